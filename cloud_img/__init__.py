@@ -4,8 +4,10 @@ from aiohttp import web
 from aiohttp_security import CookiesIdentityPolicy, setup as security_setup
 
 from .utils import (AuthorizationPolicy, config_setup, log_setup,
-                    wait_for_foundation, get_config)
+                    redis_setup, wait_for_foundation, get_config)
 from .constants import MODE
+from .hashing import setup as hashing_setup
+from .logs import request_id_middleware
 from .models import setup as db_setup
 from .routes import setup as router_setup
 
@@ -27,7 +29,7 @@ def create_app(mode=MODE.DEBUG):
         web app instance.
 
     """
-    app = web.Application()
+    app = web.Application(middlewares=[request_id_middleware])
     app['mode'] = mode
 
     config_setup(app)
@@ -37,7 +39,11 @@ def create_app(mode=MODE.DEBUG):
     wait_for_foundation(conf)
 
     db_setup(app)
-    security_setup(app, CookiesIdentityPolicy(), AuthorizationPolicy(app=app))
+    redis_setup(app)
+    hashing_setup(app)
+    authorization_policy = AuthorizationPolicy(
+        app=app, **conf.get('auth', {}).get('policy', {}))
+    security_setup(app, CookiesIdentityPolicy(), authorization_policy)
     router_setup(app)
 
     if mode is MODE.DEBUG:  # pragma: no cover
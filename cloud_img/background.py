@@ -1,12 +1,24 @@
 import asyncio
+import json
 import logging
 
 from aioredis import create_redis
 from pq.server.apps import PulsarQueue, QueueApp, Rpc, RpcServer
 from pq.server.consumer import Consumer, Producer
 
-from cloud_img.models import create_db, create_db_manager
+from cloud_img.blobs import create_blob_store
+from cloud_img.buffers import WriteBehindBuffer
+from cloud_img.cache import INVALIDATE_IMAGE, INVALIDATE_UPLOAD_CFG, \
+    image_cache, listen_invalidation_forever, parse_revision_message, \
+    upload_cfg_cache
+from cloud_img.metrics import metrics
+from cloud_img.models import ImageWithUploadCfg, create_db, \
+    create_db_manager
 from cloud_img.models.upload_cfg import Client
+from cloud_img.utils import regex_cache
+
+
+logger = logging.getLogger(__name__)
 
 
 class SetupMixin:
@@ -19,16 +31,64 @@ class SetupMixin:
         self.db_config = self.cfg.params.get('db_config')
         self.db = create_db(self.mode, self.db_config)
         self.db_manager = create_db_manager(self.db)
+        self.worker_config = self.cfg.params.get('worker_config') or {}
+        regex_cache.configure(**self.worker_config.get('regex', {}))
+        image_cache.configure(**self.worker_config.get('image_cache', {}))
+        upload_cfg_cache.configure(
+            **self.worker_config.get('upload_cfg_cache', {}))
+        # the upload results written in batches, see `jobs.upload_img`
+        self.result_buffer = WriteBehindBuffer(
+            lambda rows: self.db_manager.execute(
+                ImageWithUploadCfg.upsert_many(rows)),
+            name='image_with_upload_cfg',
+            **self.worker_config.get('result_buffer', {}))
+        metrics.register('result_buffer', self.result_buffer.stats)
 
         async def create_redis_client(uri):
             self.redis_client = await create_redis(uri)
+            self.blob_store = create_blob_store(
+                self.redis_client,
+                **self.worker_config.get('blob_store', {}))
+
+        async def listen_cache_invalidation(uri):
+            async def connect():
+                # subscribing needs a dedicated connection
+                self.pubsub_client = await create_redis(uri)
+                return self.pubsub_client
+
+            # the image invalidations published while disconnected are
+            # lost, the upload configs' revisions are checked by the jobs
+            await listen_invalidation_forever(connect, {
+                INVALIDATE_IMAGE: lambda msg: image_cache.invalidate(int(msg)),
+                INVALIDATE_UPLOAD_CFG: lambda msg: upload_cfg_cache.invalidate(
+                    *parse_revision_message(msg)),
+            }, on_resubscribe=image_cache.clear)
 
         async def create_http_client():
-            self.http_client = Client()
+            self.http_client = Client(**self.worker_config.get('http', {}))
+            metrics.register('http_client', self.http_client.stats)
 
         # attach task into running loop
         asyncio.ensure_future(create_redis_client(self.cfg.get('data_store')))
+        self._invalidation_listener = asyncio.ensure_future(
+            listen_cache_invalidation(self.cfg.get('data_store')))
         asyncio.ensure_future(create_http_client())
+        log_interval = self.worker_config.get('metrics', {}).get(
+            'log_interval', 0)
+        self._metrics_logger = None
+        if log_interval:
+            self._metrics_logger = asyncio.ensure_future(
+                self.log_metrics(log_interval))
+
+    async def log_metrics(self, interval):
+        """
+        log the snapshot of the metrics as one JSON line every `interval`
+        seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            logger.info('metrics %s', json.dumps(
+                metrics.snapshot(), sort_keys=True, default=str))
 
     def close(self, msg=None):
         """
@@ -37,16 +97,25 @@ class SetupMixin:
         async def close_redis_client():
             self.redis_client.close()
             await self.redis_client.wait_closed()
+            self._invalidation_listener.cancel()
+            pubsub_client = getattr(self, 'pubsub_client', None)
+            if pubsub_client is not None:
+                pubsub_client.close()
+                await pubsub_client.wait_closed()
 
         async def close_http_client():
             await self.http_client.close()
 
+        if self._metrics_logger is not None:
+            self._metrics_logger.cancel()
         cw_redis_client = asyncio.ensure_future(close_redis_client())
         cw_http_client = asyncio.ensure_future(close_http_client())
+        cw_result_buffer = asyncio.ensure_future(self.result_buffer.close())
         cw_inherit = super(SetupMixin, self).close(msg=msg)
+        regex_cache.close()
 
         self._closing_waiter = asyncio.gather(cw_http_client, cw_redis_client,
-                                              cw_inherit)
+                                              cw_result_buffer, cw_inherit)
         return self._closing_waiter
 
 
@@ -88,14 +157,16 @@ class CustomPulsarQueuea(PulsarQueue):
 
 
 def bg_manager(app):
-    from cloud_img.utils import get_config, build_redis_uri
-    config = get_config()['db']['redis']
-    uri = build_redis_uri(config)
+    from cloud_img.utils import get_config, build_redis_uri, thaw
+    config = get_config()
+    uri = build_redis_uri(config.redis)
     cfg = {'task_paths': ['cloud_img.jobs'], 'data_store': uri}
+    # plain dicts, the params are pickled into the consumer processes
     m = CustomPulsarQueuea(
         cfg=cfg,
         mode=app['mode'],
-        db_config=get_config()['db']['mysql'],
+        db_config=thaw(config.mysql),
+        worker_config=thaw(config.worker),
     )
     m.console_parsed = False
     m.apps()[0].logger = logging.getLogger(__name__)
@@ -0,0 +1,573 @@
+import asyncio
+import collections
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from .cache import INVALIDATE_IMAGE, publish_invalidation
+from .metrics import metrics
+
+
+__all__ = ('BlobStore', 'RedisBlobStore', 'FileBlobStore', 'TieredBlobStore',
+           'content_hash', 'create_blob_store')
+
+
+def content_hash(data):
+    """
+    the BLAKE2b hex digest of the image data, addressing its content.
+    """
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+class BlobStore:
+    """
+    Interface of the image blob stores.
+
+    The reads return bytes-like objects, which may be memoryviews
+    over the backend's buffers.
+    """
+
+    async def put(self, image_id, data, *, invalidate=True, digest=None):
+        """
+        Store the image, and invalidate it in the workers' caches
+        if `invalidate`.
+
+        Parameters
+        ----------
+        digest : str
+            the content hash if it is already computed, not hashed again.
+
+        Returns
+        -------
+        str
+            the content hash of the image.
+
+        """
+        raise NotImplementedError
+
+    async def delete(self, image_id):
+        raise NotImplementedError
+
+    async def size(self, image_id):
+        """
+        the size of the image, None if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    async def read_range(self, image_id, start, stop):
+        """
+        read the bytes of the image in [start, stop).
+        """
+        raise NotImplementedError
+
+    async def iter_chunks(self, image_id):
+        """
+        Yield the image chunk by chunk.
+
+        Raises
+        ------
+        KeyError
+            the image doesn't exist.
+
+        """
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+    async def get(self, image_id):
+        """
+        the whole image, None if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    async def touch(self, image_id):
+        """
+        mark the image as read, no-op unless the backend expires images.
+        """
+
+
+class RedisBlobStore(BlobStore):
+    """
+    Image blobs stored in redis with one key per image.
+
+    The blobs are written and read in fixed-size chunks, so no redis
+    request or reply carries a whole large image, and the keys spread
+    over the nodes of a redis cluster.
+    The images in the legacy `image` hash are still readable.
+
+    Parameters
+    ----------
+    redis_client : aioredis.Redis
+        redis client.
+    chunk_size : int
+        bytes per chunk.
+    ttl : int
+        seconds before an image expires, None means never.
+    prefix : str
+        prefix of the keys.
+    legacy_hash : str
+        name of the legacy hash of all the images, None disables it.
+
+    Usages
+    ------
+
+        >>> store = RedisBlobStore(redis_client)
+        >>> await store.put(1, image_bytes)
+        >>> await store.read_range(1, 0, 8)
+        >>> async for chunk in store.iter_chunks(1):
+        ...     pass
+
+    """
+
+    def __init__(self, redis_client, chunk_size=256 * 1024, ttl=None,
+                 prefix='image', legacy_hash='image'):
+        self.redis_client = redis_client
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.prefix = prefix
+        self.legacy_hash = legacy_hash
+
+    def key(self, image_id):
+        return f'{self.prefix}:{image_id}:blob'
+
+    async def put(self, image_id, data, *, invalidate=True, digest=None):
+        """
+        Store the image in one transaction, chunk by chunk,
+        and invalidate it in the workers' caches if `invalidate`.
+
+        Returns
+        -------
+        str
+            the content hash of the image.
+
+        """
+        key = self.key(image_id)
+        view = memoryview(data).cast('B')
+        tr = self.redis_client.multi_exec()
+        tr.delete(key)
+        for start in range(0, len(view), self.chunk_size):
+            tr.append(key, view[start:start + self.chunk_size].tobytes())
+        if self.ttl:
+            tr.expire(key, self.ttl)
+        await tr.execute()
+        if invalidate:
+            await publish_invalidation(
+                self.redis_client, INVALIDATE_IMAGE, image_id)
+        return digest if digest is not None else content_hash(view)
+
+    async def delete(self, image_id):
+        """
+        delete the image, and invalidate it in the workers' caches.
+        """
+        await self.redis_client.delete(self.key(image_id))
+        if self.legacy_hash is not None:
+            await self.redis_client.hdel(self.legacy_hash, image_id)
+        await publish_invalidation(
+            self.redis_client, INVALIDATE_IMAGE, image_id)
+
+    async def size(self, image_id):
+        """
+        the size of the image, None if it doesn't exist.
+        """
+        size = await self.redis_client.strlen(self.key(image_id))
+        if not size and self.legacy_hash is not None:
+            size = await self.redis_client.hstrlen(self.legacy_hash, image_id)
+        return size or None
+
+    async def _get_legacy(self, image_id):
+        if self.legacy_hash is None:
+            return None
+        return await self.redis_client.hget(self.legacy_hash, image_id)
+
+    async def read_range(self, image_id, start, stop):
+        """
+        read the bytes of the image in [start, stop).
+        """
+        if stop <= start:
+            return b''
+        data = await self.redis_client.getrange(
+            self.key(image_id), start, stop - 1)
+        if not data:
+            legacy = await self._get_legacy(image_id)
+            if legacy is not None:
+                data = legacy[start:stop]
+        return data
+
+    async def iter_chunks(self, image_id):
+        """
+        Yield the image chunk by chunk, only one chunk is in memory.
+
+        Raises
+        ------
+        KeyError
+            the image doesn't exist.
+        LookupError
+            the image is deleted or replaced while reading.
+
+        """
+        key = self.key(image_id)
+        size = await self.redis_client.strlen(key)
+        if not size:
+            legacy = await self._get_legacy(image_id)
+            if legacy is None:
+                raise KeyError(image_id)
+            view = memoryview(legacy)
+            for start in range(0, len(view), self.chunk_size):
+                yield view[start:start + self.chunk_size]
+            return
+
+        for start in range(0, size, self.chunk_size):
+            stop = min(start + self.chunk_size, size)
+            chunk = await self.redis_client.getrange(key, start, stop - 1)
+            if len(chunk) != stop - start:
+                raise LookupError(f'image {image_id!r} changed while reading.')
+            yield chunk
+
+    async def get(self, image_id):
+        """
+        the whole image, None if it doesn't exist.
+        """
+        try:
+            chunks = [bytes(chunk) async for chunk in self.iter_chunks(
+                image_id)]
+        except KeyError:
+            return None
+        return b''.join(chunks)
+
+    async def touch(self, image_id):
+        """
+        restart the expiration of the image.
+        """
+        if self.ttl:
+            await self.redis_client.expire(self.key(image_id), self.ttl)
+
+
+class FileBlobStore(BlobStore):
+    """
+    Image blobs stored as files in sharded directories.
+
+    The files are memory-mapped for reading, the returned memoryviews
+    share the pages of the OS page cache instead of copying them.
+    The files are replaced atomically, the readers of the previous file
+    keep their mapping.
+    All the file operations run in the default executor, including
+    faulting in the mapped pages, so the event loop doesn't wait
+    for the disk.
+
+    Parameters
+    ----------
+    root : str
+        root directory of the blobs.
+    shard_depth : int
+        levels of the shard directories.
+    shard_width : int
+        hex characters in the name of a shard directory.
+    chunk_size : int
+        bytes per chunk of `iter_chunks`.
+    redis_client : aioredis.Redis
+        publishes the invalidations, None disables them.
+
+    """
+
+    def __init__(self, root, shard_depth=2, shard_width=2,
+                 chunk_size=256 * 1024, redis_client=None):
+        self.root = Path(root)
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        self.chunk_size = chunk_size
+        self.redis_client = redis_client
+
+    def path(self, image_id):
+        """
+        the path of the image, sharded by the hash of its id so that
+        the sequential ids spread over the directories.
+        """
+        digest = hashlib.blake2b(str(image_id).encode('utf-8'),
+                                 digest_size=16).hexdigest()
+        width = self.shard_width
+        shards = [digest[i * width:(i + 1) * width]
+                  for i in range(self.shard_depth)]
+        return self.root.joinpath(*shards, str(image_id))
+
+    @staticmethod
+    def _write(path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _map(self, image_id):
+        try:
+            with open(self.path(image_id), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b'')
+                return memoryview(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _fault_in(view):
+        """
+        touch one byte per page, so that the pages are read from the disk
+        by the executor's thread instead of when the view is consumed.
+        """
+        bytes(view[::mmap.PAGESIZE])
+        return view
+
+    def _read(self, image_id, start=0, stop=None):
+        view = self._map(image_id)
+        if view is None:
+            return None
+        return self._fault_in(view[start:stop])
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    async def _run(fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, fn, *args)
+
+    async def _invalidate(self, image_id):
+        if self.redis_client is not None:
+            await publish_invalidation(
+                self.redis_client, INVALIDATE_IMAGE, image_id)
+
+    async def put(self, image_id, data, *, invalidate=True, digest=None):
+        """
+        Write the image in the default executor, and invalidate it
+        in the workers' caches if `invalidate`.
+
+        Returns
+        -------
+        str
+            the content hash of the image.
+
+        """
+        view = memoryview(data).cast('B')
+        await self._run(self._write, self.path(image_id), view)
+        if invalidate:
+            await self._invalidate(image_id)
+        return digest if digest is not None else content_hash(view)
+
+    async def delete(self, image_id):
+        await self._run(self._unlink, self.path(image_id))
+        await self._invalidate(image_id)
+
+    async def size(self, image_id):
+        return await self._run(self._size, self.path(image_id))
+
+    async def read_range(self, image_id, start, stop):
+        if stop <= start:
+            return b''
+        view = await self._run(self._read, image_id, start, stop)
+        if view is None:
+            return b''
+        return view
+
+    async def iter_chunks(self, image_id):
+        """
+        Yield the image chunk by chunk from one mapping of the file.
+
+        Raises
+        ------
+        KeyError
+            the image doesn't exist.
+
+        """
+        view = await self._run(self._map, image_id)
+        if view is None:
+            raise KeyError(image_id)
+        for start in range(0, len(view), self.chunk_size):
+            yield await self._run(
+                self._fault_in, view[start:start + self.chunk_size])
+
+    async def get(self, image_id):
+        return await self._run(self._read, image_id)
+
+
+class TieredBlobStore(BlobStore):
+    """
+    Image blobs in a cold tier with the frequently read ones
+    also in a hot tier.
+
+    The images are written through both tiers. A cold image read
+    `promote_hits` times within `window` seconds is promoted into the hot
+    tier, the reads of a hot image restart its expiration, and the idle
+    ones are demoted by expiring from the hot tier.
+
+    Parameters
+    ----------
+    hot : BlobStore
+        fast tier expiring the images, e.g. `RedisBlobStore` with a ttl.
+    cold : BlobStore
+        durable tier, e.g. `FileBlobStore`.
+    promote_hits : int
+        cold reads to promote an image.
+    window : float
+        seconds the cold reads are counted in.
+    max_tracked : int
+        maximum count of the images whose cold reads are counted.
+
+    """
+
+    def __init__(self, hot, cold, promote_hits=3, window=300,
+                 max_tracked=10000):
+        self.hot = hot
+        self.cold = cold
+        self.promote_hits = promote_hits
+        self.window = window
+        self.max_tracked = max_tracked
+        self.hot_hits = 0
+        self.cold_hits = 0
+        self.misses = 0
+        self.promotions = 0
+        # image_id -> (hits, window_start)
+        self._accesses = collections.OrderedDict()
+
+    def _count_access(self, image_id):
+        """
+        count a cold read, return whether the image should be promoted.
+        """
+        now = time.monotonic()
+        hits, window_start = self._accesses.pop(image_id, (0, now))
+        if now - window_start >= self.window:
+            hits, window_start = 0, now
+        hits += 1
+        if hits >= self.promote_hits:
+            return True
+        self._accesses[image_id] = (hits, window_start)
+        while len(self._accesses) > self.max_tracked:
+            self._accesses.popitem(last=False)
+        return False
+
+    async def _read_cold(self, image_id):
+        data = await self.cold.get(image_id)
+        if data is None:
+            self.misses += 1
+            return None
+        self.cold_hits += 1
+        if self._count_access(image_id):
+            # the content is unchanged, the caches are still valid
+            await self.hot.put(image_id, data, invalidate=False)
+            self.promotions += 1
+            metrics.incr('blobs.promotion')
+        return data
+
+    async def put(self, image_id, data, *, invalidate=True, digest=None):
+        digest = await self.cold.put(
+            image_id, data, invalidate=False, digest=digest)
+        await self.hot.put(
+            image_id, data, invalidate=invalidate, digest=digest)
+        self._accesses.pop(image_id, None)
+        return digest
+
+    async def delete(self, image_id):
+        await self.cold.delete(image_id)
+        await self.hot.delete(image_id)
+        self._accesses.pop(image_id, None)
+
+    async def size(self, image_id):
+        size = await self.hot.size(image_id)
+        if size is None:
+            size = await self.cold.size(image_id)
+        return size
+
+    async def read_range(self, image_id, start, stop):
+        if await self.hot.size(image_id) is not None:
+            return await self.hot.read_range(image_id, start, stop)
+        return await self.cold.read_range(image_id, start, stop)
+
+    async def iter_chunks(self, image_id):
+        """
+        yield the image chunk by chunk from the hot tier if it is there,
+        otherwise from the cold tier.
+        """
+        if await self.hot.size(image_id) is not None:
+            self.hot_hits += 1
+            await self.hot.touch(image_id)
+            chunks = self.hot.iter_chunks(image_id)
+        else:
+            if await self._read_cold(image_id) is None:
+                raise KeyError(image_id)
+            chunks = self.cold.iter_chunks(image_id)
+        async for chunk in chunks:
+            yield chunk
+
+    async def get(self, image_id):
+        data = await self.hot.get(image_id)
+        if data is not None:
+            self.hot_hits += 1
+            await self.hot.touch(image_id)
+            return data
+        return await self._read_cold(image_id)
+
+    def stats(self):
+        return {
+            'hot_hits': self.hot_hits,
+            'cold_hits': self.cold_hits,
+            'misses': self.misses,
+            'promotions': self.promotions,
+            'tracked': len(self._accesses),
+        }
+
+
+def create_blob_store(redis_client, backend='redis', redis=None, file=None,
+                      tiered=None):
+    """
+    Create the blob store of the worker config `worker.blob_store`.
+
+    Only the hot tier of the tiered backend expires the images,
+    the redis backend keeps the only copy of them.
+
+    Parameters
+    ----------
+    redis_client : aioredis.Redis
+        redis client.
+    backend : str
+        'redis', 'file', or 'tiered' with the redis hot tier
+        over the file cold tier.
+    redis, file, tiered : dict
+        options of `RedisBlobStore`, `FileBlobStore` and `TieredBlobStore`,
+        `tiered` also takes `hot_ttl`, seconds before an idle image
+        is demoted from the hot tier.
+
+    """
+    assert backend in ('redis', 'file', 'tiered'), \
+        f'unknown backend {backend!r}'
+    redis = dict(redis or {})
+    # the only copy of the images, the expired ones can't be uploaded
+    assert not redis.get('ttl'), \
+        'the redis options should not expire the images, ' \
+        'set tiered.hot_ttl for the hot tier.'
+    if backend == 'redis':
+        return RedisBlobStore(redis_client, **redis)
+    if backend == 'file':
+        return FileBlobStore(redis_client=redis_client, **(file or {}))
+    tiered = dict(tiered or {})
+    hot_ttl = tiered.pop('hot_ttl', 86400)
+    store = TieredBlobStore(
+        RedisBlobStore(redis_client, ttl=hot_ttl, **redis),
+        FileBlobStore(**(file or {})),
+        **tiered)
+    metrics.register('blob_store', store.stats)
+    return store
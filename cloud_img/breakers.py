@@ -0,0 +1,104 @@
+import time
+
+from .metrics import metrics
+
+
+__all__ = ('CircuitBreaker', 'CircuitOpen')
+
+
+class CircuitOpen(Exception):
+    """
+    raised instead of calling a host whose circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Fast-fail the calls to a host which keeps failing.
+
+    The circuit opens after `failure_threshold` consecutive failures,
+    and the calls fail with `CircuitOpen` without reaching the host.
+    After `reset_timeout` seconds one trial call is let through,
+    the circuit closes if it succeeds, otherwise it opens again.
+    Only the failures of the host count, e.g. connection errors and
+    5xx responses, not `CircuitOpen` itself.
+
+    Parameters
+    ----------
+    name : str
+        name in the metrics, e.g. the host.
+    failure_threshold : int
+        consecutive failures to open the circuit.
+    reset_timeout : float
+        seconds the circuit stays open before the trial call.
+
+    Usages
+    ------
+
+        >>> breaker = CircuitBreaker('example.com')
+        >>> breaker.before_call()
+        >>> try:
+        ...     await call()
+        ... except Exception:
+        ...     breaker.record_failure()
+        ...     raise
+        ... else:
+        ...     breaker.record_success()
+
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+
+    def before_call(self):
+        """
+        Check the circuit before calling the host.
+
+        Raises
+        ------
+        CircuitOpen
+            the circuit is open, or the trial call is in flight.
+
+        """
+        now = time.monotonic()
+        if self.state != self.CLOSED and \
+                now - self.opened_at >= self.reset_timeout:
+            # let this call through as the trial, another one is let
+            # through if it doesn't finish in `reset_timeout` seconds
+            self.state = self.HALF_OPEN
+            self.opened_at = now
+            return
+        if self.state != self.CLOSED:
+            self.rejected += 1
+            metrics.incr('breakers.rejected')
+            raise CircuitOpen(f'circuit of {self.name!r} is {self.state}.')
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or \
+                self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                metrics.incr('breakers.opened')
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+        }
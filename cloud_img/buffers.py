@@ -0,0 +1,146 @@
+import asyncio
+import logging
+
+from .metrics import metrics
+
+
+__all__ = ('WriteBehindBuffer', )
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Collect rows and write them in batches.
+
+    A batch is written once `max_rows` rows are collected or `max_delay`
+    seconds after its first row. `add` returns after the batch with the
+    row is written, so a job acknowledged after it has its row committed.
+    When a batch fails, its rows are written one by one, and only
+    the callers of the failing rows get the error.
+
+    Parameters
+    ----------
+    write : coroutine function
+        writes a list of rows in one query, e.g. a multi-row upsert.
+    max_rows : int
+        rows per batch.
+    max_delay : float
+        seconds a row waits for the others.
+    name : str
+        name in the metrics.
+
+    Usages
+    ------
+
+        >>> buffer = WriteBehindBuffer(
+        ...     lambda rows: db_manager.execute(
+        ...         ImageWithUploadCfg.upsert_many(rows)),
+        ...     name='image_with_upload_cfg')
+        >>> await buffer.add({'image_id': 1, 'upload_cfg_id': 1})
+        >>> await buffer.close()
+
+    """
+
+    def __init__(self, write, max_rows=100, max_delay=0.05, name='rows'):
+        self.write = write
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.name = name
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self._rows = []
+        self._waiters = []
+        self._timer = None
+        self._flushing = set()
+
+    async def add(self, row):
+        """
+        Add the row and wait until it is written.
+
+        Raises
+        ------
+        Exception
+            the error of writing the row.
+
+        """
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._rows.append(row)
+        self._waiters.append(waiter)
+        if len(self._rows) >= self.max_rows:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+        # the row is written even if the caller is cancelled
+        await asyncio.shield(waiter)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._rows:
+            return
+        rows, waiters = self._rows, self._waiters
+        self._rows, self._waiters = [], []
+        task = asyncio.ensure_future(self._flush(rows, waiters))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, rows, waiters):
+        self.flushes += 1
+        try:
+            with metrics.timer(f'buffers.{self.name}.flush'):
+                await self.write(rows)
+        except Exception as exc:
+            if len(rows) == 1:
+                self._done(rows, waiters, exc)
+                return
+            logger.warning('flushing %d rows of %s fails: %r, '
+                           'writing them one by one',
+                           len(rows), self.name, exc)
+            for row, waiter in zip(rows, waiters):
+                try:
+                    await self.write([row])
+                except Exception as row_exc:
+                    self._done([row], [waiter], row_exc)
+                else:
+                    self._done([row], [waiter])
+        else:
+            self._done(rows, waiters)
+
+    def _done(self, rows, waiters, exc=None):
+        if exc is None:
+            self.flushed_rows += len(rows)
+            metrics.incr(f'buffers.{self.name}.rows', len(rows))
+        else:
+            self.failed_rows += len(rows)
+            metrics.incr(f'buffers.{self.name}.failure', len(rows))
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    async def flush(self):
+        """
+        write the collected rows now, and wait for all the pending batches.
+        """
+        self._start_flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing)
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._rows),
+            'flushing': len(self._flushing),
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'failed_rows': self.failed_rows,
+        }
@@ -0,0 +1,401 @@
+import asyncio
+import collections
+import logging
+import time
+
+from .metrics import metrics
+
+
+__all__ = ('ByteLRUCache', 'VersionedCache', 'INVALIDATE_IMAGE',
+           'INVALIDATE_UPLOAD_CFG', 'image_cache', 'upload_cfg_cache',
+           'publish_invalidation', 'bump_upload_cfg_revision',
+           'fetch_upload_cfg_revision', 'parse_revision_message',
+           'listen_invalidation', 'listen_invalidation_forever')
+
+logger = logging.getLogger(__name__)
+
+# redis pub/sub channels to invalidate the caches of the workers
+INVALIDATE_IMAGE = 'cloud_img:invalidate:image'
+INVALIDATE_UPLOAD_CFG = 'cloud_img:invalidate:upload_cfg'
+# redis hash of the revision counters by upload config's id
+UPLOAD_CFG_REVISION = 'upload_cfg:revision'
+
+
+class ByteLRUCache:
+    """
+    LRU cache of bytes values bounded by their total size.
+
+    It is shared by all the coroutines of one process,
+    concurrent loads of the same key wait for one loader call.
+
+    Parameters
+    ----------
+    max_bytes : int
+        memory ceiling of the cached values.
+    ttl : float
+        seconds before an entry expires, None means never.
+    max_item_bytes : int
+        values larger than it are not cached, defaults to `max_bytes`.
+
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=None,
+                 max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # key -> (value, expire_at)
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+
+    def configure(self, max_bytes=None, ttl=None, max_item_bytes=None):
+        """
+        configure the cache through the worker config.
+        """
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes
+        self._evict()
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expire_at = entry
+        if expire_at is not None and expire_at <= time.monotonic():
+            self.expirations += 1
+            self._remove(key)
+            return None
+        return value
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self.bytes -= len(value)
+
+    def _evict(self):
+        while self._entries and self.bytes > self.max_bytes:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def fits(self, size):
+        """
+        whether a value of `size` bytes can be cached.
+        """
+        max_item_bytes = self.max_item_bytes or self.max_bytes
+        return size <= min(max_item_bytes, self.max_bytes)
+
+    def set(self, key, value):
+        """
+        cache the value if it fits in the cache.
+        """
+        if key in self._entries:
+            self._remove(key)
+        if not self.fits(len(value)):
+            return
+        expire_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (value, expire_at)
+        self.bytes += len(value)
+        self._evict()
+
+    async def get(self, key, loader):
+        """
+        get the value from cache or load it by `await loader()`.
+
+        None returned by the loader is not cached.
+        """
+        value = self._lookup(key)
+        if value is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+        self.misses += 1
+        loading = self._loading.get(key)
+        if loading is not None:
+            return await asyncio.shield(loading)
+
+        loading = asyncio.ensure_future(loader())
+        self._loading[key] = loading
+        try:
+            value = await asyncio.shield(loading)
+        finally:
+            # invalidated while loading if it is not the current load
+            current = self._loading.get(key) is loading
+            if current:
+                del self._loading[key]
+        if value is not None and current:
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        """
+        drop the entry of `key`, a pending load is not cached either.
+        """
+        self._loading.pop(key, None)
+        if key in self._entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
+
+
+class VersionedCache:
+    """
+    LRU cache of values keyed by (key, revision).
+
+    Only the entry of the latest known revision of a key is served,
+    the revision is raised by `invalidate` when the value is written.
+
+    Parameters
+    ----------
+    maxsize : int
+        maximum count of the cached keys.
+
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._revisions = {}
+        # key -> (revision, value)
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+
+    def configure(self, maxsize=None):
+        """
+        configure the cache through the worker config.
+        """
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self._evict()
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] == self.revision(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def revision(self, key):
+        """
+        the latest known revision of `key`.
+        """
+        return self._revisions.get(key, 0)
+
+    async def get(self, key, loader):
+        """
+        get the value of the latest revision or load it by `await loader()`.
+
+        None returned by the loader is not cached.
+        """
+        revision = self.revision(key)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == revision:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        loading_key = (key, revision)
+        loading = self._loading.get(loading_key)
+        if loading is None:
+            loading = asyncio.ensure_future(loader())
+            self._loading[loading_key] = loading
+            loading.add_done_callback(
+                lambda _: self._loading.pop(loading_key, None))
+        value = await asyncio.shield(loading)
+        # a newer revision is written while loading
+        if value is not None and revision == self.revision(key):
+            self._entries[key] = (revision, value)
+            self._entries.move_to_end(key)
+            self._evict()
+        return value
+
+    def invalidate(self, key, revision=None):
+        """
+        raise the revision of `key` to `revision`, or by one if it is None.
+        The stale revisions are ignored, messages can arrive out of order.
+        """
+        current = self.revision(key)
+        if revision is None:
+            revision = current + 1
+        if revision <= current:
+            return
+        self._revisions[key] = revision
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+# image data of the upload worker, configured by `worker.image_cache`
+image_cache = ByteLRUCache()
+metrics.register('image_cache', image_cache.stats)
+# upload configs of the upload worker, configured by `worker.upload_cfg_cache`
+upload_cfg_cache = VersionedCache()
+metrics.register('upload_cfg_cache', upload_cfg_cache.stats)
+
+
+async def publish_invalidation(redis_client, channel, key):
+    """
+    tell all the workers to invalidate `key` in the cache of `channel`.
+    """
+    await redis_client.publish(channel, str(key))
+
+
+async def bump_upload_cfg_revision(redis_client, upload_cfg_id):
+    """
+    Bump the revision counter of the upload config after writing it,
+    and tell all the workers to drop their cached older revisions.
+
+    Returns
+    -------
+    int
+        the new revision.
+
+    """
+    revision = await redis_client.hincrby(UPLOAD_CFG_REVISION, upload_cfg_id)
+    await redis_client.publish(INVALIDATE_UPLOAD_CFG,
+                               f'{upload_cfg_id}:{revision}')
+    return revision
+
+
+async def fetch_upload_cfg_revision(redis_client, upload_cfg_id):
+    """
+    the revision counter of the upload config, 0 if it is never bumped.
+    """
+    revision = await redis_client.hget(UPLOAD_CFG_REVISION, upload_cfg_id)
+    return int(revision) if revision is not None else 0
+
+
+def parse_revision_message(message):
+    """
+    parse the message published by `bump_upload_cfg_revision`.
+    """
+    key, revision = message.split(':')
+    return int(key), int(revision)
+
+
+async def listen_invalidation(redis_client, handlers):
+    """
+    Subscribe the invalidation channels and dispatch the messages
+    until the redis connection closes.
+
+    Parameters
+    ----------
+    redis_client : aioredis.Redis
+        a dedicated connection, it is in subscribe mode afterwards.
+    handlers : Mapping
+        handler by channel, called with the decoded message.
+
+    """
+    channels = await redis_client.subscribe(*handlers)
+
+    async def reader(channel):
+        handler = handlers[channel.name.decode('utf-8')]
+        while await channel.wait_message():
+            message = await channel.get(encoding='utf-8')
+            try:
+                handler(message)
+            except Exception:
+                logger.exception('invalidation handler of %r fails',
+                                 channel.name)
+
+    await asyncio.gather(*[reader(channel) for channel in channels])
+
+
+async def listen_invalidation_forever(connect, handlers, on_resubscribe=None,
+                                      base_delay=0.5, max_delay=30):
+    """
+    Run `listen_invalidation` and subscribe again whenever the connection
+    closes or fails, waiting from `base_delay` up to `max_delay` seconds
+    between the attempts. It returns only when cancelled.
+
+    Parameters
+    ----------
+    connect : coroutine function
+        creates a dedicated redis connection.
+    handlers : Mapping
+        handler by channel, called with the decoded message.
+    on_resubscribe : callable
+        called before subscribing again, the messages published while
+        disconnected are lost, e.g. clearing the cache.
+    base_delay : float
+        seconds to wait after the first disconnection.
+    max_delay : float
+        maximum seconds to wait, the wait is reset after a subscription
+        lasts longer than it.
+
+    """
+    delay = base_delay
+    while True:
+        started = time.monotonic()
+        try:
+            redis_client = await connect()
+            try:
+                await listen_invalidation(redis_client, handlers)
+            finally:
+                redis_client.close()
+            reason = 'is closed'
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            reason = f'fails: {err!r}'
+        if time.monotonic() - started > max_delay:
+            delay = base_delay
+        logger.warning('invalidation subscription %s, '
+                       'subscribing again in %.1fs', reason, delay)
+        metrics.incr('cache.invalidation.resubscribe')
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+        if on_resubscribe is not None:
+            on_resubscribe()
@@ -0,0 +1,112 @@
+import logging
+
+from .metrics import metrics
+
+
+__all__ = ('UserCounter', 'TOTAL_MODES', 'image_counter', 'upload_cfg_counter',
+           'get_total')
+
+logger = logging.getLogger(__name__)
+
+# how a list endpoint resolves its total, selected by the `total` argument
+TOTAL_MODES = ('exact', 'approximate', 'none')
+
+# increase the counter only if it is cached, a missing counter is counted
+# from the database on the next read
+INCR_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+
+class UserCounter:
+    """
+    Row counts of a table cached in redis by user.
+
+    The counters are kept up to date by the create and delete paths
+    through `incr`, and reconcile with the database when they expire.
+
+    Parameters
+    ----------
+    name : str
+        name of the counted table.
+    ttl : int
+        seconds before a counter is counted from the database again.
+
+    Usages
+    ------
+
+        >>> total = await image_counter.get(
+        ...     redis_client, lambda: Image.count(user_id=1, db_manager=db),
+        ...     1)
+        >>> await image_counter.incr(redis_client, 1)
+
+    """
+
+    def __init__(self, name, ttl=3600):
+        self.name = name
+        self.ttl = ttl
+
+    def key(self, *parts):
+        """
+        the key of the counter, `parts` such as (user_id, ) or
+        (user_id, upload_cfg_id) for the filtered count.
+        """
+        return ':'.join(['counter', self.name, *map(str, parts)])
+
+    async def get(self, redis_client, count, *parts):
+        """
+        get the cached count, or count it by `await count()` and cache it.
+        """
+        key = self.key(*parts)
+        value = await redis_client.get(key)
+        if value is not None:
+            metrics.incr(f'counters.{self.name}.hit')
+            return int(value)
+
+        metrics.incr(f'counters.{self.name}.miss')
+        value = await count()
+        await redis_client.set(key, value, expire=self.ttl,
+                               exist=redis_client.SET_IF_NOT_EXIST)
+        return value
+
+    async def incr(self, redis_client, *parts, delta=1):
+        """
+        increase the cached count by `delta`, pass a negative one when
+        deleting rows.
+        """
+        await redis_client.eval(
+            INCR_IF_EXISTS, keys=[self.key(*parts)], args=[delta])
+
+    async def invalidate(self, redis_client, *parts):
+        await redis_client.delete(self.key(*parts))
+
+
+image_counter = UserCounter('image')
+upload_cfg_counter = UserCounter('upload_cfg')
+
+
+async def get_total(mode, counter, redis_client, count, *parts):
+    """
+    Resolve the total of a list endpoint.
+
+    Parameters
+    ----------
+    mode : str
+        one of `TOTAL_MODES`,
+        exact runs `count`, approximate reads the cached counter
+        and none skips the total.
+
+    Returns
+    -------
+    int
+        the total, None if the mode is none.
+
+    """
+    if mode == 'exact':
+        return await count()
+    if mode == 'approximate':
+        return await counter.get(redis_client, count, *parts)
+    return None
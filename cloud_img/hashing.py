@@ -0,0 +1,149 @@
+import asyncio
+import concurrent.futures
+import functools
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .metrics import metrics
+from .utils import get_config
+
+
+__all__ = ('PasswordHasher', 'HasherBusy', 'password_hasher', 'setup')
+
+
+class HasherBusy(Exception):
+    """
+    raised when too many hashing operations are pending.
+    """
+
+
+class PasswordHasher:
+    """
+    Hash and check passwords in a bounded executor off the event loop.
+
+    Parameters
+    ----------
+    max_workers : int
+        size of the executor.
+    executor : str
+        'thread' or 'process', hashlib releases the GIL during PBKDF2,
+        so threads are enough unless the hash method is pure python.
+    iterations : int
+        PBKDF2 work factor of the new hashes, None means werkzeug's default.
+        The existing hashes keep their own work factor.
+    max_pending : int
+        maximum count of the running and queued operations,
+        more raise `HasherBusy`, None means no limit.
+
+    """
+
+    def __init__(self, max_workers=2, executor='thread', iterations=None,
+                 max_pending=None):
+        self._executor = None
+        self.configure(max_workers, executor, iterations, max_pending)
+
+    def configure(self, max_workers=2, executor='thread', iterations=None,
+                  max_pending=None):
+        """
+        configure the hasher through the app config.
+        """
+        assert executor in ('thread', 'process'), \
+            f'unknown executor {executor!r}'
+        self.close()
+        self.max_workers = max_workers
+        self.executor_type = executor
+        self.iterations = iterations
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+
+    @property
+    def method(self):
+        if self.iterations is None:
+            return 'pbkdf2:sha256'
+        return f'pbkdf2:sha256:{self.iterations}'
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.executor_type == 'process':
+                executor_cls = concurrent.futures.ProcessPoolExecutor
+            else:
+                executor_cls = concurrent.futures.ThreadPoolExecutor
+            self._executor = executor_cls(max_workers=self.max_workers)
+        return self._executor
+
+    def generate(self, password):
+        """
+        hash the password synchronously.
+        """
+        return generate_password_hash(password, method=self.method)
+
+    async def _run(self, name, fn, *args):
+        if self.max_pending is not None and self.pending >= self.max_pending:
+            self.rejected += 1
+            metrics.incr(f'hashing.{name}.rejected')
+            raise HasherBusy(f'{self.pending} hashing operations pending.')
+        self.pending += 1
+        try:
+            with metrics.timer(f'hashing.{name}'):
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(
+                    self.executor, functools.partial(fn, *args))
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        """
+        hash the password in the executor.
+
+        Raises
+        ------
+        HasherBusy
+            too many hashing operations are pending.
+
+        """
+        return await self._run(
+            'hash', generate_password_hash, password, self.method)
+
+    async def check(self, pwhash, password):
+        """
+        check the password against the hash in the executor.
+
+        Raises
+        ------
+        HasherBusy
+            too many hashing operations are pending.
+
+        """
+        return await self._run('check', check_password_hash, pwhash, password)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'rejected': self.rejected,
+        }
+
+
+password_hasher = PasswordHasher()
+metrics.register('password_hasher', password_hasher.stats)
+
+
+def setup(app):
+    """
+    setup the password hasher with the config `auth.password`.
+    """
+    password_hasher.configure(
+        **get_config().get('auth', {}).get('password', {}))
+
+    async def acleanup(app):
+        password_hasher.close()
+
+    app.on_cleanup.append(acleanup)
@@ -1,3 +1,3 @@
-from .upload import upload_img
+from .upload import upload_img, upload_img_to_many
 
-__all__ = (upload_img, )
+__all__ = (upload_img, upload_img_to_many)
@@ -1,22 +1,159 @@
-from async_lru import alru_cache
+import asyncio
+import logging
+
 from pq import api
 
-from cloud_img.models import ImageWithUploadCfg, UploadCfg
+from cloud_img.cache import (fetch_upload_cfg_revision, image_cache,
+                             upload_cfg_cache)
+from cloud_img.counters import image_counter
+from cloud_img.logs import with_job_context
+from cloud_img.metrics import metrics
+from cloud_img.models import Image, ImageWithUploadCfg, UploadCfg
+from cloud_img.models.upload_cfg import Client
+from cloud_img.utils import retry
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageNotFound(LookupError):
+    """
+    raised when the image to upload doesn't exist in the blob store,
+    the job fails at once without retrying.
+    """
+
+
+async def get_image_data(blob_store, image_id):
+    """
+    get the image data through the worker's image cache.
+    """
+    return await image_cache.get(
+        int(image_id), lambda: blob_store.get(image_id))
+
+
+async def open_image(blob_store, image_id, upload_cfg):
+    """
+    Open the image data for the upload config.
+
+    The images too large for the worker's image cache are streamed
+    from the blob store chunk by chunk, unless the upload config
+    needs the data in more than one formdata field.
+
+    Returns
+    -------
+    bytes or async iterable
+        the image data
+
+    Raises
+    ------
+    ImageNotFound
+        if the image doesn't exist.
+
+    """
+    if int(image_id) not in image_cache and \
+            len(upload_cfg.plan.image_fields) <= 1:
+        size = await blob_store.size(image_id)
+        if size is None:
+            raise ImageNotFound(image_id)
+        if not image_cache.fits(size):
+            metrics.incr('jobs.upload_img.stream')
+            return blob_store.iter_chunks(image_id)
+    image_data = await get_image_data(blob_store, image_id)
+    if image_data is None:
+        raise ImageNotFound(image_id)
+    return image_data
+
+
+async def get_upload_cfg(mysql_client, redis_client, upload_cfg_id):
+    """
+    Get the latest revision of the upload config through the worker's cache.
+
+    The revision counter in redis is checked on every call, so a revision
+    whose invalidation message is lost, e.g. while the subscription is
+    reconnecting, is not served.
+    """
+    async def load():
+        return await mysql_client.get(UploadCfg, id=upload_cfg_id)
+
+    upload_cfg_id = int(upload_cfg_id)
+    upload_cfg_cache.invalidate(
+        upload_cfg_id,
+        await fetch_upload_cfg_revision(redis_client, upload_cfg_id))
+    return await upload_cfg_cache.get(upload_cfg_id, load)
+
+
+async def find_reusable_result(mysql_client, image_id, upload_cfg_id):
+    """
+    the upload result of the same content on the upload config,
+    to be reused instead of uploading the image again.
+    """
+    rv = await ImageWithUploadCfg.find_duplicate(
+        image_id, upload_cfg_id, db_manager=mysql_client)
+    if rv is None:
+        return None
+    metrics.incr('jobs.upload_img.dedup')
+    return {
+        'image_url': rv.image_url,
+        'thumbnail_url': rv.thumbnail_url,
+        'delete_url': rv.delete_url,
+    }
+
+
+async def get_uploaded_cfg_ids(mysql_client, image_id):
+    """
+    the ids of the upload configs the image is already uploaded to,
+    the repeated jobs skip them.
+    """
+    rows = await Image.get_upload_cfgs(image_id, db_manager=mysql_client)
+    return {row.upload_cfg_id for row in rows}
+
+
+def result_row(image_id, upload_cfg_id, rv):
+    """
+    the row of `ImageWithUploadCfg.upsert_many` of an upload result,
+    keyed by the field names, the column names are not recognized.
+    """
+    return dict(image=image_id, upload_cfg=upload_cfg_id, **rv)
+
+
+async def do_upload(backend, upload_cfg, image_data):
+    """
+    upload the image with the worker's upload options.
+    """
+    upload_config = backend.worker_config.get('upload', {})
+    with metrics.timer('jobs.upload_img.upload'):
+        rv, _ = await upload_cfg.upload(
+            backend.http_client,
+            image_data,
+            stream=upload_config.get('stream_response', False),
+            window=upload_config.get('stream_window', 64 * 1024))
+    return rv
+
 
+async def upload_with_retry(backend, upload_cfg, open_data):
+    """
+    Upload the image, retrying the failures of the host with exponential
+    backoff, configured by the worker config `upload.retry`.
 
-@alru_cache()
-async def get_image_data(redis_client, image_id):
-    data = await redis_client.hget('image', image_id)
-    return data
+    The `CircuitOpen` of a failing host is raised at once.
 
+    Parameters
+    ----------
+    open_data : callable
+        returns an awaitable of the image data, called per attempt
+        since a streamed image can't be sent twice.
+
+    """
+    async def attempt():
+        return await do_upload(backend, upload_cfg, await open_data())
 
-@alru_cache()
-async def get_upload_cfg(mysql_client, upload_cfg_id):
-    upload_cfg = await mysql_client.get(UploadCfg, id=upload_cfg_id)
-    return upload_cfg
+    retry_config = backend.worker_config.get('upload', {}).get('retry', {})
+    return await retry(attempt, exceptions=Client.HOST_ERRORS,
+                       name='jobs.upload_img', **retry_config)
 
 
 @api.job()
+@with_job_context
 async def upload_img(self, user_id, image_id, upload_cfg_id):
     """
     dispatch upload img job to broker.
@@ -28,11 +165,16 @@ async def upload_img(self, user_id, image_id, upload_cfg_id):
     image_id : int
         image's id
 
-        also cache it into redis and lru_cache it into memory
+        read from the blob store through the worker's image cache,
+        streamed chunk by chunk if it is too large for the cache
     upload_cfg_id : int
         upload_cfg's id
 
-        lru_cache it into memory
+        cache it into memory until its revision is bumped,
+        the result of the same content on it is reused without uploading
+
+    The job is idempotent by (image_id, upload_cfg_id),
+    a repeated one does nothing if the image is already uploaded.
 
     Usages
     ------
@@ -44,18 +186,118 @@ async def upload_img(self, user_id, image_id, upload_cfg_id):
     """
     db_manager = self.backend.db_manager
     redis_client = self.backend.redis_client
-    http_client = self.backend.http_client
 
-    image_bytes = await get_image_data(redis_client, image_id)
-    upload_cfg = await get_upload_cfg(db_manager, upload_cfg_id)
+    if upload_cfg_id in await get_uploaded_cfg_ids(db_manager, image_id):
+        metrics.incr('jobs.upload_img.repeated')
+        return
 
-    rv, _ = await upload_cfg.upload(http_client, image_bytes)
+    rv = await find_reusable_result(db_manager, image_id, upload_cfg_id)
+    if rv is None:
+        upload_cfg = await get_upload_cfg(
+            db_manager, redis_client, upload_cfg_id)
+        rv = await upload_with_retry(
+            self.backend, upload_cfg,
+            lambda: open_image(self.backend.blob_store, image_id, upload_cfg))
 
     # TODO: validate rv
-    # TODO: handle exception
 
-    await db_manager.create(
-        ImageWithUploadCfg,
-        image_id=image_id,
-        upload_cfg_id=upload_cfg_id,
-        **rv)
+    # written in a batch with the other jobs' results,
+    # the job succeeds only after it is committed
+    await self.backend.result_buffer.add(
+        result_row(image_id, upload_cfg_id, rv))
+    # the image is listed under the upload config now
+    await image_counter.incr(redis_client, user_id, upload_cfg_id)
+
+
+@api.job()
+@with_job_context
+async def upload_img_to_many(self, user_id, image_id, upload_cfg_ids,
+                             concurrency=4):
+    """
+    dispatch the job uploading one img to many upload configs to broker.
+
+    The image data is fetched once, then uploaded to all the upload configs
+    concurrently, and the results are inserted in one bulk insert.
+
+    Parameters
+    ----------
+    user_id : int
+        user's id
+    image_id : int
+        image's id
+    upload_cfg_ids : list
+        upload_cfgs' ids
+    concurrency : int
+        maximum count of the concurrent uploads
+
+    Returns
+    -------
+    dict
+        result of every upload config by its id,
+        {'status': 'SUCCESS'} or {'status': 'FAILURE', 'error': str},
+        the upload configs the image is already uploaded to are skipped
+        as SUCCESS.
+
+    Usages
+    ------
+
+        >>> task = await api.tasks.queue(
+        ...     'upload_img_to_many', 1, 1, [1, 2, 3], callback=False)
+    """
+    db_manager = self.backend.db_manager
+    redis_client = self.backend.redis_client
+
+    uploaded = await get_uploaded_cfg_ids(db_manager, image_id)
+    pending = [upload_cfg_id for upload_cfg_id in upload_cfg_ids
+               if upload_cfg_id not in uploaded]
+    image_bytes = None
+    if pending:
+        image_bytes = await get_image_data(self.backend.blob_store, image_id)
+        if image_bytes is None:
+            raise ImageNotFound(image_id)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get_image_bytes():
+        return image_bytes
+
+    async def upload_to(upload_cfg_id):
+        async with semaphore:
+            rv = await find_reusable_result(
+                db_manager, image_id, upload_cfg_id)
+            if rv is None:
+                upload_cfg = await get_upload_cfg(
+                    db_manager, redis_client, upload_cfg_id)
+                rv = await upload_with_retry(
+                    self.backend, upload_cfg, get_image_bytes)
+        return result_row(image_id, upload_cfg_id, rv)
+
+    results = await asyncio.gather(
+        *[upload_to(upload_cfg_id) for upload_cfg_id in pending],
+        return_exceptions=True)
+
+    report = {
+        str(upload_cfg_id): {'status': 'SUCCESS'}
+        for upload_cfg_id in upload_cfg_ids if upload_cfg_id in uploaded
+    }
+    rows = []
+    for upload_cfg_id, result in zip(pending, results):
+        if isinstance(result, Exception):
+            logger.warning('upload image(id=%r) to upload_cfg(id=%r) fails: '
+                           '%r', image_id, upload_cfg_id, result)
+            metrics.incr('jobs.upload_img_to_many.failure')
+            report[str(upload_cfg_id)] = {
+                'status': 'FAILURE',
+                'error': repr(result),
+            }
+            continue
+        metrics.incr('jobs.upload_img_to_many.success')
+        report[str(upload_cfg_id)] = {'status': 'SUCCESS'}
+        rows.append(result)
+
+    if rows:
+        await db_manager.execute(ImageWithUploadCfg.upsert_many(rows))
+        for row in rows:
+            await image_counter.incr(
+                redis_client, user_id, row['upload_cfg'])
+
+    return report
@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import uuid
+import weakref
+
+from aiohttp import web
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover, python < 3.7
+    contextvars = None
+
+
+__all__ = ('BatchingQueueListener', 'BatchStreamHandler',
+           'BatchTimedRotatingFileHandler', 'BoundedQueueHandler',
+           'ContextFilter', 'JsonFormatter', 'TaskContextVar', 'log_context',
+           'request_id_middleware', 'with_job_context')
+
+_MISSING = object()
+
+
+class TaskContextVar:
+    """
+    Substitute of `contextvars.ContextVar` for python < 3.7.
+
+    The value is bound to the running task instead of the context,
+    so the tasks created inside don't inherit it, and it is the default
+    outside of any task, e.g. in the executor's threads.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self._values = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _current_task():
+        current_task = getattr(asyncio, 'current_task', None) or \
+            asyncio.Task.current_task
+        try:
+            return current_task()
+        except RuntimeError:
+            # no event loop in this thread
+            return None
+
+    def get(self):
+        task = self._current_task()
+        if task is None:
+            return self.default
+        return self._values.get(task, self.default)
+
+    def set(self, value):
+        task = self._current_task()
+        if task is None:
+            return None
+        token = (task, self._values.get(task, _MISSING))
+        self._values[task] = value
+        return token
+
+    def reset(self, token):
+        if token is None:
+            return
+        task, value = token
+        if value is _MISSING:
+            self._values.pop(task, None)
+        else:
+            self._values[task] = value
+
+
+# ids bound to the records, e.g. request_id and job_id
+if contextvars is not None:
+    _log_context = contextvars.ContextVar('log_context', default={})
+else:  # pragma: no cover
+    _log_context = TaskContextVar(default={})
+
+CONTEXT_KEYS = ('request_id', 'job_id')
+
+
+@contextlib.contextmanager
+def log_context(**ids):
+    """
+    bind the ids to the records logged in the block, only within
+    the running task on python < 3.7, see `TaskContextVar`.
+    """
+    token = _log_context.set({**_log_context.get(), **ids})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Attach the bound ids to the records.
+
+    Add it to the handler of the logging threads, such as the
+    `BoundedQueueHandler`, the context is gone in the listener's thread.
+    """
+
+    def filter(self, record):
+        context = _log_context.get()
+        for key in CONTEXT_KEYS:
+            setattr(record, key, context.get(key))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    format the records into one JSON object per line.
+    """
+
+    def __init__(self, datefmt='%Y-%m-%dT%H:%M:%S%z'):
+        super().__init__(datefmt=datefmt)
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'name': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for key in CONTEXT_KEYS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Put the records into a bounded queue without doing any I/O.
+
+    Parameters
+    ----------
+    queue : queue.Queue
+        the bounded queue shared with the listener.
+    policy : str
+        'drop' drops the record when the queue is full,
+        'block' waits up to `block_timeout` seconds for a free slot first.
+    block_timeout : float
+        seconds to wait with the 'block' policy.
+
+    """
+
+    def __init__(self, queue, policy='drop', block_timeout=0.1):
+        assert policy in ('drop', 'block'), f'unknown policy {policy!r}'
+        super().__init__(queue)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'maxsize': self.queue.maxsize,
+            'dropped': self.dropped,
+        }
+
+
+class BatchFlushMixin:
+    """
+    defer flushing the stream until the end of a batch.
+    """
+    batching = False
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+
+class BatchStreamHandler(BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class BatchTimedRotatingFileHandler(BatchFlushMixin,
+                                    logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    Write the queued records in batches in the listener's thread.
+
+    The records already queued are taken together, up to `batch_size`,
+    and the streams are flushed once per batch instead of once per record.
+    """
+
+    def __init__(self, queue, *handlers, batch_size=256):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        q = self.queue
+        has_task_done = hasattr(q, 'task_done')
+        stop = False
+        while not stop:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._sentinel in batch
+            records = [
+                record for record in batch if record is not self._sentinel]
+            if records:
+                self.handle_batch(records)
+            if has_task_done:
+                for _ in batch:
+                    q.task_done()
+
+    def handle_batch(self, records):
+        for handler in self.handlers:
+            batching = isinstance(handler, BatchFlushMixin)
+            if batching:
+                handler.batching = True
+            try:
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                if batching:
+                    handler.batching = False
+                    handler.flush()
+
+    def stop(self):
+        """
+        write the queued records and stop, it can be called again.
+        """
+        if self._thread is not None:
+            super().stop()
+
+
+@web.middleware
+async def request_id_middleware(request, handler):
+    """
+    bind the `X-Request-ID` header, or a new id, to the request's records.
+    """
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    with log_context(request_id=request_id):
+        response = await handler(request)
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+
+def with_job_context(fn):
+    """
+    bind the task's id to the records logged by the job.
+    """
+    @functools.wraps(fn)
+    async def wrapped(self, *args, **kwargs):
+        task = getattr(self, 'task', None)
+        with log_context(job_id=getattr(task, 'id', None)):
+            return await fn(self, *args, **kwargs)
+
+    return wrapped
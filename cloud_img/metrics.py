@@ -0,0 +1,138 @@
+import collections
+import contextlib
+import math
+import time
+
+
+__all__ = ('Metrics', 'Timing', 'metrics')
+
+
+class Timing:
+    """
+    Latency statistics of one metric.
+
+    Attributes
+    ----------
+    count : int
+        count of the observations.
+    total : float
+        sum of the observed seconds.
+    min : float
+        the fastest observation.
+    max : float
+        the slowest observation.
+    buckets : list
+        cumulative histogram counts, one per upper bound in `BUCKETS`.
+
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, math.inf)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * len(self.BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+    def toJSON(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'avg': self.total / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'buckets': {
+                str(bound): count
+                for bound, count in zip(self.BUCKETS, self.buckets)
+            },
+        }
+
+
+class Metrics:
+    """
+    In-process registry of counters, timings and collectors.
+
+    Usages
+    ------
+
+        >>> from cloud_img.metrics import metrics
+        >>> metrics.incr('jobs.upload_img.success')
+        >>> with metrics.timer('jobs.upload_img'):
+        ...     pass
+        >>> metrics.register('regex_cache', regex_cache.stats)
+        >>> metrics.snapshot()
+
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.timings = collections.defaultdict(Timing)
+        self.collectors = {}
+
+    def incr(self, name, value=1):
+        """
+        increase the counter `name` by `value`.
+        """
+        self.counters[name] += value
+
+    def observe(self, name, seconds):
+        """
+        record an observed latency of `name`.
+        """
+        self.timings[name].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        record the latency of the wrapped block as `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def register(self, name, collector):
+        """
+        register a callable which returns the stats of a component,
+        it is called when taking the snapshot.
+        """
+        self.collectors[name] = collector
+
+    def snapshot(self):
+        """
+        Take a snapshot of all the metrics.
+
+        Returns
+        -------
+        dict
+            contains counters, timings and the collected stats.
+
+        """
+        return {
+            'counters': dict(self.counters),
+            'timings': {
+                name: timing.toJSON()
+                for name, timing in self.timings.items()
+            },
+            'collectors': {
+                name: collector()
+                for name, collector in self.collectors.items()
+            },
+        }
+
+    def reset(self):
+        self.counters.clear()
+        self.timings.clear()
+
+
+metrics = Metrics()
@@ -1,11 +1,14 @@
+import asyncio
 import logging
 
 import aiomysql
 import peewee
 import peewee_async
+from playhouse.migrate import MySQLMigrator, migrate
 
 from ..utils import get_config
 from ..constants import MODE
+from ..metrics import metrics
 
 db_proxy = peewee.Proxy()
 
@@ -18,6 +21,8 @@ __all__ = (
     'create_db',
     'create_db_manager',
     'db_proxy',
+    'gather_queries',
+    'migrate_db',
     Image,
     ImageWithUploadCfg,
     UploadCfg,
@@ -62,6 +67,7 @@ def create_db(mode, conf):
     logger.info('creating tables: %r', tables)
     # safe=True, means fail silently
     database.create_tables(tables, safe=True)
+    migrate_db(database, tables)
 
     # forbid using sync method
     logger.info('forbid using sync method')
@@ -70,6 +76,38 @@ def create_db(mode, conf):
     return db_proxy
 
 
+def migrate_db(database, tables):
+    """
+    Add the nullable columns and create the indexes in `Meta.indexes`
+    missing from the existing tables.
+
+    `create_tables(safe=True)` skips the existing tables along with their
+    indexes, so the fields and indexes added to the models afterwards
+    are created here, with the sync methods still allowed.
+    """
+    migrator = MySQLMigrator(database)
+    for model in tables:
+        table = model._meta.db_table
+        columns = {column.name for column in database.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.db_column in columns or not field.null:
+                continue
+            logger.info('adding column %r to table %r',
+                        field.db_column, table)
+            migrate(migrator.add_column(table, field.db_column, field))
+
+        existing = {tuple(index.columns)
+                    for index in database.get_indexes(table)}
+        for fields, unique in model._meta.indexes:
+            index_columns = tuple(model._meta.fields[name].db_column
+                                  for name in fields)
+            if index_columns in existing:
+                continue
+            logger.info('creating index %r on table %r',
+                        index_columns, table)
+            database.create_index(model, list(fields), unique)
+
+
 def create_db_manager(database):
     """
     create a db_manager to manage the database connections.
@@ -80,6 +118,57 @@ def create_db_manager(database):
     return manager
 
 
+async def gather_queries(prefix, **queries):
+    """
+    Run independent queries concurrently.
+
+    Each query runs on its own connection of the pool, so the latency is
+    close to the slowest query instead of the sum of them.
+
+    Parameters
+    ----------
+    prefix : str
+        the latency of each query is recorded into metrics as
+        `{prefix}.{name}`.
+    queries :
+        awaitable queries by name.
+
+    Returns
+    -------
+    dict
+        result of each query by name.
+
+    Raises
+    ------
+    Exception
+        the first exception raised, the other queries are cancelled.
+
+    Usages
+    ------
+
+        >>> rv = await gather_queries(
+        ...     'routes.image',
+        ...     total=Image.count(user_id=1, db_manager=db_manager),
+        ...     images=Image.paginate(user_id=1, db_manager=db_manager))
+        >>> rv['total'], rv['images']
+
+    """
+    async def timed(name, query):
+        with metrics.timer(f'{prefix}.{name}'):
+            return await query
+
+    names = list(queries)
+    futures = [asyncio.ensure_future(timed(name, queries[name]))
+               for name in names]
+    try:
+        results = await asyncio.gather(*futures)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return dict(zip(names, results))
+
+
 async def asetup(app):
     """
     asynchronously setup database.
@@ -13,6 +13,8 @@ class Image(peewee.Model):
     created_at = peewee.DateTimeField(default=datetime.utcnow)
     seen_at = peewee.DateTimeField(default=datetime.utcnow)
     description = peewee.CharField(max_length=255, default='')
+    # BLAKE2b hex digest of the image data, see `blobs.content_hash`
+    content_hash = peewee.CharField(max_length=64, null=True)
 
     user = peewee.ForeignKeyField(User, related_name='images')
 
@@ -20,6 +22,12 @@ class Image(peewee.Model):
         from . import db_proxy
         database = db_proxy
         db_table = 'image'
+        indexes = (
+            # serves the keyset pagination of user's images
+            (('user', 'id'), False),
+            # maps the content to the existing images
+            (('user', 'content_hash'), False),
+        )
 
     def toJSON(self):
         return {
@@ -46,8 +54,13 @@ class Image(peewee.Model):
                        upload_cfg_id=None,
                        page_no=1,
                        page_size=15,
+                       last_id=None,
                        *,
                        db_manager):
+        """
+        paginate images in descending id order, after `last_id` if it is
+        given (keyset pagination), otherwise by `page_no` (offset).
+        """
         from .upload_cfg import ImageWithUploadCfg
         sql = cls.select()
         if user_id is not None:
@@ -55,11 +68,43 @@ class Image(peewee.Model):
         if upload_cfg_id is not None:
             sql = sql.join(ImageWithUploadCfg).where(
                 ImageWithUploadCfg.upload_cfg_id == upload_cfg_id)
-        sql = sql \
-            .order_by(cls.id.desc()) \
-            .paginate(page_no, page_size)
+        sql = sql.order_by(cls.id.desc())
+        if last_id is not None:
+            sql = sql.where(cls.id < last_id).limit(page_size)
+        else:
+            sql = sql.paginate(page_no, page_size)
         return await db_manager.execute(sql)
 
+    @classmethod
+    async def ingest(cls, user_id, data, *, blob_store, db_manager):
+        """
+        Store the image data of the user, deduplicated by its content.
+
+        Returns
+        -------
+        (Image, bool)
+            the image and whether it is created, the existing image
+            of the user with the same content is returned as is.
+
+        """
+        from ..blobs import content_hash
+        digest = content_hash(data)
+        sql = cls.select() \
+            .where(cls.user_id == user_id, cls.content_hash == digest) \
+            .order_by(cls.id) \
+            .limit(1)
+        for image in await db_manager.execute(sql):
+            return image, False
+
+        image = await db_manager.create(
+            cls, user=user_id, content_hash=digest)
+        try:
+            await blob_store.put(image.id, data, digest=digest)
+        except Exception:
+            await db_manager.delete(image)
+            raise
+        return image, True
+
     @classmethod
     async def get_upload_cfgs(cls, image_id, *, db_manager):
         from .upload_cfg import ImageWithUploadCfg
@@ -67,3 +112,32 @@ class Image(peewee.Model):
             .select() \
             .where(ImageWithUploadCfg.image_id == image_id)
         return await db_manager.execute(sql)
+
+    @classmethod
+    async def get_upload_cfgs_in_batch(cls, image_ids, *, db_manager):
+        """
+        Get the upload configs of many images in one query.
+
+        Parameters
+        ----------
+        image_ids : list
+            images' ids
+
+        Returns
+        -------
+        dict
+            list of the ImageWithUploadCfg by image's id,
+            every one of `image_ids` is included.
+
+        """
+        from .upload_cfg import ImageWithUploadCfg
+        rv = {image_id: [] for image_id in image_ids}
+        if not rv:
+            return rv
+        sql = ImageWithUploadCfg \
+            .select() \
+            .where(ImageWithUploadCfg.image_id << list(rv)) \
+            .order_by(ImageWithUploadCfg.id)
+        for image_with_upload_cfg in await db_manager.execute(sql):
+            rv[image_with_upload_cfg.image_id].append(image_with_upload_cfg)
+        return rv
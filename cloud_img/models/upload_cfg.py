@@ -1,8 +1,14 @@
 import abc
+import asyncio
+import codecs
+import collections
+import collections.abc
 import json
 import logging
 import re
 import reprlib
+import urllib.parse
+import uuid
 from datetime import datetime
 
 import aiohttp
@@ -10,10 +16,14 @@ import lxml.etree
 import peewee
 import yarl
 
-from ..utils import datetime2unix, query_json, query_regex, query_xml
+from ..breakers import CircuitBreaker
+from ..utils import (compile_xml_path, datetime2unix, query_json, query_regex,
+                     query_regex_async, query_xml, search_regex_async)
 
 
-__all__ = ('UploadCfg', 'ImageWithUploadCfg', 'Adapter', 'Client')
+__all__ = ('UploadCfg', 'UploadPlan', 'MultipartForm', 'StreamingQuery',
+           'ImageWithUploadCfg', 'UpsertQuery', 'Adapter', 'Client',
+           'LocalRequestError')
 
 logger = logging.getLogger(__name__)
 
@@ -65,21 +75,689 @@ class Adapter(abc.ABC):
 
         """
 
+    async def send_stream(self, method, url, headers=None, data=None):
+        """
+        send the request to server,
+        then yield the decoded response body chunk by chunk.
+
+        The consumer may stop iterating at any time,
+        the rest of the response is not read then.
+        Adapters which are not able to stream
+        yield the whole response body from `send` at once.
+
+        Parameters are the same as `send`.
+
+        """
+        yield await self.send(
+            method=method, url=url, headers=headers, data=data)
+
+
+class LocalRequestError(Exception):
+    """
+    raised when a request fails for a local reason, e.g. producing
+    its body or an invalid url, it is not a failure of the host.
+    """
+
 
 class Client(Adapter):
-    def __init__(self):
-        self.session = aiohttp.ClientSession()
+    """
+    aiohttp adapter with a tuned connection pool.
+
+    Every host gets its own concurrency budget,
+    so that one slow image host cannot take all the connections
+    and starve the uploads to the others.
+
+    Parameters
+    ----------
+    limit : int
+        total count of simultaneous connections, 0 means no limit.
+    limit_per_host : int
+        count of simultaneous connections to one host, 0 means no limit.
+    ttl_dns_cache : int
+        seconds to cache the resolved DNS records, None means forever.
+    keepalive_timeout : float
+        seconds to keep an idle connection alive for reusing.
+    host_concurrency : int
+        count of concurrent requests to one host, None means no limit.
+    hosts : Mapping
+        host_concurrency overrides by host.
+    breaker : Mapping
+        options of the `CircuitBreaker` of every host, None disables them.
+        The connection errors, timeouts and 5xx responses are the failures,
+        the local errors are raised as `LocalRequestError` instead.
+
+    """
+    CHUNK_SIZE = 16 * 1024
+    # the errors counted as failures of the host
+    HOST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+    def __init__(self,
+                 limit=100,
+                 limit_per_host=0,
+                 ttl_dns_cache=10,
+                 keepalive_timeout=15,
+                 host_concurrency=None,
+                 hosts=None,
+                 breaker=None):
+        self.host_concurrency = host_concurrency
+        self.hosts = dict(hosts or {})
+        self.breaker = None if breaker is None else dict(breaker)
+        self._semaphores = {}
+        self._breakers = {}
+        self._in_flight = collections.Counter()
+        self._stats = collections.Counter()
+
+        trace_config = aiohttp.TraceConfig()
+        for signal, name in (
+            (trace_config.on_request_end, 'requests'),
+            (trace_config.on_request_exception, 'request_exceptions'),
+            (trace_config.on_connection_create_end, 'connections_created'),
+            (trace_config.on_connection_reuseconn, 'connections_reused'),
+            (trace_config.on_connection_queued_start, 'connections_queued'),
+            (trace_config.on_dns_cache_hit, 'dns_cache_hits'),
+            (trace_config.on_dns_cache_miss, 'dns_cache_misses'),
+        ):
+            signal.append(self._make_counter(name))
+
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=ttl_dns_cache,
+            keepalive_timeout=keepalive_timeout)
+        self.session = aiohttp.ClientSession(
+            connector=connector, trace_configs=[trace_config])
+
+    def _make_counter(self, name):
+        async def on_signal(session, trace_config_ctx, params):
+            self._stats[name] += 1
+
+        return on_signal
+
+    async def _acquire(self, url):
+        """
+        Wait for a free slot in the concurrency budget of the url's host.
+
+        Raises
+        ------
+        CircuitOpen
+            the host keeps failing, fail fast without taking a slot.
+
+        """
+        host = yarl.URL(url).host
+        breaker = self._get_breaker(host)
+        if breaker is not None:
+            breaker.before_call()
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            concurrency = self.hosts.get(host, self.host_concurrency)
+            if concurrency is not None:
+                semaphore = asyncio.Semaphore(concurrency)
+                self._semaphores[host] = semaphore
+        if semaphore is not None:
+            await semaphore.acquire()
+        self._in_flight[host] += 1
+        return host
+
+    def _get_breaker(self, host):
+        if self.breaker is None:
+            return None
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host, **self.breaker)
+            self._breakers[host] = breaker
+        return breaker
+
+    def _record(self, host, ok):
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            return
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    def _check_status(self, host, resp):
+        """
+        record the response, raise aiohttp.ClientResponseError if it is 5xx.
+        """
+        self._record(host, resp.status < 500)
+        if resp.status >= 500:
+            resp.raise_for_status()
+
+    def _release(self, host):
+        self._in_flight[host] -= 1
+        semaphore = self._semaphores.get(host)
+        if semaphore is not None:
+            semaphore.release()
+
+    def _prepare(self, headers, data):
+        """
+        Returns
+        -------
+        (headers, data, body_errors)
+            `body_errors` collects the errors of producing the body.
+
+        """
+        if isinstance(data, MultipartForm):
+            headers = dict(headers or {})
+            headers['Content-Type'] = data.content_type
+            if data.size is not None:
+                headers['Content-Length'] = str(data.size)
+            data = data.chunks()
+        body_errors = []
+        if hasattr(data, '__aiter__'):
+            data = self._watch_body(data, body_errors)
+        return headers, data, body_errors
+
+    @staticmethod
+    async def _watch_body(chunks, body_errors):
+        # aiohttp reports the errors of the body as connection errors
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception as exc:
+            body_errors.append(exc)
+            raise
+
+    def _failed(self, host, exc, body_errors):
+        """
+        record the failure of the host, or convert a local error into
+        `LocalRequestError` which is returned to raise.
+        """
+        if body_errors:
+            return LocalRequestError(
+                f'producing the request body fails: {body_errors[0]!r}')
+        if isinstance(exc, aiohttp.InvalidURL):
+            return LocalRequestError(f'invalid url: {exc}')
+        # the 5xx responses are recorded by `_check_status`
+        if not isinstance(exc, aiohttp.ClientResponseError):
+            self._record(host, False)
+        return None
 
     async def send(self, method, url, headers=None, data=None):
-        async with self.session.request(
-                method, url, headers=headers, data=data) as resp:
-            response_body = await resp.text()
+        headers, data, body_errors = self._prepare(headers, data)
+        host = await self._acquire(url)
+        try:
+            async with self.session.request(
+                    method, url, headers=headers, data=data) as resp:
+                self._check_status(host, resp)
+                response_body = await resp.text()
+        except self.HOST_ERRORS as exc:
+            local_error = self._failed(host, exc, body_errors)
+            if local_error is not None:
+                raise local_error from exc
+            raise
+        finally:
+            self._release(host)
         return response_body
 
+    async def send_stream(self, method, url, headers=None, data=None):
+        headers, data, body_errors = self._prepare(headers, data)
+        host = await self._acquire(url)
+        try:
+            async with self.session.request(
+                    method, url, headers=headers, data=data) as resp:
+                self._check_status(host, resp)
+                decoder = codecs.getincrementaldecoder(
+                    resp.charset or 'utf-8')(errors='replace')
+                async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
+                    text = decoder.decode(chunk)
+                    if text:
+                        yield text
+                text = decoder.decode(b'', final=True)
+                if text:
+                    yield text
+        except self.HOST_ERRORS as exc:
+            local_error = self._failed(host, exc, body_errors)
+            if local_error is not None:
+                raise local_error from exc
+            raise
+        finally:
+            self._release(host)
+
+    def stats(self):
+        """
+        connection reuse statistics and the requests in flight by host.
+        """
+        stats = dict(self._stats)
+        created = stats.get('connections_created', 0)
+        reused = stats.get('connections_reused', 0)
+        stats['reuse_ratio'] = reused / (created + reused) \
+            if created + reused else 0.0
+        stats['hosts'] = {
+            host: {
+                'concurrency': self.hosts.get(host, self.host_concurrency),
+                'in_flight': in_flight,
+            }
+            for host, in_flight in self._in_flight.items()
+        }
+        for host, breaker in self._breakers.items():
+            stats['hosts'].setdefault(host, {})['breaker'] = breaker.stats()
+        return stats
+
     async def close(self):
         await self.session.close()
 
 
+class UploadPlan:
+    """
+    Compiled request template of an UploadCfg.
+
+    All the `$key$` substitutions are resolved from `values` and
+    the url is built with its query string,
+    only the `$input$` image data slots are left to fill per upload.
+
+    Attributes
+    ----------
+    method : str
+        request method.
+    url : yarl.URL
+        upload url with the query string.
+    headers : dict
+        request headers, should not be mutated.
+    image_fields : tuple
+        names of the formdata fields which hold the image data.
+    boundary : str
+        multipart boundary if there are image fields.
+    segments : tuple
+        the multipart body, the image field names stand for the slots
+        of the image data, the others are the encoded bytes in between.
+
+    """
+
+    def __init__(self, method, url, headers, formdata, image_fields):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.image_fields = image_fields
+        self._formdata = formdata
+        self.boundary = None
+        self.segments = ()
+        if image_fields:
+            self.boundary = uuid.uuid4().hex
+            self.segments = self._build_segments()
+
+    def _build_segments(self):
+        # the same layout as aiohttp.FormData's multipart body
+        segments = []
+        static = bytearray()
+        for name, value in self._formdata.items():
+            quoted_name = urllib.parse.quote(name, '')
+            static += f'--{self.boundary}\r\n'.encode('utf-8')
+            if name in self.image_fields:
+                static += (
+                    'Content-Type: application/octet-stream\r\n'
+                    'Content-Disposition: form-data; '
+                    f'name="{quoted_name}"; filename="{quoted_name}"\r\n'
+                    '\r\n').encode('utf-8')
+                segments.append(bytes(static))
+                segments.append(name)
+                static = bytearray(b'\r\n')
+                continue
+            static += (
+                'Content-Type: text/plain; charset=utf-8\r\n'
+                f'Content-Disposition: form-data; name="{quoted_name}"\r\n'
+                '\r\n').encode('utf-8')
+            static += str(value).encode('utf-8') + b'\r\n'
+        static += f'--{self.boundary}--\r\n'.encode('utf-8')
+        segments.append(bytes(static))
+        return tuple(segments)
+
+    @classmethod
+    def compile(cls, upload_cfg):
+        """
+        Compile the request template of the `upload_cfg`.
+
+        Parameters
+        ----------
+        upload_cfg : UploadCfg
+            upload config to compile.
+
+        Returns
+        -------
+        UploadPlan
+            compiled upload plan.
+
+        """
+        pattern = upload_cfg.VALUE_PATTERN
+        image_key = upload_cfg.IMAGE_KEY
+        values = upload_cfg.values
+
+        def make_repl(assert_msg):
+            def repl(match):
+                key = match.groupdict().get('key')
+                assert key != image_key, assert_msg
+                rv = values.get(key)
+                return str(rv) if rv is not None else match.group()
+
+            return repl
+
+        querystring = {}
+        repl = make_repl('cannot set image data into url query string')
+        for name, template in upload_cfg.request_querystring.items():
+            querystring[name], _ = pattern.subn(repl, template)
+
+        headers = {}
+        repl = make_repl('cannot set image data into request headers')
+        for name, template in upload_cfg.request_headers.items():
+            headers[name], _ = pattern.subn(repl, template)
+
+        formdata = {}
+        image_fields = []
+        repl = make_repl('cannot concat image bytes with str')
+        for name, template in upload_cfg.request_formdata.items():
+            match = pattern.match(template)
+            if match and match.groupdict().get('key') == image_key:
+                formdata[name] = None
+                image_fields.append(name)
+                continue
+            formdata[name], _ = pattern.subn(repl, template)
+
+        url = yarl.URL(upload_cfg.request_url)
+        if querystring:
+            url = url.with_query(querystring)
+
+        return cls(
+            method=upload_cfg.request_method,
+            url=url,
+            headers=headers,
+            formdata=formdata,
+            image_fields=tuple(image_fields))
+
+    def formdata(self, data):
+        """
+        Fill the image data into a new formdata.
+
+        Parameters
+        ----------
+        data : bytes, file-like or async iterable
+            image binary data.
+
+        Returns
+        -------
+        dict or MultipartForm
+            request formdata,
+            a MultipartForm if there are image fields.
+
+        """
+        if self.image_fields:
+            return MultipartForm(self, data)
+        return self._formdata.copy()
+
+
+class MultipartForm(collections.abc.Mapping):
+    """
+    multipart/form-data request body which doesn't copy the image data.
+
+    The body is the precomputed segments of the UploadPlan
+    with the image data sent in between as memoryview slices,
+    or read chunk by chunk from a file-like or async iterable source.
+    A file-like source is read in the default executor,
+    so that a blocking read doesn't stall the event loop.
+    As a mapping it looks like the formdata it stands for.
+
+    Parameters
+    ----------
+    plan : UploadPlan
+        compiled upload plan with image fields.
+    data : bytes, file-like or async iterable
+        image binary data.
+
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, plan, data):
+        self.plan = plan
+        self.data = data
+        if not isinstance(data, (bytes, bytearray, memoryview)) and \
+                len(plan.image_fields) > 1:
+            raise ValueError(
+                'an image data stream can only fill one formdata field.')
+
+    def __getitem__(self, name):
+        if name in self.plan.image_fields:
+            return self.data
+        return self.plan._formdata[name]
+
+    def __iter__(self):
+        return iter(self.plan._formdata)
+
+    def __len__(self):
+        return len(self.plan._formdata)
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.plan.boundary}'
+
+    @property
+    def size(self):
+        """
+        length of the body, None if the image data is a stream.
+        """
+        if not isinstance(self.data, (bytes, bytearray, memoryview)):
+            return None
+        size = len(memoryview(self.data).cast('B'))
+        return sum(size if isinstance(segment, str) else len(segment)
+                   for segment in self.plan.segments)
+
+    async def chunks(self):
+        """
+        yield the body chunk by chunk.
+        """
+        for segment in self.plan.segments:
+            if not isinstance(segment, str):
+                yield segment
+                continue
+            async for chunk in self._iter_data():
+                yield chunk
+
+    async def _iter_data(self):
+        data = self.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            view = memoryview(data).cast('B')
+            for start in range(0, len(view), self.CHUNK_SIZE):
+                yield view[start:start + self.CHUNK_SIZE]
+        elif hasattr(data, 'read'):
+            loop = asyncio.get_event_loop()
+            while True:
+                chunk = await loop.run_in_executor(
+                    None, data.read, self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            async for chunk in data:
+                yield chunk
+
+
+class StreamingQuery:
+    """
+    Query the image's info from a response body fed chunk by chunk.
+
+    + regex querystrs search a bounded sliding window of the body
+      when closing, a match of a greedy pattern could still grow with
+      more incoming text, so it is not accepted earlier. Once the text
+      reaches twice the window, it is searched before its head is
+      dropped, so the searching costs linear time of the body.
+      The results are the same as `UploadCfg.query_response` for
+      the bodies within the window, the larger bodies are answered
+      from their first matching window.
+    + xml querystrs are resolved by `lxml.etree.XMLPullParser`
+      as soon as the target element ends.
+    + json querystrs need the whole body, the chunks are buffered.
+
+    `done` turns True once all the querystrs are resolved,
+    the rest of the response doesn't need to be read then.
+    The failed querystrs raise the same errors
+    as `UploadCfg.query_response` when closing.
+
+    Parameters
+    ----------
+    upload_cfg : UploadCfg
+        upload config which owns the querystrs.
+    window : int
+        count of characters kept for the regex querystrs,
+        up to twice of it while receiving.
+
+    """
+
+    def __init__(self, upload_cfg, window=64 * 1024):
+        self.upload_cfg = upload_cfg
+        self.window = window
+        self.queries = upload_cfg.response_queries
+        self.results = {}
+        self.pending = {
+            url_type: (content_type, querystr)
+            for url_type, content_type, querystr, _, _ in self.queries
+            if content_type is not None
+        }
+        content_types = {ct for ct, _ in self.pending.values()}
+
+        self._head = ''
+        self._json_chunks = [] if 'json' in content_types else None
+        self._text = '' if 'regex' in content_types else None
+        # url_type -> ValueError raised when closing
+        self._errors = {}
+        self._xml_parser = None
+        self._xml_error = None
+        if 'xml' in content_types:
+            self._xml_parser = lxml.etree.XMLPullParser(events=('start',
+                                                                'end'))
+            # stack of (tag, index, counter of the children's tags)
+            self._xml_stack = []
+            self._xml_steps = {
+                url_type: compile_xml_path(querystr).steps
+                for url_type, (content_type, querystr) in self.pending.items()
+                if content_type == 'xml'
+            }
+
+    @property
+    def done(self):
+        return not self.pending
+
+    async def feed(self, chunk):
+        """
+        feed a chunk of the decoded response body.
+        """
+        if len(self._head) < 64:
+            self._head += chunk[:64]
+        if self._json_chunks is not None:
+            self._json_chunks.append(chunk)
+        if self._xml_parser is not None and self._xml_error is None:
+            self._feed_xml(chunk)
+        if self._text is not None:
+            await self._feed_regex(chunk)
+
+    def _resolve(self, url_type, query_rv):
+        self.results[url_type] = query_rv
+        del self.pending[url_type]
+
+    async def _feed_regex(self, chunk):
+        self._text += chunk
+        if len(self._text) > 2 * self.window:
+            await self._search_regex()
+            self._text = self._text[-self.window:]
+
+    async def _search_regex(self):
+        text = self._text
+        for url_type, (content_type, querystr) in list(self.pending.items()):
+            if content_type != 'regex':
+                continue
+            try:
+                match = await search_regex_async(text, querystr)
+            except ValueError as err:
+                # raise it when closing
+                self._errors[url_type] = err
+                del self.pending[url_type]
+                continue
+            if match is not None:
+                self._resolve(url_type, match[0])
+
+    def _feed_xml(self, chunk):
+        try:
+            self._xml_parser.feed(chunk)
+            events = list(self._xml_parser.read_events())
+        except lxml.etree.XMLSyntaxError as err:
+            self._xml_error = err
+            return
+
+        stack = self._xml_stack
+        for event, element in events:
+            if event == 'start':
+                if stack:
+                    counter = stack[-1][2]
+                    counter[element.tag] = counter.get(element.tag, 0) + 1
+                    index = counter[element.tag]
+                else:
+                    index = 1
+                stack.append((element.tag, index, {}))
+                continue
+
+            for url_type, steps in list(self._xml_steps.items()):
+                if url_type in self.pending and \
+                        self._match_xml(steps) and len(element) == 0:
+                    self._resolve(url_type, element.text)
+            stack.pop()
+
+    def _match_xml(self, steps):
+        stack = self._xml_stack
+        if len(steps) != len(stack):
+            return False
+        (root_key, root_index), *steps = steps
+        if root_index is not None or stack[0][0] != root_key:
+            return False
+        for (key, index), (tag, element_index, _) in zip(steps, stack[1:]):
+            if key != tag or (1 if index is None else index) != element_index:
+                return False
+        return True
+
+    async def close(self):
+        """
+        Resolve the rest querystrs with the end of the response body.
+
+        Returns
+        -------
+        dict
+            contains image's url, thumbnail_url, delete_url.
+
+        """
+        upload_cfg = self.upload_cfg
+        error_msg = ('response_body {}'.format(reprlib.repr(self._head)) +
+                     ' is not able to decode as ')
+        documents = {}
+
+        if self._errors:
+            raise next(iter(self._errors.values()))
+
+        for url_type, (content_type, querystr) in list(self.pending.items()):
+            if content_type == 'json':
+                if 'json' not in documents:
+                    documents['json'] = upload_cfg._load_response(
+                        ''.join(self._json_chunks), 'json')
+                query_rv = query_json(documents['json'], querystr)
+            elif content_type == 'xml':
+                if 'xml' not in documents:
+                    try:
+                        if self._xml_error is not None:
+                            raise self._xml_error
+                        documents['xml'] = self._xml_parser.close()
+                    except lxml.etree.XMLSyntaxError:
+                        raise ValueError(error_msg + 'xml data.')
+                query_rv = query_xml(documents['xml'], querystr)
+            else:
+                query_rv = await query_regex_async(self._text, querystr)
+            self._resolve(url_type, query_rv)
+
+        rv = {}
+        for url_type, content_type, _, prefix, suffix in self.queries:
+            if content_type is None:
+                rv[url_type] = ''
+                continue
+            rv[url_type] = f'{prefix}{self.results[url_type]}{suffix}'
+        return rv
+
+
 class UploadCfg(peewee.Model):
     """
     Upload config for different websites.
@@ -149,8 +827,59 @@ class UploadCfg(peewee.Model):
         from . import db_proxy
         database = db_proxy
         db_table = 'upload_cfg'
+        # serves the keyset pagination of user's upload configs
+        indexes = ((('user', 'id'), False), )
+
+    # fields that the compiled upload plan depends on
+    PLAN_FIELDS = frozenset((
+        'request_url',
+        'request_method',
+        'values',
+        'request_querystring',
+        'request_headers',
+        'request_formdata',
+    ))
+
+    # fields that the compiled response queries depend on
+    QUERYSTR_FIELDS = frozenset((
+        'image_url_querystr',
+        'thumbnail_url_querystr',
+        'delete_url_querystr',
+    ))
+    CONTENT_TYPES = frozenset(('json', 'xml', 'regex'))
+
+    def __setattr__(self, name, value):
+        # assigning a field the plan depends on starts a new revision
+        if name in self.PLAN_FIELDS:
+            self.__dict__.pop('_upload_plan', None)
+        elif name in self.QUERYSTR_FIELDS:
+            self.__dict__.pop('_response_queries', None)
+        super().__setattr__(name, value)
+
+    @property
+    def plan(self):
+        """
+        The compiled upload plan of the current revision.
+
+        It is built on first access and reused until one of the
+        `PLAN_FIELDS` is assigned again.
+        Mutating `values` or the request_* mappings in place
+        requires calling `invalidate_plan` explicitly.
+        """
+        plan = self.__dict__.get('_upload_plan')
+        if plan is None:
+            plan = UploadPlan.compile(self)
+            self.__dict__['_upload_plan'] = plan
+        return plan
+
+    def invalidate_plan(self):
+        """
+        Drop the compiled upload plan.
+        """
+        self.__dict__.pop('_upload_plan', None)
 
-    async def upload(self, adapter, data):
+    async def upload(self, adapter, data, *, stream=False,
+                     window=64 * 1024):
         """
         Make an aysnchronous image file uploading.
 
@@ -158,89 +887,142 @@ class UploadCfg(peewee.Model):
         ----------
         adapter : Adapter
             adopting the different clients to perform the request.
-        data : bytes
+        data : bytes, file-like or async iterable
             image binary data.
+        stream : bool
+            query the response while receiving it,
+            stop receiving once all the querystrs are resolved.
+            the returned response body is None then.
+        window : int
+            count of characters kept for the regex querystrs in stream mode.
 
         """
         if not isinstance(adapter, Adapter):  # pragma: no cover
             raise ValueError(f"{adapter:!r} should be Adopter's instance.")
 
-        querystring = self.request_querystring.copy()
-        headers = self.request_headers.copy()
-        formdata = self.request_formdata.copy()
+        plan = self.plan
+        kwargs = dict(
+            method=plan.method,
+            url=plan.url,
+            headers=plan.headers,
+            data=plan.formdata(data))
 
-        def make_repl(assert_msg):
-            def repl(match):
-                key = match.groupdict().get('key')
-                assert key != self.IMAGE_KEY, assert_msg
-                rv = self.values.get(key)
-                return str(rv) if rv is not None else match.group()
+        if stream:
+            rv = await self.query_response_stream(
+                adapter.send_stream(**kwargs), window=window)
+            return rv, None
 
-            return repl
+        response_body = await adapter.send(**kwargs)
 
-        if querystring:
-            repl = make_repl('cannot set image data into url query string')
-            for name, template in querystring.items():
-                querystring[name], _ = self.VALUE_PATTERN.subn(repl, template)
-
-        if headers:
-            repl = make_repl('cannot set image data into request headers')
-            for name, template in headers.items():
-                headers[name], _ = self.VALUE_PATTERN.subn(repl, template)
-
-        if formdata:
-            repl = make_repl('cannot concat image bytes with str')
-            for name, template in formdata.items():
-                match = self.VALUE_PATTERN.match(template)
-                if match and match.groupdict().get('key') == self.IMAGE_KEY:
-                    formdata[name] = data
-                    continue
-                formdata[name], _ = self.VALUE_PATTERN.subn(repl, template)
-
-        url = yarl.URL(self.request_url)
-        if querystring:
-            url = url.with_query(querystring)
+        rv = await self.query_response_async(response_body)
 
-        response_body = await adapter.send(
-            method=self.request_method,
-            url=url,
-            headers=headers,
-            data=formdata)
+        return rv, response_body
+
+    async def query_response_stream(self, chunks, window=64 * 1024):
+        """
+        Query the image's info from the response body chunks.
 
-        rv = self.query_response(response_body)
+        Parameters
+        ----------
+        chunks : async iterable
+            decoded response body chunks.
+        window : int
+            count of characters kept for the regex querystrs.
 
-        return rv, response_body
+        Returns
+        -------
+        dict
+            contains image's url, thumbnail_url, delete_url.
+
+        """
+        query = StreamingQuery(self, window=window)
+        try:
+            async for chunk in chunks:
+                await query.feed(chunk)
+                if query.done:
+                    break
+        finally:
+            aclose = getattr(chunks, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+        return await query.close()
+
+    @property
+    def response_queries(self):
+        """
+        The compiled querystrs of the current revision.
+
+        A tuple of (url_type, content_type, querystr, prefix, suffix),
+        content_type is None if the querystr of url_type is empty.
+        """
+        queries = self.__dict__.get('_response_queries')
+        if queries is None:
+            queries = self._compile_querystrs()
+            self.__dict__['_response_queries'] = queries
+        return queries
+
+    def _compile_querystrs(self):
+        url_querystrs = dict(
+            image_url=self.image_url_querystr,
+            thumbnail_url=self.thumbnail_url_querystr,
+            delete_url=self.delete_url_querystr)
+        queries = []
+
+        for url_type, url_querystr in url_querystrs.items():
+            if not url_querystr:
+                queries.append((url_type, None, None, '', ''))
+                continue
+            match = self.QUERYSTR_PATTERN.search(url_querystr)
+            if match is None:
+                raise ValueError(
+                    f'{url_type}_querystr {url_querystr!r} is invalid.')
+
+            group = match.groupdict()
+            content_type = group.get('content_type')
+            if content_type not in self.CONTENT_TYPES:
+                raise ValueError(
+                    f'content_type {content_type!r} is not supported')
+            querystr = group.get('querystr')
+            prefix = url_querystr[:match.start()]
+            suffix = url_querystr[match.end():]
+            queries.append((url_type, content_type, querystr, prefix, suffix))
 
-    def _query_response(self, response_body, content_type, querystr):
+        return tuple(queries)
+
+    def _load_response(self, response_body, content_type):
         error_msg = ('response_body {}'.format(reprlib.repr(response_body)) +
                      ' is not able to decode as ')
         if content_type == 'json':
 
             try:
-                resource = json.loads(response_body)
-            except json.JSONDecodeError as err:
+                return json.loads(response_body)
+            except json.JSONDecodeError:
                 raise ValueError(error_msg + 'json data.')
 
-            return query_json(resource, querystr)
-
         elif content_type == 'xml':
 
             try:
-                resource = lxml.etree.fromstring(response_body)
-            except lxml.etree.XMLSyntaxError as err:
+                return lxml.etree.fromstring(response_body)
+            except lxml.etree.XMLSyntaxError:
                 raise ValueError(error_msg + 'xml data.')
 
-            return query_xml(resource, querystr)
-
-        elif content_type == 'regex':
-            return query_regex(response_body, querystr)
+        # regex queries the raw response body
+        return response_body
 
-        raise ValueError(f'content_type {content_type!r} is not supported')
+    def _query_document(self, document, content_type, querystr):
+        if content_type == 'json':
+            return query_json(document, querystr)
+        elif content_type == 'xml':
+            return query_xml(document, querystr)
+        return query_regex(document, querystr)
 
     def query_response(self, response_body):
         """
         Query the image's info from the response
 
+        The response body is decoded at most once per content type,
+        and the decoded document is shared by all the querystrs.
+
         Parameters
         ----------
         response_body : str
@@ -252,29 +1034,45 @@ class UploadCfg(peewee.Model):
             contains image's url, thumbnail_url, delete_url.
 
         """
-
-        url_querystrs = dict(
-            image_url=self.image_url_querystr,
-            thumbnail_url=self.thumbnail_url_querystr,
-            delete_url=self.delete_url_querystr)
+        documents = {}
         rv = {}
 
-        for url_type, url_querystr in url_querystrs.items():
-            if not url_querystr:
+        for (url_type, content_type, querystr, prefix,
+             suffix) in self.response_queries:
+            if content_type is None:
                 rv[url_type] = ''
                 continue
-            match = self.QUERYSTR_PATTERN.search(url_querystr)
-            if match is None:
-                raise ValueError(
-                    f'{url_type}_querystr {url_querystr!r} is invalid.')
+            if content_type not in documents:
+                documents[content_type] = self._load_response(
+                    response_body, content_type)
+            query_rv = self._query_document(documents[content_type],
+                                            content_type, querystr)
+            rv[url_type] = f'{prefix}{query_rv}{suffix}'
 
-            group = match.groupdict()
-            content_type = group.get('content_type')
-            querystr = group.get('querystr')
-            query_rv = self._query_response(response_body, content_type,
-                                            querystr)
-            prefix = url_querystr[:match.start()]
-            suffix = url_querystr[match.end():]
+        return rv
+
+    async def query_response_async(self, response_body):
+        """
+        Query the image's info from the response like `query_response`,
+        but the regex querystrs are searched by `query_regex_async`,
+        off the event loop if the regex guard is enabled.
+        """
+        documents = {}
+        rv = {}
+
+        for (url_type, content_type, querystr, prefix,
+             suffix) in self.response_queries:
+            if content_type is None:
+                rv[url_type] = ''
+                continue
+            if content_type == 'regex':
+                query_rv = await query_regex_async(response_body, querystr)
+            else:
+                if content_type not in documents:
+                    documents[content_type] = self._load_response(
+                        response_body, content_type)
+                query_rv = self._query_document(documents[content_type],
+                                                content_type, querystr)
             rv[url_type] = f'{prefix}{query_rv}{suffix}'
 
         return rv
@@ -310,17 +1108,44 @@ class UploadCfg(peewee.Model):
                        user_id=None,
                        page_no=1,
                        page_size=15,
+                       last_id=None,
                        *,
                        db_manager):
+        """
+        paginate upload configs in descending id order, after `last_id` if
+        it is given (keyset pagination), otherwise by `page_no` (offset).
+        """
         sql = cls.select()
         if user_id is not None:
             sql = sql.where(cls.user_id == user_id)
-        sql = sql \
-            .order_by(cls.id.desc()) \
-            .paginate(page_no, page_size)
+        sql = sql.order_by(cls.id.desc())
+        if last_id is not None:
+            sql = sql.where(cls.id < last_id).limit(page_size)
+        else:
+            sql = sql.paginate(page_no, page_size)
         return await db_manager.execute(sql)
 
 
+class UpsertQuery(peewee.InsertQuery):
+    """
+    MySQL's multi-row `INSERT ... ON DUPLICATE KEY UPDATE`,
+    the rows conflicting with a unique index update `update_fields`.
+    """
+
+    def __init__(self, model_class, update_fields, **kwargs):
+        super().__init__(model_class, **kwargs)
+        self.update_fields = update_fields
+
+    def sql(self):
+        sql, params = super().sql()
+        quote = self.database.quote_char
+        updates = ', '.join(
+            f'{quote}{field.db_column}{quote} = '
+            f'VALUES({quote}{field.db_column}{quote})'
+            for field in self.update_fields)
+        return f'{sql} ON DUPLICATE KEY UPDATE {updates}', params
+
+
 class ImageWithUploadCfg(peewee.Model):
     from .image import Image
     upload_cfg = peewee.ForeignKeyField(UploadCfg, related_name='images')
@@ -339,6 +1164,54 @@ class ImageWithUploadCfg(peewee.Model):
         db_table = 'image_with_upload_cfg'
         indexes = ((('upload_cfg', 'image'), True), )
 
+    @classmethod
+    def upsert_many(cls, rows):
+        """
+        insert the upload results in one query,
+        the existing results of the same (upload_cfg, image) are updated.
+        The rows are keyed by the field names, e.g. `image`, not `image_id`.
+        """
+        return UpsertQuery(
+            cls,
+            update_fields=[cls.image_url, cls.thumbnail_url, cls.delete_url,
+                           cls.seen_at],
+            rows=rows)
+
+    @classmethod
+    async def find_duplicate(cls, image_id, upload_cfg_id, *, db_manager):
+        """
+        Find the upload result of another image of the same user
+        with the same content as the image on the upload config.
+
+        The results are never shared between the users.
+
+        Returns
+        -------
+        ImageWithUploadCfg
+            the reusable result, None if there is no one or the image
+            has no content hash.
+
+        """
+        from .image import Image
+        Source = Image.alias()
+        source_hash = Source \
+            .select(Source.content_hash) \
+            .where(Source.id == image_id)
+        source_user = Source \
+            .select(Source.user) \
+            .where(Source.id == image_id)
+        sql = cls.select() \
+            .join(Image) \
+            .where(cls.upload_cfg_id == upload_cfg_id,
+                   cls.image_id != image_id,
+                   Image.user == source_user,
+                   Image.content_hash == source_hash) \
+            .order_by(cls.id) \
+            .limit(1)
+        for image_with_upload_cfg in await db_manager.execute(sql):
+            return image_with_upload_cfg
+        return None
+
     def toJSON(self):
         return {
             'image_id': self.image_id,
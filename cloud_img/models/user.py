@@ -1,10 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import jwt
 import peewee
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.security import check_password_hash
 
-from ..constants import GLOBAL, JWT_KEY_CONFIG, JWT_KEY_DEFAULT
+from ..hashing import password_hasher
 from ..utils import get_config
 
 
@@ -23,6 +23,9 @@ class User(peewee.Model):
         db_table = 'user'
 
     def validate_password(self, password):
+        """
+        blocking, use `await password_hasher.check(...)` in the handlers.
+        """
         return check_password_hash(self.password_hash, password)
 
     @property
@@ -32,32 +35,50 @@ class User(peewee.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        """
+        blocking, use `await password_hasher.hash(...)` in the handlers.
+        """
+        self.password_hash = password_hasher.generate(password)
 
     @property
     def identity(self):
-        """user security identity"""
-        # TODO: better way to import the config
-        # config.get(JWT_KEY_CONFIG)
+        """
+        user security identity.
+
+        It expires after `auth.token_ttl` seconds if configured.
+        """
         config = get_config()
-        key = config.get(GLOBAL, {}).get(JWT_KEY_CONFIG, JWT_KEY_DEFAULT)
         payload = {'user_id': self.id}
-        jwt_bytes = jwt.encode(payload=payload, key=key, algorithm='HS256')
+        token_ttl = config.auth.get('token_ttl')
+        if token_ttl:
+            payload['exp'] = datetime.utcnow() + timedelta(seconds=token_ttl)
+        jwt_bytes = jwt.encode(
+            payload=payload, key=config.jwt_key, algorithm='HS256')
         return jwt_bytes.decode('utf8')
 
     @classmethod
-    def decode_identity(self, identity):
+    def decode_identity_claims(cls, identity):
         """
         decode identity.
 
-        return the `user_id` by the identity
-        or 'None' if identity decode fail.
+        return the verified claims of the identity
+        or 'None' if identity decode fail or it expires.
         """
-        config = get_config()
-        key = config.get(GLOBAL, {}).get(JWT_KEY_CONFIG, JWT_KEY_DEFAULT)
         jwt_bytes = identity.encode('utf8')
         try:
-            payload = jwt.decode(jwt=jwt_bytes, key=key, algorithms='HS256')
-            return payload.get('user_id')
-        except jwt.DecodeError:
+            return jwt.decode(
+                jwt=jwt_bytes, key=get_config().jwt_key, algorithms='HS256')
+        except jwt.InvalidTokenError:
             return None
+
+    @classmethod
+    def decode_identity(cls, identity):
+        """
+        decode identity.
+
+        return the `user_id` by the identity
+        or 'None' if identity decode fail.
+        """
+        claims = cls.decode_identity_claims(identity)
+        if claims is not None:
+            return claims.get('user_id')
@@ -1,6 +1,7 @@
 from aiohttp.web import Application
 
 from .auth import login, signup, logout
+from .health import healthz, show_metrics
 from .image import ImageApi
 from .upload_cfg import UploadCfgApi
 
@@ -19,6 +20,10 @@ def setup(app: Application):
     app.router.add_post(r'/signup', signup)
     app.router.add_post(r'/logout', logout)
 
+    app.router.add_get(r'/healthz', healthz)
+    app.router.add_get(r'/metrics', show_metrics)
+
     app.router.add_get(r'/image', ImageApi.get)
+    app.router.add_post(r'/image', ImageApi.post)
 
     app.router.add_get(r'/upload_cfg', UploadCfgApi.get)
@@ -2,11 +2,11 @@ import logging
 
 import peewee
 from aiohttp import web
-from aiohttp_security.api import forget, remember
-from jsonschema import ValidationError, validate
+from aiohttp_security.api import AUTZ_KEY, forget, remember
 
+from ..hashing import HasherBusy, password_hasher
 from ..models.user import User
-from ..utils import login_required
+from ..utils import login_required, validate_json
 
 
 logger = logging.getLogger(__name__)
@@ -46,21 +46,17 @@ argsSchema = {
 """
 
 
+@validate_json(argsSchema)
 async def login(request, *args, **kwargs):
     logger.debug("login arguments: args=%r, kwargs=%r", args, kwargs)
     db_manager = request.app['db_manager']
-    reqBody = await request.json()
-    try:
-        validate(reqBody, argsSchema)
-    except ValidationError as err:
-        logger.debug('args schema validate failure: %r', err)
-        return web.json_response({'message': 'paramaters error'}, status=400)
+    reqBody = request['body']
 
     username = reqBody['username']
     password = reqBody['password']
     try:
         user = await db_manager.get(User, username=username)
-        valid = user.validate_password(password)
+        valid = await password_hasher.check(user.password_hash, password)
         if valid:
             logger.debug('%r login success', user)
             response = web.json_response({'message': 'login success'})
@@ -68,6 +64,10 @@ async def login(request, *args, **kwargs):
             return response
     except User.DoesNotExist:
         logger.debug('user(username=%r) not exists', username)
+    except HasherBusy as err:
+        logger.warning('User(username=%r) login shed: %s', username, err)
+        return web.json_response({'message': 'too many requests'},
+                                 status=429)
     logger.debug('User(username=%r) login failure', username)
     return web.json_response(
         {
@@ -75,21 +75,25 @@ async def login(request, *args, **kwargs):
         }, status=400)
 
 
+@validate_json(argsSchema)
 async def signup(request):
     db_manager = request.app['db_manager']
 
-    reqBody = await request.json()
-    try:
-        validate(reqBody, argsSchema)
-    except ValidationError as err:
-        logger.debug('args schema validate failure: %r', err)
-        return web.json_response({'message': 'paramaters error'}, status=400)
+    reqBody = request['body']
 
     username = reqBody['username']
     password = reqBody['password']
 
     try:
-        await db_manager.create(User, username=username, password=password)
+        password_hash = await password_hasher.hash(password)
+    except HasherBusy as err:
+        logger.warning('User(username=%r) signup shed: %s', username, err)
+        return web.json_response({'message': 'too many requests'},
+                                 status=429)
+
+    try:
+        await db_manager.create(
+            User, username=username, password_hash=password_hash)
     except peewee.IntegrityError as err:
         logger.debug('User(username=%r) signup failure: %r', username, err)
         return web.json_response(
@@ -105,4 +109,5 @@ async def logout(request):
     logger.debug('User(id=%d) logout', request.user_id)
     response = web.json_response({'message': 'logout success'})
     await forget(request, response)
+    request.app[AUTZ_KEY].invalidate(request.user_id)
     return response
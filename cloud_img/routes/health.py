@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+from aiohttp import web
+
+from ..metrics import metrics
+from ..utils import login_required
+
+
+logger = logging.getLogger(__name__)
+__all__ = ('healthz', 'show_metrics')
+
+
+async def ping_mysql(app):
+    database = app['db_manager'].database
+    cursor = await database.cursor_async()
+    try:
+        await cursor.execute('SELECT 1')
+    finally:
+        await cursor.release
+
+
+async def ping_redis(app):
+    await app['redis_client'].ping()
+
+
+PINGS = {
+    'mysql': ping_mysql,
+    'redis': ping_redis,
+}
+
+
+async def healthz(request, timeout=1):
+    """
+    readiness of the app's dependencies through its own connections,
+    503 if any of them is not ready.
+    """
+    async def check(name, ping):
+        try:
+            await asyncio.wait_for(ping(request.app), timeout)
+        except Exception as err:
+            logger.warning('dependency %s is not ready: %r', name, err)
+            return False
+        return True
+
+    names = list(PINGS)
+    results = await asyncio.gather(
+        *[check(name, PINGS[name]) for name in names])
+    dependencies = {
+        name: 'ready' if ready else 'unavailable'
+        for name, ready in zip(names, results)
+    }
+    ready = all(results)
+    return web.json_response({
+        'ready': ready,
+        'dependencies': dependencies,
+    }, status=200 if ready else 503)
+
+
+@login_required
+async def show_metrics(request):
+    """
+    snapshot of the counters, timings and collected stats of this process,
+    only for the logined users since it reveals the hosts and the traffic.
+    """
+    return web.json_response(metrics.snapshot())
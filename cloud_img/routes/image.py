@@ -1,9 +1,12 @@
+import asyncio
 import logging
 
 from aiohttp import web
 
-from ..models import Image
-from ..utils import login_required
+from ..counters import TOTAL_MODES, get_total, image_counter
+from ..metrics import metrics
+from ..models import Image, gather_queries
+from ..utils import decode_cursor, encode_cursor, login_required
 
 
 logger = logging.getLogger(__name__)
@@ -21,43 +24,105 @@ class ImageApi:
         page_size = query.get('page_size', 15)
         page_size = int(page_size)
         page_size = page_size if page_size < 15 else 15
+        # the cursor takes precedence over the page_no
+        try:
+            last_id = decode_cursor(query.get('cursor'))
+        except ValueError as err:
+            logger.debug('cursor decode failure: %r', err)
+            return web.json_response({'message': 'paramaters error'},
+                                     status=400)
         upload_cfg_id = query.get('upload_cfg_id')
         if upload_cfg_id:
             upload_cfg_id = int(upload_cfg_id)
+        total_mode = query.get('total', 'exact')
+        if total_mode not in TOTAL_MODES:
+            return web.json_response({'message': 'paramaters error'},
+                                     status=400)
 
         user_id = request.user_id
         db_manager = request.app['db_manager']
-        # get total count of user's images
-        total = await Image.count(
-            user_id=user_id,
-            upload_cfg_id=upload_cfg_id,
-            db_manager=db_manager)
-        # paginate the Image table
-        images = await Image.paginate(
-            user_id=user_id,
-            upload_cfg_id=upload_cfg_id,
-            page_no=page_no,
-            page_size=page_size,
-            db_manager=db_manager)
+        counter_key = (user_id, )
+        if upload_cfg_id:
+            counter_key = (user_id, upload_cfg_id)
+        # get total count of user's images and paginate the Image table
+        # concurrently, they are independent
+        rv = await gather_queries(
+            'routes.image.get',
+            total=get_total(
+                total_mode,
+                image_counter,
+                request.app['redis_client'],
+                lambda: Image.count(
+                    user_id=user_id,
+                    upload_cfg_id=upload_cfg_id,
+                    db_manager=db_manager),
+                *counter_key),
+            images=Image.paginate(
+                user_id=user_id,
+                upload_cfg_id=upload_cfg_id,
+                page_no=page_no,
+                page_size=page_size,
+                last_id=last_id,
+                db_manager=db_manager))
+        total = rv['total']
+        images = list(rv['images'])
+        next_cursor = None
+        if len(images) == page_size:
+            next_cursor = encode_cursor(images[-1].id)
 
         images = [image.toJSON() for image in images]
 
-        # get the real image source
+        # get the real image sources of the whole page in one query
+        with metrics.timer('routes.image.get.sources'):
+            sources = await Image.get_upload_cfgs_in_batch(
+                image_ids=[image['id'] for image in images],
+                db_manager=db_manager)
         for image in images:
-            image_with_upload_cfg = await Image.get_upload_cfgs(
-                image_id=image['id'], db_manager=db_manager)
-            image['sources'] = [v.toJSON() for v in image_with_upload_cfg]
+            image['sources'] = [v.toJSON() for v in sources[image['id']]]
 
-        logger.debug('images count: %d, total: %d', len(images), total)
+        logger.debug('images count: %d, total: %r', len(images), total)
         return web.json_response({
             'images': images,
             'page_no': page_no,
             'page_size': page_size,
             'total': total,
+            'next_cursor': next_cursor,
         })
 
+    @login_required
     async def post(request):
-        raise NotImplementedError()
+        """
+        Store the image of the multipart field `file`, deduplicated by
+        its content, 201 if it is created, 200 with the existing image
+        of the same user and the same content.
+        """
+        data = await request.post()
+        field = data.get('file')
+        if not isinstance(field, web.FileField):
+            return web.json_response({'message': 'paramaters error'},
+                                     status=400)
+        loop = asyncio.get_event_loop()
+        image_data = await loop.run_in_executor(None, field.file.read)
+        if not image_data:
+            return web.json_response({'message': 'paramaters error'},
+                                     status=400)
+
+        user_id = request.user_id
+        with metrics.timer('routes.image.post.ingest'):
+            image, created = await Image.ingest(
+                user_id, image_data,
+                blob_store=request.app['blob_store'],
+                db_manager=request.app['db_manager'])
+        if created:
+            await image_counter.incr(request.app['redis_client'], user_id)
+        else:
+            metrics.incr('routes.image.post.dedup')
+        logger.debug('image %d of user %d, created: %r',
+                     image.id, user_id, created)
+        return web.json_response({
+            'image': image.toJSON(),
+            'created': created,
+        }, status=201 if created else 200)
 
     async def delete(request):
         raise NotImplementedError()
@@ -2,8 +2,9 @@ import logging
 
 from aiohttp import web
 
-from ..models import UploadCfg
-from ..utils import login_required
+from ..counters import TOTAL_MODES, get_total, upload_cfg_counter
+from ..models import UploadCfg, gather_queries
+from ..utils import decode_cursor, encode_cursor, login_required
 
 
 logger = logging.getLogger(__name__)
@@ -21,27 +22,53 @@ class UploadCfgApi:
         page_size = query.get('page_size', 15)
         page_size = int(page_size)
         page_size = page_size if page_size < 15 else 15
+        # the cursor takes precedence over the page_no
+        try:
+            last_id = decode_cursor(query.get('cursor'))
+        except ValueError as err:
+            logger.debug('cursor decode failure: %r', err)
+            return web.json_response({'message': 'paramaters error'},
+                                     status=400)
+        total_mode = query.get('total', 'exact')
+        if total_mode not in TOTAL_MODES:
+            return web.json_response({'message': 'paramaters error'},
+                                     status=400)
 
         user_id = request.user_id
         db_manager = request.app['db_manager']
-        # get total count of user's upload config
-        total = await UploadCfg.count(user_id=user_id, db_manager=db_manager)
-        # paginate the upload config table
-        upload_cfgs = await UploadCfg.paginate(
-            user_id=user_id,
-            page_no=page_no,
-            page_size=page_size,
-            db_manager=db_manager)
+        # get total count of user's upload config and paginate the upload
+        # config table concurrently, they are independent
+        rv = await gather_queries(
+            'routes.upload_cfg.get',
+            total=get_total(
+                total_mode,
+                upload_cfg_counter,
+                request.app['redis_client'],
+                lambda: UploadCfg.count(
+                    user_id=user_id, db_manager=db_manager),
+                user_id),
+            upload_cfgs=UploadCfg.paginate(
+                user_id=user_id,
+                page_no=page_no,
+                page_size=page_size,
+                last_id=last_id,
+                db_manager=db_manager))
+        total = rv['total']
+        upload_cfgs = list(rv['upload_cfgs'])
+        next_cursor = None
+        if len(upload_cfgs) == page_size:
+            next_cursor = encode_cursor(upload_cfgs[-1].id)
 
         upload_cfgs = [upload_cfg.toJSON() for upload_cfg in upload_cfgs]
 
-        logger.debug('upload_cfgs count: %d, total: %d', len(upload_cfgs),
+        logger.debug('upload_cfgs count: %d, total: %r', len(upload_cfgs),
                      total)
         return web.json_response({
             'upload_cfgs': upload_cfgs,
             'page_no': page_no,
             'page_size': page_size,
             'total': total,
+            'next_cursor': next_cursor,
         })
 
     async def post(request):
@@ -1,46 +1,206 @@
 import asyncio
+import atexit
+import base64
+import binascii
+import collections
+import collections.abc
 import functools
+import json
 import logging
 import logging.handlers
 import pathlib
+import queue
+import random
 import re
+import signal
+import sys
 import time
+import types
 
+import aiomysql
 import aioredis
 import pymysql
 import yaml
 from aiohttp import web
 from aiohttp_security import AbstractAuthorizationPolicy, authorized_userid
+from jsonschema import ValidationError, validators
 from lxml import etree
 
-from .constants import GLOBAL, MODE
+from .blobs import create_blob_store
+from .constants import GLOBAL, JWT_KEY_CONFIG, JWT_KEY_DEFAULT, MODE
+from .logs import (BatchingQueueListener, BatchStreamHandler,
+                   BatchTimedRotatingFileHandler, BoundedQueueHandler,
+                   ContextFilter, JsonFormatter)
+from .metrics import Timing, metrics
 
 
 __all__ = ('get_config', 'AuthorizationPolicy', 'config_setup',
-           'wait_for_foundation')
+           'ConfigSnapshot', 'reload_config', 'wait_for_foundation')
 _config = None
+_config_path = None
 _mode = None
 logger = logging.getLogger(__name__)
 
 
+def freeze(value):
+    """
+    convert the mappings into read-only views and the lists into tuples.
+    """
+    if isinstance(value, collections.abc.Mapping):
+        return types.MappingProxyType(
+            {key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """
+    convert a frozen config back into dicts and lists,
+    e.g. to pickle it into another process.
+    """
+    if isinstance(value, collections.abc.Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class ConfigSnapshot(collections.abc.Mapping):
+    """
+    Immutable config of one mode, resolved once when loading.
+
+    The mode's section and the `GLOBAL` section are merged,
+    nested mappings are read-only.
+
+    Parameters
+    ----------
+    raw : dict
+        the loaded config file.
+    mode : str
+        the mode's section to select, None selects the whole file.
+
+    """
+    __slots__ = ('_data', '_jwt_key')
+
+    def __init__(self, raw, mode=None):
+        conf = dict(raw[mode] if mode is not None else raw)
+        conf[GLOBAL] = raw.get(GLOBAL, {})
+        self._data = freeze(conf)
+        self._jwt_key = self._data[GLOBAL].get(JWT_KEY_CONFIG, JWT_KEY_DEFAULT)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'<ConfigSnapshot {list(self._data)!r}>'
+
+    @property
+    def jwt_key(self):
+        return self._jwt_key
+
+    @property
+    def mysql(self):
+        return self._data['db']['mysql']
+
+    @property
+    def redis(self):
+        return self._data['db']['redis']
+
+    @property
+    def worker(self):
+        return self._data.get('worker', types.MappingProxyType({}))
+
+    @property
+    def auth(self):
+        return self._data.get('auth', types.MappingProxyType({}))
+
+
 def get_config():
     """
-    get different config depends on app's mode.
+    get the config snapshot of app's mode.
+
+    Do not keep it, reloading swaps in a new one.
     """
-    global _config
     assert _config is not None, "use config_setup(app) first."
-    conf = _config.copy()
-    if _mode is not None:  # pragma: no cover
-        conf = conf[_mode]
-    conf[GLOBAL] = _config[GLOBAL].copy()
-    return conf
+    return _config
+
+
+def reload_config():
+    """
+    Read the config file again and swap the snapshot atomically,
+    the current snapshot is kept if the file is invalid.
+
+    Returns
+    -------
+    ConfigSnapshot
+        the new snapshot.
+
+    """
+    global _config
+    assert _config_path is not None, "use config_setup(app) first."
+    raw = yaml.load(_config_path.read_text('utf-8'))
+    _config = ConfigSnapshot(raw, _mode)
+    logger.info('config loaded from %s', _config_path)
+    return _config
 
 
 def config_setup(app):
-    global _config, _mode
-    confPath = pathlib.Path('.') / 'conf.yaml'
-    _config = yaml.load(confPath.read_text('utf-8'))
+    """
+    Load the config, and reload it on SIGHUP or the file changing
+    every `config_reload.watch_interval` seconds while the app runs.
+    """
+    global _config_path, _mode
+    _config_path = pathlib.Path('.') / 'conf.yaml'
     _mode = app['mode']
+    reload_config()
+
+    def try_reload():
+        try:
+            reload_config()
+        except Exception:
+            logger.exception('config reload fails, keep the current one')
+
+    async def watch(interval):
+        mtime = _config_path.stat().st_mtime
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                current = _config_path.stat().st_mtime
+            except OSError:
+                continue
+            if current != mtime:
+                mtime = current
+                try_reload()
+
+    async def asetup(app):
+        loop = asyncio.get_event_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, try_reload)
+        except (AttributeError, NotImplementedError, RuntimeError):
+            # no SIGHUP on Windows or out of the main thread
+            logger.info('config reloading on SIGHUP is unavailable')
+        interval = get_config().get('config_reload', {}).get('watch_interval')
+        if interval:
+            app['config_watcher'] = asyncio.ensure_future(watch(interval))
+
+    async def acleanup(app):
+        loop = asyncio.get_event_loop()
+        try:
+            loop.remove_signal_handler(signal.SIGHUP)
+        except (AttributeError, NotImplementedError, RuntimeError):
+            pass
+        if 'config_watcher' in app:
+            app['config_watcher'].cancel()
+
+    app.on_startup.append(asetup)
+    app.on_cleanup.append(acleanup)
 
 
 def build_redis_uri(config):
@@ -51,31 +211,81 @@ def build_redis_uri(config):
     return uri
 
 
+def redis_setup(app):
+    """
+    setup a redis client for the app as `app['redis_client']`,
+    and the blob store of `worker.blob_store` as `app['blob_store']`,
+    the images are stored where the workers read them.
+    """
+    async def asetup(app):
+        logger.info('redis setup')
+        config = get_config()
+        uri = build_redis_uri(config.redis)
+        app['redis_client'] = await aioredis.create_redis(uri)
+        app['blob_store'] = create_blob_store(
+            app['redis_client'], **thaw(config.worker.get('blob_store', {})))
+
+    async def acleanup(app):
+        logger.info('redis cleanup')
+        app['redis_client'].close()
+        await app['redis_client'].wait_closed()
+
+    app.on_startup.append(asetup)
+    app.on_cleanup.append(acleanup)
+
+
 def log_setup(app):
     """
-    setup the log handler.
+    setup the log handlers behind a queue.
+
+    The records are put into a bounded queue, and written in batches by
+    a listener's thread, so logging does no I/O in the event loop.
 
     + `StreamHandler` logging into console.
     + `TimedRotatingFileHandler` logging into timed rotating file.
+
+    Configured by `logging`, `format: json` writes structured records
+    with the request and job ids.
     """
     mode = app['mode']
+    config = get_config().get('logging', {})
     formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         '%Y-%m-%dT%H:%M:%S%z')
+    if config.get('format') == 'json':  # pragma: no cover
+        formatter = JsonFormatter()
 
     logger = logging.getLogger()
     logger.setLevel(logging.NOTSET)
 
     if mode != MODE.TEST:  # pragma: no cover
-        std_handler = logging.StreamHandler()
+        std_handler = BatchStreamHandler()
         std_handler.setFormatter(formatter)
 
-        file_handler = logging.handlers.TimedRotatingFileHandler(
+        file_handler = BatchTimedRotatingFileHandler(
             f'{mode}.log', when='h', encoding='utf8', backupCount=5, utc=True)
         file_handler.setFormatter(formatter)
 
-        logger.addHandler(file_handler)
-        logger.addHandler(std_handler)
+        log_queue = queue.Queue(config.get('queue_size', 10000))
+        queue_handler = BoundedQueueHandler(
+            log_queue,
+            policy=config.get('policy', 'drop'),
+            block_timeout=config.get('block_timeout', 0.1))
+        queue_handler.addFilter(ContextFilter())
+        listener = BatchingQueueListener(
+            log_queue, file_handler, std_handler,
+            batch_size=config.get('batch_size', 256))
+        listener.start()
+        metrics.register('logging', queue_handler.stats)
+
+        async def acleanup(app):
+            listener.stop()
+
+        app.on_cleanup.append(acleanup)
+        # write the queued records when exiting without the cleanup
+        atexit.register(listener.stop)
+
+        logger.addHandler(queue_handler)
 
     logger.info('logging handlers %r', logger.handlers)
 
@@ -87,10 +297,33 @@ def log_setup(app):
 class AuthorizationPolicy(AbstractAuthorizationPolicy):
     """
     authorization policy for the `aiohttp_security` extension.
+
+    Whether a user exists is cached for `identity_ttl` seconds,
+    and `negative_ttl` seconds if not.
+
+    Parameters
+    ----------
+    identity_ttl : float
+        seconds to cache an existing user, 0 disables the cache.
+    negative_ttl : float
+        seconds to cache a nonexistent user, 0 disables the negative cache.
+    maxsize : int
+        maximum count of the cached users.
+    trust_claims : bool
+        authorize the identities with an `exp` claim by their signatures
+        without looking the users up.
+
     """
 
-    def __init__(self, *, app):
+    def __init__(self, *, app, identity_ttl=60, negative_ttl=10,
+                 maxsize=10000, trust_claims=False):
         self.app = app
+        self.identity_ttl = identity_ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.trust_claims = trust_claims
+        # user_id -> (exists, expire_at)
+        self._users = collections.OrderedDict()
 
     async def permits(self, identity, permission, context=None):
         """Check user permissions.
@@ -100,6 +333,32 @@ class AuthorizationPolicy(AbstractAuthorizationPolicy):
         """
         raise NotImplementedError()
 
+    def _lookup(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        exists, expire_at = entry
+        if expire_at <= time.monotonic():
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return exists
+
+    def _store(self, user_id, exists):
+        ttl = self.identity_ttl if exists else self.negative_ttl
+        if not ttl:
+            return
+        self._users[user_id] = (exists, time.monotonic() + ttl)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.maxsize:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        forget the cached user, call it when the user logs out or is deleted.
+        """
+        self._users.pop(user_id, None)
+
     async def authorized_userid(self, identity):
         """Retrieve authorized user id.
 
@@ -107,14 +366,27 @@ class AuthorizationPolicy(AbstractAuthorizationPolicy):
         or 'None' if no user exists related to the identity.
         """
         from .models import User
-        user_id = User.decode_identity(identity)
-        if user_id:
+        claims = User.decode_identity_claims(identity)
+        user_id = claims.get('user_id') if claims else None
+        if not user_id:
+            return None
+        if self.trust_claims and 'exp' in claims:
+            metrics.incr('auth.trusted_claims')
+            return user_id
+
+        exists = self._lookup(user_id)
+        if exists is None:
+            metrics.incr('auth.identity_cache.miss')
             db_manager = self.app['db_manager']
             try:
                 await db_manager.get(User, id=user_id)
+                exists = True
             except User.DoesNotExist:
-                return None
-            return user_id
+                exists = False
+            self._store(user_id, exists)
+        else:
+            metrics.incr('auth.identity_cache.hit')
+        return user_id if exists else None
 
 
 def login_required(fn):  # pragma: no cover
@@ -147,91 +419,550 @@ def login_required(fn):  # pragma: no cover
     return wrapped
 
 
+def validate_json(schema, max_body_size=64 * 1024):
+    """Decorator that validates the JSON request body against the schema.
+
+    The schema is checked and compiled into a validator once when
+    decorating. The validated body is stored as `request['body']`.
+
+    Parameters
+    ----------
+    schema : dict
+        JSON schema of the request body.
+    max_body_size : int
+        bodies larger than it are rejected with 413 before being parsed.
+
+    Usages
+    ------
+
+        >>> @validate_json(argsSchema)
+        ... async def login(request):
+        ...     username = request['body']['username']
+
+    """
+    validator_cls = validators.validator_for(schema)
+    validator_cls.check_schema(schema)
+    validator = validator_cls(schema)
+
+    def decorator(fn):
+        metric_name = f'routes.{fn.__name__}.validation'
+
+        @functools.wraps(fn)
+        async def wrapped(*args, **kwargs):
+            request = args[-1]
+            content_length = request.content_length
+            if content_length is not None and content_length > max_body_size:
+                return web.json_response(
+                    {'message': 'request body too large'}, status=413)
+            # the content length may be absent, read one more byte to know,
+            # `read` returns only the buffered bytes, read until EOF
+            raw = bytearray()
+            while len(raw) <= max_body_size:
+                chunk = await request.content.read(
+                    max_body_size + 1 - len(raw))
+                if not chunk:
+                    break
+                raw += chunk
+            if len(raw) > max_body_size:
+                return web.json_response(
+                    {'message': 'request body too large'}, status=413)
+
+            with metrics.timer(metric_name):
+                try:
+                    body = json.loads(raw.decode('utf-8'))
+                    validator.validate(body)
+                except (UnicodeError, ValueError, ValidationError) as err:
+                    logger.debug('args schema validate failure: %r', err)
+                    return web.json_response({'message': 'paramaters error'},
+                                             status=400)
+            request['body'] = body
+            return await fn(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
 KEY_INDEX_PATTERN = re.compile(r'((?P<key>[^\s\.\[\]]+)'
                                r'((?P<left>\[)(?P<index>\d+)(?(left)\]))?)+?')
+XML_NAME_PATTERN = re.compile(r'^[^\W\d][\w\-]*$')
 
 
-def query_json(resource, path):
+def tokenize_path(path):
     """
-    parse query_path to load the value through the path from json data.
+    split the query path into a tuple of (key, index),
+    index is None if the key has no index.
+    """
+    steps = []
+    for match in KEY_INDEX_PATTERN.finditer(path):
+        group = match.groupdict()
+        index = int(group['index']) if group['index'] else None
+        steps.append((group['key'], index))
+    return tuple(steps)
+
+
+class JSONPath:
+    """
+    compiled query path to load the value from json data.
 
     TODO: unescape the path
     """
-    error_msg = f'query json path {path!r} is invalid.'
-    try:
-        for match in KEY_INDEX_PATTERN.finditer(path):
-            group = match.groupdict()
-            key = group['key']
-            assert isinstance(resource, dict)
-            resource = resource[key]
-            if group['index']:
-                index = int(group['index'])
-                assert isinstance(resource, list)
-                assert index >= 1, ' the index should start at 1.'
-                assert index < len(resource) + 1, ' index out of range.'
-                resource = resource[index - 1]
-
-        rv_type = type(resource)
-        assert issubclass(rv_type, (str, int, float)), \
-            f'result type must be str, int or float, but get {rv_type}'
-        return resource
-    except AssertionError as err:
-        raise ValueError(f'{error_msg}{err}')
-    except KeyError as key:
-        raise ValueError(f'{error_msg} key {key} no exists')
 
+    def __init__(self, path):
+        self.path = path
+        self.steps = tokenize_path(path)
+        self.error_msg = f'query json path {path!r} is invalid.'
 
-def query_xml(resource, path):
+    def __call__(self, resource):
+        try:
+            for key, index in self.steps:
+                assert isinstance(resource, dict)
+                resource = resource[key]
+                if index is not None:
+                    assert isinstance(resource, list)
+                    assert index >= 1, ' the index should start at 1.'
+                    assert index < len(resource) + 1, ' index out of range.'
+                    resource = resource[index - 1]
+
+            rv_type = type(resource)
+            assert issubclass(rv_type, (str, int, float)), \
+                f'result type must be str, int or float, but get {rv_type}'
+            return resource
+        except AssertionError as err:
+            raise ValueError(f'{self.error_msg}{err}')
+        except KeyError as key:
+            raise ValueError(f'{self.error_msg} key {key} no exists')
+
+
+class XMLPath:
     """
-    parse query_path to load the value through the path from xml data.
+    compiled query path to load the value from xml data.
+
+    The first key matches the element itself,
+    each of the others selects a child element by tag,
+    the index starts at 1 and defaults to the first one.
+
+    The path is compiled into an `lxml.etree.XPath` if possible,
+    walking through the elements step by step is only needed
+    to explain why the query fails.
 
     TODO: unescape the path
     """
-    error_msg = f'query xml path {path!r} is invalid.'
-    try:
-        for match in KEY_INDEX_PATTERN.finditer(path):
-            group = match.groupdict()
-            key = group['key']
-            if isinstance(resource, etree._Element):
-                if resource.tag != key:
-                    raise KeyError(key)
-                assert group['index'] is None
-                resource = resource.getchildren()
-            elif isinstance(resource, list):
-                resource = [elem for elem in resource if elem.tag == key]
-                if len(resource) == 0:
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = tokenize_path(path)
+        self.error_msg = f'query xml path {path!r} is invalid.'
+        self.xpath = self._compile_xpath()
+
+    def _compile_xpath(self):
+        if not self.steps:
+            return None
+        (root_key, root_index), *steps = self.steps
+        if root_index is not None:
+            return None
+        if not all(XML_NAME_PATTERN.match(key) for key, _ in self.steps):
+            return None
+        expr = [f'self::{root_key}']
+        for key, index in steps:
+            expr.append(f'{key}[{1 if index is None else index}]')
+        try:
+            return etree.XPath('/'.join(expr))
+        except etree.XPathSyntaxError:
+            return None
+
+    def __call__(self, resource):
+        if self.xpath is not None:
+            rv = self.xpath(resource)
+            if len(rv) == 1 and len(rv[0]) == 0:
+                return rv[0].text
+        return self._walk(resource)
+
+    def _walk(self, resource):
+        try:
+            for depth, (key, index) in enumerate(self.steps):
+                if depth == 0:
+                    if resource.tag != key:
+                        raise KeyError(key)
+                    assert index is None
+                    continue
+                children = [elem for elem in resource if elem.tag == key]
+                if len(children) == 0:
                     raise KeyError(key)
-                if group['index']:
-                    index = int(group['index'])
+                if index is not None:
                     assert index >= 1, ' the index should start at 1.'
-                    assert index < len(resource) + 1, ' index out of range.'
-                    resource = resource[index - 1]
+                    assert index < len(children) + 1, ' index out of range.'
+                    resource = children[index - 1]
                 else:
-                    resource = resource[0]
-            else:
-                raise AssertionError(' not supposed to happen.')
-        assert len(resource) == 0, ' it must be the deepest element.'
-        return resource.text
-    except AssertionError as err:
-        raise ValueError(f'{error_msg}{err}')
-    except KeyError as key:
-        raise ValueError(f'{error_msg} key {key} no exists')
+                    resource = children[0]
+            assert len(resource) == 0, ' it must be the deepest element.'
+            return resource.text
+        except AssertionError as err:
+            raise ValueError(f'{self.error_msg}{err}')
+        except KeyError as key:
+            raise ValueError(f'{self.error_msg} key {key} no exists')
+
+
+@functools.lru_cache(maxsize=256)
+def compile_json_path(path):
+    """
+    compile the json query path, the compiled paths are lru cached.
+    """
+    return JSONPath(path)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_xml_path(path):
+    """
+    compile the xml query path, the compiled paths are lru cached.
+    """
+    return XMLPath(path)
+
+
+def query_json(resource, path):
+    """
+    parse query_path to load the value through the path from json data.
+    """
+    return compile_json_path(path)(resource)
+
+
+def query_xml(resource, path):
+    """
+    parse query_path to load the value through the path from xml data.
+    """
+    return compile_xml_path(path)(resource)
+
+
+# the guard process, searching the patterns read from stdin line by line
+REGEX_GUARD_SCRIPT = """
+import json, re, sys
+for line in sys.stdin:
+    raw_pattern, resource = json.loads(line)
+    try:
+        match = re.search(raw_pattern, resource)
+        rv = {'match': None if match is None else [match.group(1),
+                                                   match.end()]}
+    except (re.error, IndexError) as err:
+        rv = {'error': str(err)}
+    sys.stdout.write(json.dumps(rv) + '\\n')
+    sys.stdout.flush()
+"""
+
+
+class RegexTimeout(Exception):
+    """
+    raised when a guarded searching takes longer than the timeout.
+    """
+
+
+class RegexGuardError(Exception):
+    """
+    raised when the guard process is not able to run.
+    """
+
+
+class RegexGuard:
+    """
+    Search the patterns in a long-lived guard process.
+
+    The process is a plain subprocess instead of a `multiprocessing` child,
+    so it can be started by the daemonic pulsar actors too.
+    It is killed and restarted if a searching takes too long,
+    the only way to stop a catastrophic backtracking.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._loop = None
+        self._lock = None
+
+    async def _start(self):
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                sys.executable, '-c', REGEX_GUARD_SCRIPT,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE)
+        except (OSError, RuntimeError) as err:
+            # RuntimeError: no child watcher attached to the running loop
+            raise RegexGuardError(f'guard process fails to start: {err!r}')
+
+    async def search(self, raw_pattern, resource, timeout):
+        """
+        Search the first group of the pattern in the guard process.
+
+        Raises
+        ------
+        re.error
+            the pattern is invalid.
+        RegexTimeout
+            the searching takes longer than `timeout` seconds.
+        RegexGuardError
+            the guard process is not able to run.
+
+        """
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # the process and the lock belong to the previous loop
+            self.kill()
+            self._loop = loop
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self._process is None or \
+                    self._process.returncode is not None:
+                await self._start()
+            process = self._process
+            request = json.dumps([raw_pattern, resource]) + '\n'
+            try:
+                process.stdin.write(request.encode('utf-8'))
+                await process.stdin.drain()
+                line = await asyncio.wait_for(process.stdout.readline(),
+                                              timeout)
+            except asyncio.TimeoutError:
+                self.kill()
+                raise RegexTimeout(
+                    f'searching {raw_pattern!r} takes more than {timeout}s.')
+            except (ConnectionError, OSError) as err:
+                self.kill()
+                raise RegexGuardError(f'guard process fails: {err!r}')
+            if not line:
+                self.kill()
+                raise RegexGuardError('guard process exits unexpectedly.')
+
+        rv = json.loads(line.decode('utf-8'))
+        if 'error' in rv:
+            raise re.error(rv['error'])
+        return None if rv['match'] is None else tuple(rv['match'])
+
+    def kill(self):
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+        self._process = None
+
+
+class RegexCache:
+    """
+    Bounded cache of the compiled regex patterns from the upload configs.
+
+    The cache is bounded by both the count of the patterns
+    and the sum of their compiled sizes, least recently used first out.
+    The match latency of every cached pattern is recorded.
+
+    If `timeout` is set, `search_async` runs the searching in a guard
+    process off the event loop, which is killed if the searching takes
+    longer than `timeout` seconds, so that a catastrophic backtracking
+    pattern cannot stall the worker. `search` is never guarded.
+
+    Attributes
+    ----------
+    maxsize : int
+        maximum count of the cached patterns.
+    maxweight : int
+        maximum sum in bytes of the compiled patterns.
+    timeout : float
+        seconds allowed for one guarded searching, None means no guard.
+
+    """
+
+    def __init__(self, maxsize=256, maxweight=1024 * 1024, timeout=None):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.guard_errors = 0
+        self.weight = 0
+        # raw_pattern -> [compiled, weight, Timing]
+        self._patterns = collections.OrderedDict()
+        self._guard = RegexGuard()
+
+    def configure(self, maxsize=None, maxweight=None, timeout=None):
+        """
+        configure the cache through the `regex` section of the worker config.
+        """
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if maxweight is not None:
+            self.maxweight = maxweight
+        self.timeout = timeout
+        self._evict()
+
+    def compile(self, raw_pattern):
+        """
+        get the compiled pattern from cache or compile it.
+
+        raise `re.error` if the pattern is invalid.
+        """
+        entry = self._patterns.get(raw_pattern)
+        if entry is not None:
+            self.hits += 1
+            self._patterns.move_to_end(raw_pattern)
+            return entry[0]
+
+        self.misses += 1
+        pattern = re.compile(raw_pattern)
+        weight = sys.getsizeof(pattern)
+        self._patterns[raw_pattern] = [pattern, weight, Timing()]
+        self.weight += weight
+        self._evict()
+        return pattern
+
+    def _evict(self):
+        while self._patterns and (len(self._patterns) > self.maxsize or
+                                  self.weight > self.maxweight):
+            _, (_, weight, _) = self._patterns.popitem(last=False)
+            self.weight -= weight
+
+    def _observe(self, raw_pattern, elapsed):
+        entry = self._patterns.get(raw_pattern)
+        if entry is not None:
+            entry[2].observe(elapsed)
+        metrics.observe('query_regex', elapsed)
+
+    def search(self, raw_pattern, resource):
+        """
+        search the first group of the pattern in the resource,
+        in the caller's thread without the guard.
+
+        Returns
+        -------
+        tuple or None
+            (group, end) or None if the pattern matches nothing,
+            `end` is the end position of the whole match.
+
+        """
+        pattern = self.compile(raw_pattern)
+        start = time.perf_counter()
+        try:
+            match = pattern.search(resource)
+            return None if match is None else (match.group(1), match.end())
+        finally:
+            self._observe(raw_pattern, time.perf_counter() - start)
+
+    async def search_async(self, raw_pattern, resource):
+        """
+        Search like `search`, through the guard process if `timeout` is set.
+
+        Raises
+        ------
+        re.error
+            the pattern is invalid.
+        RegexTimeout
+            the searching takes longer than `timeout` seconds.
+        RegexGuardError
+            the guard process is not able to run.
+
+        """
+        if self.timeout is None:
+            return self.search(raw_pattern, resource)
+
+        # invalid patterns fail here without a round-trip
+        self.compile(raw_pattern)
+        start = time.perf_counter()
+        try:
+            return await self._guard.search(raw_pattern, resource,
+                                            self.timeout)
+        except RegexTimeout:
+            self.timeouts += 1
+            raise
+        except RegexGuardError:
+            self.guard_errors += 1
+            logger.exception('regex guard fails')
+            raise
+        finally:
+            self._observe(raw_pattern, time.perf_counter() - start)
+
+    def close(self):
+        self._guard.kill()
+
+    def stats(self):
+        return {
+            'size': len(self._patterns),
+            'weight': self.weight,
+            'hits': self.hits,
+            'misses': self.misses,
+            'timeouts': self.timeouts,
+            'guard_errors': self.guard_errors,
+            'patterns': {
+                raw_pattern: timing.toJSON()
+                for raw_pattern, (_, _, timing) in self._patterns.items()
+            },
+        }
+
+
+regex_cache = RegexCache()
+metrics.register('regex_cache', regex_cache.stats)
+
+
+def search_regex(resource, raw_pattern):
+    """
+    Search the first group of the pattern through `regex_cache.search`.
+
+    Returns
+    -------
+    tuple or None
+        (group, end) or None if the pattern matches nothing.
+
+    Raises
+    ------
+    ValueError
+        the pattern is invalid.
+
+    """
+    try:
+        return regex_cache.search(raw_pattern, resource)
+    except re.error:
+        raise ValueError(f'query regex pattern {raw_pattern!r} is invalid.')
 
 
 def query_regex(resource, raw_pattern):
     """
     use regex to load the value from raw data.
+    """
+    match = search_regex(resource, raw_pattern)
+    if match is None:
+        raise ValueError(f'query regex pattern {raw_pattern!r} is invalid.'
+                         ' pattern should match something.')
+    return match[0]
+
+
+async def search_regex_async(resource, raw_pattern):
+    """
+    Search the first group of the pattern through `regex_cache.search_async`.
+
+    Returns
+    -------
+    tuple or None
+        (group, end) or None if the pattern matches nothing.
+
+    Raises
+    ------
+    ValueError
+        the pattern is invalid, times out, or the guard fails.
+
     """
     error_msg = f'query regex pattern {raw_pattern!r} is invalid.'
     try:
-        pattern = re.compile(raw_pattern)
-        match = pattern.search(resource)
-        assert match is not None, ' pattern should match something.'
-        return match.group(1)
-    except AssertionError as err:
-        raise ValueError(f'{error_msg}{err}')
+        return await regex_cache.search_async(raw_pattern, resource)
     except re.error:
         raise ValueError(f'{error_msg}')
+    except RegexTimeout:
+        raise ValueError(f'{error_msg} match timeout.')
+    except RegexGuardError as err:
+        raise ValueError(f'{error_msg} {err}')
+
+
+async def query_regex_async(resource, raw_pattern):
+    """
+    use regex to load the value from raw data, off the event loop
+    if the guard of `regex_cache` is enabled.
+    """
+    match = await search_regex_async(resource, raw_pattern)
+    if match is None:
+        raise ValueError(f'query regex pattern {raw_pattern!r} is invalid.'
+                         ' pattern should match something.')
+    return match[0]
 
 
 def datetime2unix(dt):
@@ -239,43 +970,192 @@ def datetime2unix(dt):
     return time.mktime(tt)
 
 
-def check_mysql(conf):
-    """ check mysql exists or not. """
+def encode_cursor(last_id):
+    """
+    encode the id of the last item of a page into an opaque cursor.
+    """
+    raw = json.dumps({'id': last_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode the cursor into the id of the last seen item.
+
+    Parameters
+    ----------
+    cursor : str
+        the cursor returned as `next_cursor`, empty means the first page.
+
+    Returns
+    -------
+    int
+        the last seen id, None for the first page.
+
+    Raises
+    ------
+    ValueError
+        the cursor is malformed.
+
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        last_id = json.loads(raw.decode('utf-8'))['id']
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        raise ValueError(f'invalid cursor {cursor!r}.')
+    if type(last_id) is not int:
+        raise ValueError(f'invalid cursor {cursor!r}.')
+    return last_id
+
+
+async def probe_mysql(conf, timeout=1):
+    """ check mysql is ready or not. """
     try:
-        connect = pymysql.connect(
+        connect = await asyncio.wait_for(aiomysql.connect(
             db=conf['db'],
             host=conf['host'],
             port=conf['port'],
             user=conf['user'],
             password=conf['password'],
-            connect_timeout=1,
-        )
+            connect_timeout=timeout,
+        ), timeout)
         connect.close()
-    except (TimeoutError, pymysql.err.OperationalError):
+    except (asyncio.TimeoutError, OSError, pymysql.err.MySQLError):
+        return False
+    return True
+
+
+async def probe_redis(conf, timeout=1):
+    """ check redis is ready or not. """
+    try:
+        uri = build_redis_uri(conf)
+        connection = await aioredis.create_connection(uri, timeout=timeout)
+    except (asyncio.TimeoutError, OSError, aioredis.RedisError):
         return False
+    connection.close()
+    await connection.wait_closed()
     return True
 
 
+def run_sync(coro):
+    """ run the coroutine to complete in a new event loop. """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def check_mysql(conf):
+    """ check mysql exists or not. """
+    return run_sync(probe_mysql(conf))
+
+
 def check_redis(conf):
     """ check redis exists or not. """
-    loop = asyncio.new_event_loop()
+    return run_sync(probe_redis(conf))
 
-    async def connect():
-        uri = build_redis_uri(conf)
-        connection = await aioredis.create_connection(uri, timeout=1)
-        connection.close()
-        await connection.wait_closed()
+
+async def retry(fn, attempts=3, base_delay=0.5, max_delay=10,
+                exceptions=(Exception, ), name=None):
+    """
+    Call `await fn()` until it succeeds, with exponential backoff and
+    full jitter between the attempts.
+
+    Parameters
+    ----------
+    fn : callable
+        returns a new awaitable per attempt.
+    attempts : int
+        maximum count of the attempts.
+    base_delay : float
+        maximum seconds before the second attempt, doubled per attempt.
+    max_delay : float
+        ceiling of the maximum seconds between the attempts.
+    exceptions : tuple
+        the errors to retry, the others are raised at once.
+    name : str
+        name in the logs and metrics.
+
+    Raises
+    ------
+    Exception
+        the error of the last attempt.
+
+    """
+    delay = base_delay
+    for attempt in range(1, attempts + 1):
+        try:
+            return await fn()
+        except exceptions as exc:
+            if attempt >= attempts:
+                raise
+            logger.warning('%s fails (attempt %d/%d): %r',
+                           name or fn, attempt, attempts, exc)
+            if name is not None:
+                metrics.incr(f'{name}.retry')
+        await asyncio.sleep(random.uniform(0, delay))
+        delay = min(delay * 2, max_delay)
+
+
+async def wait_for_dependencies(probes, timeout=None, base_delay=0.1,
+                                max_delay=5):
+    """
+    Probe the dependencies concurrently until all of them are ready.
+
+    Each dependency retries with exponential backoff and full jitter,
+    so a slow one does not delay probing the others.
+
+    Parameters
+    ----------
+    probes : Mapping
+        callable returns an awaitable of bool by dependency's name.
+    timeout : float
+        seconds to wait at most, None means forever.
+    base_delay : float
+        maximum seconds before the second attempt, doubled per attempt.
+    max_delay : float
+        ceiling of the maximum seconds between the attempts.
+
+    Raises
+    ------
+    TimeoutError
+        some dependencies are not ready in time, named in the message.
+
+    """
+    blocking = set(probes)
+
+    async def wait(name):
+        delay = base_delay
+        attempt = 1
+        while not await probes[name]():
+            logger.info('wait for foundation %s (attempt %d), blocking: %s',
+                        name, attempt, ', '.join(sorted(blocking)))
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, max_delay)
+            attempt += 1
+        blocking.discard(name)
+        logger.info('foundation %s is ready', name)
 
     try:
-        loop.run_until_complete(connect())
-    except (asyncio.TimeoutError, ConnectionRefusedError):
-        return False
-    return True
+        await asyncio.wait_for(
+            asyncio.gather(*[wait(name) for name in probes]), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(
+            f'foundation is not ready: {", ".join(sorted(blocking))}.')
 
 
 def wait_for_foundation(conf=None):
-    """ wait for the foundation like mysql and redis setup success. """
-    while not check_mysql(conf['db']['mysql']) or \
-            not check_redis(conf['db']['redis']):  # pragma: no cover
-        logger.info('wait for foundation...')
-        time.sleep(1)
+    """
+    wait for the foundation like mysql and redis setup success.
+
+    Configured by `foundation`, with the arguments of
+    `wait_for_dependencies`.
+    """
+    probes = {
+        'mysql': functools.partial(probe_mysql, conf['db']['mysql']),
+        'redis': functools.partial(probe_redis, conf['db']['redis']),
+    }
+    run_sync(wait_for_dependencies(probes, **conf.get('foundation', {})))
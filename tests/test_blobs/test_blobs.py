@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from cloud_img.blobs import (FileBlobStore, RedisBlobStore, TieredBlobStore,
+                             create_blob_store)
+
+
+async def test_blob_store(redis_client):
+    store = RedisBlobStore(redis_client, chunk_size=1024, ttl=60,
+                           prefix='test_image', legacy_hash=None)
+    data = os.urandom(1024 * 3 + 7)
+    await store.put(1, data)
+
+    assert await store.size(1) == len(data)
+    assert 0 < await redis_client.ttl(store.key(1)) <= 60
+    assert await store.get(1) == data
+    assert await store.read_range(1, 1000, 2000) == data[1000:2000]
+    assert await store.read_range(1, 10, 10) == b''
+
+    chunks = [chunk async for chunk in store.iter_chunks(1)]
+    assert [len(chunk) for chunk in chunks] == [1024, 1024, 1024, 7]
+    assert b''.join(chunks) == data
+
+    # replaced
+    await store.put(1, b'small')
+    assert await store.get(1) == b'small'
+
+    await store.delete(1)
+    assert await store.size(1) is None
+    assert await store.get(1) is None
+    with pytest.raises(KeyError):
+        async for _ in store.iter_chunks(1):
+            pass
+
+
+async def test_blob_store_legacy_hash(redis_client):
+    store = RedisBlobStore(redis_client, chunk_size=4, prefix='test_image',
+                           legacy_hash='test_image_legacy')
+    await redis_client.hset('test_image_legacy', 1, b'legacy image')
+
+    assert await store.size(1) == len(b'legacy image')
+    assert await store.read_range(1, 0, 6) == b'legacy'
+    chunks = [bytes(chunk) async for chunk in store.iter_chunks(1)]
+    assert chunks == [b'lega', b'cy i', b'mage']
+
+    # the chunked blob wins over the legacy one
+    await store.put(1, b'new image')
+    assert await store.get(1) == b'new image'
+
+    await store.delete(1)
+    assert await redis_client.hget('test_image_legacy', 1) is None
+
+
+async def test_blob_store_changed_while_reading(redis_client):
+    store = RedisBlobStore(redis_client, chunk_size=4, prefix='test_image',
+                           legacy_hash=None)
+    await store.put(1, b'0123456789')
+
+    chunks = store.iter_chunks(1)
+    assert await chunks.__anext__() == b'0123'
+    await store.delete(1)
+    with pytest.raises(LookupError):
+        await chunks.__anext__()
+
+
+def test_create_redis_blob_store_without_ttl():
+    store = create_blob_store(None, redis={'chunk_size': 1024})
+    assert isinstance(store, RedisBlobStore)
+    assert store.ttl is None
+
+    # the only copy of the images never expires
+    with pytest.raises(AssertionError):
+        create_blob_store(None, redis={'ttl': 86400})
+
+
+def test_create_tiered_blob_store_expires_hot_tier(tmp_path):
+    store = create_blob_store(
+        None, backend='tiered', redis={'chunk_size': 1024},
+        file={'root': str(tmp_path)}, tiered={'hot_ttl': 60})
+    assert isinstance(store, TieredBlobStore)
+    assert store.hot.ttl == 60
+    assert isinstance(store.cold, FileBlobStore)
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from cloud_img.blobs import FileBlobStore, TieredBlobStore, content_hash
+
+
+async def test_file_blob_store(tmp_path):
+    store = FileBlobStore(tmp_path, chunk_size=1024)
+    data = os.urandom(1024 * 3 + 7)
+
+    assert await store.put(1, data) == content_hash(data)
+    path = store.path(1)
+    assert path.relative_to(tmp_path).parts[:-1] == \
+        (path.parent.parent.name, path.parent.name)
+    assert len(path.parent.name) == 2
+
+    assert await store.size(1) == len(data)
+    view = await store.get(1)
+    assert isinstance(view, memoryview)
+    assert view == data
+    assert await store.read_range(1, 1000, 2000) == data[1000:2000]
+
+    chunks = [chunk async for chunk in store.iter_chunks(1)]
+    assert [len(chunk) for chunk in chunks] == [1024, 1024, 1024, 7]
+    assert b''.join(chunks) == data
+
+    # replaced atomically, the mapped view is still readable
+    await store.put(1, b'small')
+    assert view == data
+    assert await store.get(1) == b'small'
+    assert [p.name for p in path.parent.iterdir()] == ['1']
+
+    await store.put(2, b'')
+    assert await store.get(2) == b''
+
+    await store.delete(1)
+    await store.delete(1)
+    assert await store.size(1) is None
+    assert await store.get(1) is None
+    with pytest.raises(KeyError):
+        async for _ in store.iter_chunks(1):
+            pass
+
+
+async def test_tiered_blob_store(tmp_path):
+    hot = FileBlobStore(tmp_path / 'hot')
+    cold = FileBlobStore(tmp_path / 'cold')
+    store = TieredBlobStore(hot, cold, promote_hits=2)
+
+    # written through
+    await store.put(1, b'image')
+    assert await hot.get(1) == b'image'
+    assert await cold.get(1) == b'image'
+    assert await store.get(1) == b'image'
+    assert store.stats()['hot_hits'] == 1
+
+    # demoted
+    await hot.delete(1)
+    assert await store.size(1) == len(b'image')
+    assert await store.get(1) == b'image'
+    assert await hot.get(1) is None
+    # promoted by the second cold read
+    chunks = [bytes(chunk) async for chunk in store.iter_chunks(1)]
+    assert chunks == [b'image']
+    assert await hot.get(1) == b'image'
+    assert store.stats()['promotions'] == 1
+    assert store.stats()['cold_hits'] == 2
+
+    await store.delete(1)
+    assert await store.get(1) is None
+    assert store.stats()['misses'] == 1
+    with pytest.raises(KeyError):
+        async for _ in store.iter_chunks(1):
+            pass
+
+
+async def test_tiered_blob_store_window(tmp_path):
+    hot = FileBlobStore(tmp_path / 'hot')
+    cold = FileBlobStore(tmp_path / 'cold')
+    await cold.put(1, b'image')
+    await cold.put(2, b'image')
+
+    # the reads are not within the window
+    store = TieredBlobStore(hot, cold, promote_hits=2, window=0)
+    for _ in range(3):
+        assert await store.get(1) == b'image'
+    assert await hot.get(1) is None
+
+    store = TieredBlobStore(hot, cold, promote_hits=2, max_tracked=1)
+    await store.get(1)
+    await store.get(2)
+    # image 1 is not tracked anymore
+    await store.get(1)
+    assert await hot.get(1) is None
+    await store.get(1)
+    assert await hot.get(1) == b'image'
+    assert await hot.get(2) is None
@@ -0,0 +1,59 @@
+import pytest
+
+from cloud_img import breakers
+from cloud_img.breakers import CircuitBreaker, CircuitOpen
+
+
+def test_circuit_breaker(monkeypatch):
+    now = 0
+    monkeypatch.setattr(breakers.time, 'monotonic', lambda: now)
+    breaker = CircuitBreaker('example.com', failure_threshold=2,
+                             reset_timeout=10)
+
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_success()
+    # not consecutive
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+    # one trial call
+    now = 10
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now = 15
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    now = 20
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+    assert breaker.stats() == {
+        'state': 'closed', 'failures': 0, 'rejected': 3}
+
+
+def test_circuit_breaker_lost_trial(monkeypatch):
+    now = 0
+    monkeypatch.setattr(breakers.time, 'monotonic', lambda: now)
+    breaker = CircuitBreaker('example.com', failure_threshold=1,
+                             reset_timeout=10)
+    breaker.record_failure()
+
+    now = 10
+    breaker.before_call()
+    # the trial never finishes, another one is let through later
+    now = 20
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
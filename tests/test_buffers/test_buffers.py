@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from cloud_img.buffers import WriteBehindBuffer
+
+
+async def test_write_behind_buffer_by_size():
+    batches = []
+
+    async def write(rows):
+        batches.append(rows)
+
+    buffer = WriteBehindBuffer(write, max_rows=3, max_delay=60)
+    await asyncio.gather(*[buffer.add(i) for i in range(6)])
+    assert batches == [[0, 1, 2], [3, 4, 5]]
+    assert buffer.stats()['flushed_rows'] == 6
+    assert buffer.stats()['flushes'] == 2
+
+
+async def test_write_behind_buffer_by_time():
+    batches = []
+
+    async def write(rows):
+        batches.append(rows)
+
+    buffer = WriteBehindBuffer(write, max_rows=100, max_delay=0.01)
+    adding = asyncio.ensure_future(
+        asyncio.gather(buffer.add(1), buffer.add(2)))
+    await asyncio.sleep(0)
+    # not written yet, the callers are waiting
+    assert batches == []
+    assert not adding.done()
+
+    await adding
+    assert batches == [[1, 2]]
+    await buffer.close()
+    assert buffer.stats()['pending'] == 0
+
+
+async def test_write_behind_buffer_failure():
+    batches = []
+
+    async def write(rows):
+        batches.append(rows)
+        if 2 in rows:
+            raise ValueError(rows)
+
+    buffer = WriteBehindBuffer(write, max_rows=3, max_delay=60)
+    results = await asyncio.gather(
+        *[buffer.add(i) for i in range(3)], return_exceptions=True)
+    # written one by one after the batch fails
+    assert batches == [[0, 1, 2], [0], [1], [2]]
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], ValueError)
+    assert buffer.stats()['failed_rows'] == 1
+
+    with pytest.raises(ValueError):
+        await buffer.add(2)
+
+
+async def test_write_behind_buffer_close():
+    batches = []
+
+    async def write(rows):
+        await asyncio.sleep(0)
+        batches.append(rows)
+
+    buffer = WriteBehindBuffer(write, max_rows=100, max_delay=60)
+    adding = asyncio.ensure_future(buffer.add(1))
+    await asyncio.sleep(0)
+    await buffer.close()
+    assert batches == [[1]]
+    await adding
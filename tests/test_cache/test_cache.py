@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from cloud_img.cache import (ByteLRUCache, VersionedCache,
+                             listen_invalidation_forever)
+
+
+def make_loader(value, calls):
+    async def loader():
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+    return loader
+
+
+async def test_byte_lru_cache_evict():
+    cache = ByteLRUCache(max_bytes=10)
+    calls = []
+    assert await cache.get(1, make_loader(b'a' * 4, calls)) == b'a' * 4
+    assert await cache.get(2, make_loader(b'b' * 4, calls)) == b'b' * 4
+    # hit makes 1 the most recently used
+    assert await cache.get(1, make_loader(b'x', calls)) == b'a' * 4
+    await cache.get(3, make_loader(b'c' * 4, calls))
+
+    assert 1 in cache and 3 in cache and 2 not in cache
+    assert cache.bytes == 8
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 3
+    assert stats['evictions'] == 1
+
+    # too large to be cached
+    await cache.get(4, make_loader(b'd' * 11, calls))
+    assert 4 not in cache
+    assert cache.bytes == 8
+
+
+async def test_byte_lru_cache_coalesce_loads():
+    cache = ByteLRUCache()
+    calls = []
+    loader = make_loader(b'data', calls)
+    rv = await asyncio.gather(*[cache.get(1, loader) for _ in range(5)])
+    assert rv == [b'data'] * 5
+    assert len(calls) == 1
+
+    # None is not cached
+    await cache.get(2, make_loader(None, calls))
+    assert 2 not in cache
+
+
+async def test_byte_lru_cache_ttl_and_invalidate():
+    cache = ByteLRUCache(ttl=0.01)
+    calls = []
+    await cache.get(1, make_loader(b'data', calls))
+    await asyncio.sleep(0.02)
+    assert 1 not in cache
+    assert cache.stats()['expirations'] == 1
+
+    cache.ttl = None
+    await cache.get(1, make_loader(b'data', calls))
+    cache.invalidate(1)
+    assert 1 not in cache
+    assert cache.bytes == 0
+
+    # invalidated while loading
+    loading = asyncio.ensure_future(cache.get(1, make_loader(b'old', calls)))
+    await asyncio.sleep(0)
+    cache.invalidate(1)
+    assert await loading == b'old'
+    assert 1 not in cache
+
+
+async def test_versioned_cache():
+    cache = VersionedCache(maxsize=2)
+    calls = []
+    assert await cache.get(1, make_loader('v0', calls)) == 'v0'
+    assert await cache.get(1, make_loader('x', calls)) == 'v0'
+    assert cache.stats()['hits'] == 1
+
+    cache.invalidate(1, 2)
+    assert 1 not in cache
+    assert await cache.get(1, make_loader('v2', calls)) == 'v2'
+    # stale revision is ignored
+    cache.invalidate(1, 1)
+    assert await cache.get(1, make_loader('x', calls)) == 'v2'
+    cache.invalidate(1)
+    assert cache.revision(1) == 3
+
+    # invalidated while loading
+    loading = asyncio.ensure_future(cache.get(1, make_loader('v3', calls)))
+    await asyncio.sleep(0)
+    cache.invalidate(1)
+    assert await loading == 'v3'
+    assert 1 not in cache
+
+    await cache.get(1, make_loader('v4', calls))
+    await cache.get(2, make_loader('a', calls))
+    await cache.get(3, make_loader('b', calls))
+    assert 1 not in cache and len(cache) == 2
+    assert cache.stats()['evictions'] == 1
+
+
+async def test_listen_invalidation_forever_resubscribes():
+    attempts = []
+    resubscribed = []
+
+    async def connect():
+        attempts.append(1)
+        raise ConnectionRefusedError()
+
+    listener = asyncio.ensure_future(listen_invalidation_forever(
+        connect, {}, on_resubscribe=lambda: resubscribed.append(1),
+        base_delay=0.01, max_delay=0.02))
+    await asyncio.sleep(0.1)
+    listener.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await listener
+    assert len(attempts) >= 3
+    assert len(resubscribed) >= 2
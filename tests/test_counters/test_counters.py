@@ -0,0 +1,45 @@
+from cloud_img.counters import UserCounter, get_total
+
+
+async def test_user_counter(redis_client):
+    counter = UserCounter('test', ttl=60)
+    await counter.invalidate(redis_client, 1)
+    counts = []
+
+    async def count():
+        counts.append(1)
+        return 3
+
+    # not cached yet
+    await counter.incr(redis_client, 1)
+    assert await redis_client.get(counter.key(1)) is None
+
+    assert await counter.get(redis_client, count, 1) == 3
+    assert await counter.get(redis_client, count, 1) == 3
+    assert len(counts) == 1
+    assert 0 < await redis_client.ttl(counter.key(1)) <= 60
+
+    await counter.incr(redis_client, 1)
+    await counter.incr(redis_client, 1, delta=-2)
+    assert await counter.get(redis_client, count, 1) == 2
+
+    await counter.invalidate(redis_client, 1)
+    assert await counter.get(redis_client, count, 1) == 3
+    assert len(counts) == 2
+    await counter.invalidate(redis_client, 1)
+
+
+async def test_get_total(redis_client):
+    counter = UserCounter('test')
+    await counter.invalidate(redis_client, 2)
+
+    async def count():
+        return 5
+
+    assert await get_total('exact', counter, redis_client, count, 2) == 5
+    assert await redis_client.get(counter.key(2)) is None
+    assert await get_total('none', counter, redis_client, count, 2) is None
+    assert await get_total(
+        'approximate', counter, redis_client, count, 2) == 5
+    assert await redis_client.get(counter.key(2)) == b'5'
+    await counter.invalidate(redis_client, 2)
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from cloud_img.hashing import HasherBusy, PasswordHasher
+
+
+async def test_hash_and_check():
+    hasher = PasswordHasher(iterations=1000)
+    pwhash = await hasher.hash('password')
+    assert pwhash.startswith('pbkdf2:sha256:1000$')
+    assert await hasher.check(pwhash, 'password')
+    assert not await hasher.check(pwhash, 'wrong password')
+    assert hasher.stats()['pending'] == 0
+    hasher.close()
+
+
+async def test_hash_off_the_event_loop():
+    hasher = PasswordHasher(iterations=200000)
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    ticker = asyncio.ensure_future(tick())
+    await hasher.hash('password')
+    ticker.cancel()
+    assert ticks > 1
+    hasher.close()
+
+
+async def test_hasher_busy():
+    hasher = PasswordHasher(iterations=100000, max_pending=2)
+    rv = await asyncio.gather(
+        *[hasher.hash('password') for _ in range(3)], return_exceptions=True)
+    assert isinstance(rv[2], HasherBusy)
+    assert all(isinstance(pwhash, str) for pwhash in rv[:2])
+    assert hasher.stats()['rejected'] == 1
+    hasher.close()
+
+
+def test_unknown_executor():
+    with pytest.raises(AssertionError):
+        PasswordHasher(executor='fiber')
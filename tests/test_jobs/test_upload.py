@@ -2,7 +2,11 @@ from pathlib import Path
 
 from aiohttp import web
 
-from cloud_img.jobs import upload_img
+from cloud_img.blobs import RedisBlobStore, content_hash
+from cloud_img.cache import (bump_upload_cfg_revision, image_cache,
+                             upload_cfg_cache)
+from cloud_img.jobs import upload_img, upload_img_to_many
+from cloud_img.jobs.upload import result_row
 from cloud_img.models import Image, ImageWithUploadCfg, UploadCfg
 
 
@@ -47,6 +51,223 @@ async def test_upload_img_fg(bg, redis_client, db_manager, user,
     assert img_with_upload_cfg.image_url == 'https://example.com/1'
 
 
+async def test_upload_img_fg_after_upload_cfg_edited(
+        bg, redis_client, db_manager, user, aiohttp_server):
+    tasks = bg.tasks
+    task_name = upload_img.name
+
+    image_bytes = Path('tests/assets/python.png').read_bytes()
+    images = [await db_manager.create(Image, user=user) for _ in range(2)]
+    for image in images:
+        await redis_client.hset('image', image.id, image_bytes)
+
+    async def handler(request):
+        return web.json_response({'id': 1})
+
+    app = web.Application()
+    app.router.add_post('/', handler)
+    server = await aiohttp_server(app)
+
+    upload_cfg = await db_manager.create(
+        UploadCfg,
+        user=user,
+        request_url=server.make_url('/'),
+        request_formdata={'file': '$input$'},
+        image_url_querystr='https://example.com/$json:id$')
+
+    async def upload(image):
+        task = await tasks.queue(
+            task_name,
+            user_id=user.id,
+            image_id=image.id,
+            upload_cfg_id=upload_cfg.id,
+            queue=False)
+        assert task.status_string == 'SUCCESS'
+        img_with_upload_cfg = await db_manager.get(
+            ImageWithUploadCfg, upload_cfg_id=upload_cfg.id,
+            image_id=image.id)
+        return img_with_upload_cfg.image_url
+
+    assert await upload(images[0]) == 'https://example.com/1'
+    assert upload_cfg.id in upload_cfg_cache
+
+    upload_cfg.image_url_querystr = 'https://example.org/$json:id$'
+    await db_manager.update(upload_cfg)
+    # the jobs check the revision even if the message is never delivered
+    await bump_upload_cfg_revision(redis_client, upload_cfg.id)
+    assert await upload(images[1]) == 'https://example.org/1'
+
+
+async def test_upload_img_fg_streamed(bg, redis_client, db_manager, user,
+                                      aiohttp_server):
+    tasks = bg.tasks
+    task_name = upload_img.name
+
+    image_bytes = Path('tests/assets/python.png').read_bytes()
+    image = await db_manager.create(Image, user=user)
+    await RedisBlobStore(redis_client, chunk_size=1024).put(
+        image.id, image_bytes)
+
+    async def handler(request):
+        data = await request.post()
+        files = data.getall('file')
+        assert len(files) == 1
+        assert files[0].file.read() == image_bytes
+        return web.json_response({'id': 1})
+
+    app = web.Application()
+    app.router.add_post('/', handler)
+    server = await aiohttp_server(app)
+
+    upload_cfg = await db_manager.create(
+        UploadCfg,
+        user=user,
+        request_url=server.make_url('/'),
+        request_formdata={'file': '$input$'},
+        image_url_querystr='https://example.com/$json:id$')
+
+    # too large for the image cache, streamed from the blob store
+    image_cache.configure(max_item_bytes=len(image_bytes) - 1)
+    try:
+        task = await tasks.queue(
+            task_name,
+            user_id=user.id,
+            image_id=image.id,
+            upload_cfg_id=upload_cfg.id,
+            queue=False)
+    finally:
+        image_cache.configure()
+    assert task.status_string == 'SUCCESS'
+    assert image.id not in image_cache
+
+
+async def test_upload_img_fg_deduplicated(bg, redis_client, db_manager, user,
+                                          aiohttp_server):
+    tasks = bg.tasks
+    task_name = upload_img.name
+    blob_store = RedisBlobStore(redis_client)
+
+    image_bytes = Path('tests/assets/python.png').read_bytes()
+    image = await db_manager.create(
+        Image, user=user, content_hash=content_hash(image_bytes))
+    await blob_store.put(image.id, image_bytes)
+    # the same content ingested by another way
+    image_2 = await db_manager.create(
+        Image, user=user, content_hash=content_hash(image_bytes))
+    await blob_store.put(image_2.id, image_bytes)
+
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        return web.json_response({'id': len(requests)})
+
+    app = web.Application()
+    app.router.add_post('/', handler)
+    server = await aiohttp_server(app)
+
+    upload_cfg = await db_manager.create(
+        UploadCfg,
+        user=user,
+        request_url=server.make_url('/'),
+        request_formdata={'file': '$input$'},
+        image_url_querystr='https://example.com/$json:id$')
+
+    for image_id in (image.id, image_2.id):
+        task = await tasks.queue(
+            task_name,
+            user_id=user.id,
+            image_id=image_id,
+            upload_cfg_id=upload_cfg.id,
+            queue=False)
+        assert task.status_string == 'SUCCESS'
+
+    assert len(requests) == 1
+    img_with_upload_cfg = await db_manager.get(
+        ImageWithUploadCfg, upload_cfg_id=upload_cfg.id, image_id=image_2.id)
+    assert img_with_upload_cfg.image_url == 'https://example.com/1'
+
+
+async def test_upload_img_fg_retried_and_idempotent(
+        bg, redis_client, db_manager, user, aiohttp_server):
+    tasks = bg.tasks
+    task_name = upload_img.name
+
+    image_bytes = Path('tests/assets/python.png').read_bytes()
+    image = await db_manager.create(Image, user=user)
+    await RedisBlobStore(redis_client).put(image.id, image_bytes)
+
+    statuses = [500, 200]
+
+    async def handler(request):
+        data = await request.post()
+        assert data['file'].file.read() == image_bytes
+        return web.json_response({'id': 1}, status=statuses.pop(0))
+
+    app = web.Application()
+    app.router.add_post('/', handler)
+    server = await aiohttp_server(app)
+
+    upload_cfg = await db_manager.create(
+        UploadCfg,
+        user=user,
+        request_url=server.make_url('/'),
+        request_formdata={'file': '$input$'},
+        image_url_querystr='https://example.com/$json:id$')
+
+    # retried after the 500 response, then repeated without uploading
+    for _ in range(2):
+        task = await tasks.queue(
+            task_name,
+            user_id=user.id,
+            image_id=image.id,
+            upload_cfg_id=upload_cfg.id,
+            queue=False)
+        assert task.status_string == 'SUCCESS'
+    assert statuses == []
+
+    img_with_upload_cfg = await db_manager.get(
+        ImageWithUploadCfg, upload_cfg_id=upload_cfg.id)
+    assert img_with_upload_cfg.image_url == 'https://example.com/1'
+
+
+async def test_upload_img_fg_image_not_found(
+        bg, redis_client, db_manager, user, aiohttp_server):
+    tasks = bg.tasks
+    task_name = upload_img.name
+
+    # the image is missing from the blob store
+    image = await db_manager.create(Image, user=user)
+
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        return web.json_response({'id': 1})
+
+    app = web.Application()
+    app.router.add_post('/', handler)
+    server = await aiohttp_server(app)
+
+    upload_cfg = await db_manager.create(
+        UploadCfg,
+        user=user,
+        request_url=server.make_url('/'),
+        request_formdata={'file': '$input$'},
+        image_url_querystr='https://example.com/$json:id$')
+
+    task = await tasks.queue(
+        task_name,
+        user_id=user.id,
+        image_id=image.id,
+        upload_cfg_id=upload_cfg.id,
+        queue=False)
+    assert task.status_string != 'SUCCESS'
+    assert requests == []
+    assert not await db_manager.count(ImageWithUploadCfg.select().where(
+        ImageWithUploadCfg.upload_cfg_id == upload_cfg.id))
+
+
 async def test_upload_img_bg_to__sm_dot_ms(bg, redis_client, db_manager, user,
                                            session):
     tasks = bg.tasks
@@ -87,3 +308,83 @@ async def test_upload_img_bg_to__sm_dot_ms(bg, redis_client, db_manager, user,
 
     async with session.get(img_with_upload_cfg.delete_url) as resp:
         assert resp.status == 200
+
+
+async def test_upload_img_to_many_fg(bg, redis_client, db_manager, user,
+                                     aiohttp_server):
+    tasks = bg.tasks
+    task_name = upload_img_to_many.name
+
+    image_bytes = Path('tests/assets/python.png').read_bytes()
+    image = await db_manager.create(Image, user=user)
+    await redis_client.hset('image', image.id, image_bytes)
+
+    async def handler(request):
+        data = await request.post()
+        files = data.getall('file')
+        assert len(files) == 1
+        assert files[0].file.read() == image_bytes
+        return web.json_response({'id': request.match_info['name']})
+
+    app = web.Application()
+    app.router.add_post('/{name}', handler)
+    server = await aiohttp_server(app)
+
+    upload_cfgs = []
+    for name in ('a', 'b'):
+        upload_cfgs.append(await db_manager.create(
+            UploadCfg,
+            user=user,
+            request_url=server.make_url(f'/{name}'),
+            request_formdata={'file': '$input$'},
+            image_url_querystr='https://example.com/$json:id$'))
+    # the response has no key `url`
+    upload_cfgs.append(await db_manager.create(
+        UploadCfg,
+        user=user,
+        request_url=server.make_url('/c'),
+        request_formdata={'file': '$input$'},
+        image_url_querystr='$json:url$'))
+
+    task = await tasks.queue(
+        task_name,
+        user_id=user.id,
+        image_id=image.id,
+        upload_cfg_ids=[upload_cfg.id for upload_cfg in upload_cfgs],
+        queue=False)
+    assert task.status_string == 'SUCCESS'
+
+    report = task.result
+    assert report[str(upload_cfgs[0].id)] == {'status': 'SUCCESS'}
+    assert report[str(upload_cfgs[1].id)] == {'status': 'SUCCESS'}
+    assert report[str(upload_cfgs[2].id)]['status'] == 'FAILURE'
+
+    for name, upload_cfg in zip(('a', 'b'), upload_cfgs):
+        img_with_upload_cfg = await db_manager.get(
+            ImageWithUploadCfg, upload_cfg_id=upload_cfg.id)
+        assert img_with_upload_cfg.image_id == image.id
+        assert img_with_upload_cfg.image_url == f'https://example.com/{name}'
+
+    assert await Image.count(
+        upload_cfg_id=upload_cfgs[2].id, db_manager=db_manager) == 0
+
+
+async def test_result_row_written(db_manager, user):
+    image = await db_manager.create(Image, user=user)
+    upload_cfg = await db_manager.create(
+        UploadCfg,
+        user=user,
+        request_url='http://localhost/',
+        request_formdata={'file': '$input$'},
+        image_url_querystr='$json:url$')
+
+    rows = [result_row(image.id, upload_cfg.id, {
+        'image_url': 'https://example.com/1',
+        'thumbnail_url': '',
+        'delete_url': '',
+    })]
+    await db_manager.execute(ImageWithUploadCfg.upsert_many(rows))
+
+    img_with_upload_cfg = await db_manager.get(
+        ImageWithUploadCfg, upload_cfg_id=upload_cfg.id, image_id=image.id)
+    assert img_with_upload_cfg.image_url == 'https://example.com/1'
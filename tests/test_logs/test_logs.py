@@ -0,0 +1,138 @@
+import asyncio
+import io
+import json
+import logging
+import queue
+import sys
+
+from aiohttp import web
+
+from cloud_img.logs import (BatchingQueueListener, BatchStreamHandler,
+                            BoundedQueueHandler, ContextFilter,
+                            JsonFormatter, TaskContextVar, log_context,
+                            request_id_middleware, with_job_context)
+
+
+class CountingStream(io.StringIO):
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+        super().flush()
+
+
+def make_logger(name, log_queue):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = BoundedQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    logger.handlers = [handler]
+    return logger, handler
+
+
+def test_batching_queue_listener():
+    log_queue = queue.Queue()
+    logger, _ = make_logger('test_batching', log_queue)
+    stream = CountingStream()
+    handler = BatchStreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+
+    with log_context(request_id='r1'):
+        for i in range(100):
+            logger.info('record %d', i)
+    listener = BatchingQueueListener(log_queue, handler, batch_size=64)
+    listener.start()
+    listener.stop()
+    listener.stop()
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 100
+    record = json.loads(lines[-1])
+    assert record['message'] == 'record 99'
+    assert record['request_id'] == 'r1'
+    assert 'job_id' not in record
+    # two batches
+    assert stream.flushes == 2
+
+
+def test_bounded_queue_handler_drop():
+    log_queue = queue.Queue(2)
+    logger, handler = make_logger('test_drop', log_queue)
+    for i in range(5):
+        logger.info('record %d', i)
+    assert handler.stats() == {'queued': 2, 'maxsize': 2, 'dropped': 3}
+
+
+def test_json_formatter_exc_info():
+    formatter = JsonFormatter()
+    try:
+        raise ValueError('oops')
+    except ValueError:
+        record = logging.LogRecord(
+            'test', logging.ERROR, __file__, 1, 'fails %s', ('now', ),
+            exc_info=sys.exc_info())
+    data = json.loads(formatter.format(record))
+    assert data['message'] == 'fails now'
+    assert data['level'] == 'ERROR'
+    assert 'ValueError: oops' in data['exc_info']
+
+
+async def test_request_id_middleware(aiohttp_client):
+    request_ids = []
+
+    async def handler(request):
+        record = logging.LogRecord(
+            'test', logging.INFO, __file__, 1, 'msg', (), None)
+        ContextFilter().filter(record)
+        request_ids.append(record.request_id)
+        return web.json_response({})
+
+    app = web.Application(middlewares=[request_id_middleware])
+    app.router.add_get('/', handler)
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/', headers={'X-Request-ID': 'abc'})
+    assert resp.headers['X-Request-ID'] == 'abc'
+    resp = await client.get('/')
+    assert resp.headers['X-Request-ID'] == request_ids[-1]
+    assert request_ids[0] == 'abc'
+
+
+async def test_with_job_context():
+    class Task:
+        id = 'task-id'
+
+    class Job:
+        task = Task()
+
+    @with_job_context
+    async def job(self):
+        record = logging.LogRecord(
+            'test', logging.INFO, __file__, 1, 'msg', (), None)
+        ContextFilter().filter(record)
+        return record.job_id
+
+    assert await job(Job()) == 'task-id'
+
+
+async def test_task_context_var():
+    var = TaskContextVar(default={})
+    assert var.get() == {}
+
+    async def bind(value):
+        token = var.set(value)
+        await asyncio.sleep(0)
+        rv = var.get()
+        var.reset(token)
+        return rv
+
+    assert await asyncio.gather(
+        asyncio.ensure_future(bind({'job_id': 1})),
+        asyncio.ensure_future(bind({'job_id': 2}))) == [
+            {'job_id': 1}, {'job_id': 2}]
+
+    token = var.set({'request_id': 'abc'})
+    assert var.get() == {'request_id': 'abc'}
+    var.reset(token)
+    assert var.get() == {}
@@ -0,0 +1,34 @@
+from cloud_img.metrics import Metrics, Timing
+
+
+def test_timing():
+    timing = Timing()
+    assert timing.toJSON()['avg'] == 0.0
+
+    timing.observe(0.002)
+    timing.observe(0.2)
+
+    rv = timing.toJSON()
+    assert rv['count'] == 2
+    assert rv['min'] == 0.002
+    assert rv['max'] == 0.2
+    assert rv['buckets']['0.001'] == 0
+    assert rv['buckets']['0.005'] == 1
+    assert rv['buckets']['inf'] == 2
+
+
+def test_metrics_snapshot():
+    metrics = Metrics()
+    metrics.incr('jobs')
+    metrics.incr('jobs', 2)
+    with metrics.timer('job'):
+        pass
+    metrics.register('component', lambda: {'size': 1})
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'jobs': 3}
+    assert snapshot['timings']['job']['count'] == 1
+    assert snapshot['collectors'] == {'component': {'size': 1}}
+
+    metrics.reset()
+    assert metrics.snapshot()['counters'] == {}
@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+import pytest
+
+from cloud_img.metrics import metrics
+from cloud_img.models import gather_queries
+
+
+async def test_gather_queries_concurrently():
+    metrics.reset()
+
+    async def query(rv, seconds):
+        await asyncio.sleep(seconds)
+        return rv
+
+    start = time.perf_counter()
+    rv = await gather_queries(
+        'test', total=query(3, 0.1), images=query([1, 2, 3], 0.1))
+    assert time.perf_counter() - start < 0.19
+    assert rv == {'total': 3, 'images': [1, 2, 3]}
+
+    timings = metrics.snapshot()['timings']
+    assert timings['test.total']['count'] == 1
+    assert timings['test.images']['count'] == 1
+
+
+async def test_gather_queries_cancel_on_failure():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        raise ValueError('fail')
+
+    with pytest.raises(ValueError):
+        await gather_queries('test', slow=slow(), fail=fail())
+    await asyncio.sleep(0)
+    assert cancelled == [True]
@@ -1,3 +1,4 @@
+from cloud_img.blobs import RedisBlobStore, content_hash
 from cloud_img.models import Image, ImageWithUploadCfg, UploadCfg
 
 
@@ -40,6 +41,14 @@ async def test_images_paginate(db_manager, user, user_2):
     assert len(images) == 10
     assert images[0].id == 10
 
+    images = list(await Image.paginate(
+        user_id=user.id, last_id=4, db_manager=db_manager))
+    assert [image.id for image in images] == [3, 2, 1]
+
+    images = list(await Image.paginate(
+        last_id=16, page_size=5, db_manager=db_manager))
+    assert [image.id for image in images] == [15, 14, 13, 12, 11]
+
 
 async def test_get_upload_cfgs(db_manager, user):
     upload_cfg_a = await db_manager.create(UploadCfg, user=user, name='test_a')
@@ -66,6 +75,30 @@ async def test_get_upload_cfgs(db_manager, user):
     assert len(upload_cfgs) == 1
 
 
+async def test_get_upload_cfgs_in_batch(db_manager, user):
+    upload_cfg_a = await db_manager.create(UploadCfg, user=user, name='test_a')
+    upload_cfg_b = await db_manager.create(UploadCfg, user=user, name='test_b')
+    for i in range(4):
+        image = await db_manager.create(Image, user=user)
+        if i % 2:
+            await db_manager.create(
+                ImageWithUploadCfg, upload_cfg=upload_cfg_a, image=image)
+        if i % 3:
+            await db_manager.create(
+                ImageWithUploadCfg, upload_cfg=upload_cfg_b, image=image)
+
+    assert await Image.get_upload_cfgs_in_batch(
+        image_ids=[], db_manager=db_manager) == {}
+
+    upload_cfgs = await Image.get_upload_cfgs_in_batch(
+        image_ids=[1, 2, 3, 5], db_manager=db_manager)
+    assert upload_cfgs[1] == []
+    assert [v.upload_cfg_id for v in upload_cfgs[2]] == [
+        upload_cfg_a.id, upload_cfg_b.id]
+    assert [v.upload_cfg_id for v in upload_cfgs[3]] == [upload_cfg_b.id]
+    assert upload_cfgs[5] == []
+
+
 async def test_filter_by_uploadcfg(db_manager, user):
     upload_cfg_a = await db_manager.create(UploadCfg, user=user, name='test_a')
     upload_cfg_b = await db_manager.create(UploadCfg, user=user, name='test_b')
@@ -101,3 +134,87 @@ async def test_filter_by_uploadcfg(db_manager, user):
     assert len(images) == 2
     assert images[0].id == 3
     assert images[1].id == 2
+
+
+async def test_image_ingest(db_manager, redis_client, user, user_2):
+    blob_store = RedisBlobStore(redis_client, legacy_hash=None)
+
+    image, created = await Image.ingest(
+        user.id, b'image', blob_store=blob_store, db_manager=db_manager)
+    assert created
+    assert image.content_hash == content_hash(b'image')
+    assert await blob_store.get(image.id) == b'image'
+
+    same, created = await Image.ingest(
+        user.id, b'image', blob_store=blob_store, db_manager=db_manager)
+    assert not created
+    assert same.id == image.id
+
+    other, created = await Image.ingest(
+        user_2.id, b'image', blob_store=blob_store, db_manager=db_manager)
+    assert created
+    assert other.id != image.id
+
+
+async def test_find_duplicate(db_manager, user):
+    upload_cfg = await db_manager.create(UploadCfg, user=user, name='test_a')
+    upload_cfg_2 = await db_manager.create(
+        UploadCfg, user=user, name='test_b')
+    digest = content_hash(b'image')
+    image = await db_manager.create(Image, user=user, content_hash=digest)
+    same = await db_manager.create(Image, user=user, content_hash=digest)
+    other = await db_manager.create(
+        Image, user=user, content_hash=content_hash(b'other'))
+    legacy = await db_manager.create(Image, user=user)
+    uploaded = await db_manager.create(
+        ImageWithUploadCfg, image=image, upload_cfg=upload_cfg,
+        image_url='https://example.com/1')
+
+    rv = await ImageWithUploadCfg.find_duplicate(
+        same.id, upload_cfg.id, db_manager=db_manager)
+    assert rv.id == uploaded.id
+    assert rv.image_url == 'https://example.com/1'
+
+    for image_id, upload_cfg_id in ((same.id, upload_cfg_2.id),
+                                    (other.id, upload_cfg.id),
+                                    (legacy.id, upload_cfg.id),
+                                    (image.id, upload_cfg.id)):
+        assert await ImageWithUploadCfg.find_duplicate(
+            image_id, upload_cfg_id, db_manager=db_manager) is None
+
+
+async def test_find_duplicate_of_another_user(db_manager, user, user_2):
+    upload_cfg = await db_manager.create(UploadCfg, user=user, name='test_a')
+    digest = content_hash(b'image')
+    image = await db_manager.create(Image, user=user, content_hash=digest)
+    await db_manager.create(
+        ImageWithUploadCfg, image=image, upload_cfg=upload_cfg,
+        image_url='https://example.com/1')
+    image_2 = await db_manager.create(
+        Image, user=user_2, content_hash=digest)
+
+    # the result of the other user's image is not reused
+    assert await ImageWithUploadCfg.find_duplicate(
+        image_2.id, upload_cfg.id, db_manager=db_manager) is None
+
+
+async def test_upsert_many(db_manager, user):
+    upload_cfg = await db_manager.create(UploadCfg, user=user, name='test_a')
+    images = [await db_manager.create(Image, user=user) for _ in range(2)]
+    await db_manager.create(
+        ImageWithUploadCfg, image=images[0], upload_cfg=upload_cfg,
+        image_url='https://example.com/old')
+
+    await db_manager.execute(ImageWithUploadCfg.upsert_many([
+        dict(image_id=image.id, upload_cfg_id=upload_cfg.id,
+             image_url=f'https://example.com/{image.id}')
+        for image in images
+    ]))
+
+    rows = list(await Image.get_upload_cfgs(images[0].id,
+                                            db_manager=db_manager))
+    assert len(rows) == 1
+    assert rows[0].image_url == f'https://example.com/{images[0].id}'
+    rows = list(await Image.get_upload_cfgs(images[1].id,
+                                            db_manager=db_manager))
+    assert rows[0].image_url == f'https://example.com/{images[1].id}'
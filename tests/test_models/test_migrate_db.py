@@ -0,0 +1,39 @@
+from cloud_img.models import Image, migrate_db
+
+
+def test_migrate_db_creates_missing_indexes(db):
+    database = db.obj
+
+    def indexes():
+        return {tuple(index.columns): index.name
+                for index in database.get_indexes('image')}
+
+    with database.allow_sync():
+        name = indexes()[('user_id', 'id')]
+        database.execute_sql(f'DROP INDEX `{name}` ON `image`')
+        assert ('user_id', 'id') not in indexes()
+
+        migrate_db(database, [Image])
+        assert ('user_id', 'id') in indexes()
+        # nothing to do the second time
+        migrate_db(database, [Image])
+
+
+def test_migrate_db_adds_missing_columns(db):
+    database = db.obj
+
+    def columns():
+        return {column.name for column in database.get_columns('image')}
+
+    with database.allow_sync():
+        name = {tuple(index.columns): index.name
+                for index in database.get_indexes('image')}[
+                    ('user_id', 'content_hash')]
+        database.execute_sql(f'DROP INDEX `{name}` ON `image`')
+        database.execute_sql('ALTER TABLE `image` DROP COLUMN `content_hash`')
+        assert 'content_hash' not in columns()
+
+        migrate_db(database, [Image])
+        assert 'content_hash' in columns()
+        assert ('user_id', 'content_hash') in {
+            tuple(index.columns) for index in database.get_indexes('image')}
@@ -1,11 +1,21 @@
+import asyncio
+import io
 import json
+import threading
 
+import aiohttp
 import peewee
 import pytest
+from aiohttp import web
 from aiohttp.test_utils import make_mocked_coro, sentinel
 from lxml import etree
 
-from cloud_img.models.upload_cfg import Adapter, JSONField, UploadCfg
+from cloud_img.breakers import CircuitOpen
+from cloud_img.models.upload_cfg import (Adapter, ImageWithUploadCfg,
+                                         JSONField, LocalRequestError,
+                                         MultipartForm, UploadCfg)
+from cloud_img.models.upload_cfg import Client as HTTPClient
+from cloud_img.utils import regex_cache
 
 
 def test_query_fail():
@@ -128,6 +138,23 @@ def Client(mocker):
     return Client
 
 
+def test_upsert_many_sql(db):
+    query = ImageWithUploadCfg.upsert_many([
+        {'image': 1, 'upload_cfg': 2, 'image_url': 'https://example.com/1'},
+        {'image': 3, 'upload_cfg': 4, 'image_url': 'https://example.com/3'},
+    ])
+    sql, params = query.sql()
+    assert sql.startswith('INSERT INTO `image_with_upload_cfg`')
+    assert sql.endswith(
+        'ON DUPLICATE KEY UPDATE '
+        '`image_url` = VALUES(`image_url`), '
+        '`thumbnail_url` = VALUES(`thumbnail_url`), '
+        '`delete_url` = VALUES(`delete_url`), '
+        '`seen_at` = VALUES(`seen_at`)')
+    for value in (1, 2, 3, 4, 'https://example.com/3'):
+        assert value in params
+
+
 async def test_upload_through_formdata(Client):
 
     image_data = b'abcdef'
@@ -248,3 +275,367 @@ async def test_UploadCfg_paginate(db_manager, user, user_2):
     assert isinstance(images[0], UploadCfg)
     assert len(images) == 10
     assert images[0].id == 10
+
+
+async def test_upload_plan_reused_between_uploads(Client):
+    image_data = b'abcdef'
+
+    client = Client("")
+
+    upload_cfg = UploadCfg()
+    upload_cfg.request_url = 'http://localhost:80/'
+    upload_cfg.values = {'authToken': 'abcdef'}
+    upload_cfg.request_querystring = {'token': '$authToken$'}
+    upload_cfg.request_formdata = {'file': '$input$', 'name': 'img'}
+
+    plan = upload_cfg.plan
+    assert plan.image_fields == ('file', )
+    assert plan.url.query['token'] == 'abcdef'
+
+    await upload_cfg.upload(client, image_data)
+    await upload_cfg.upload(client, image_data[::-1])
+    assert upload_cfg.plan is plan
+
+    _, kwargs = client.send.call_args
+    assert kwargs['data']['file'] == image_data[::-1]
+    assert kwargs['data']['name'] == 'img'
+
+    upload_cfg.values = {'authToken': 'ghijkl'}
+    assert upload_cfg.plan is not plan
+    assert upload_cfg.plan.url.query['token'] == 'ghijkl'
+
+    plan = upload_cfg.plan
+    upload_cfg.values['authToken'] = 'mnopqr'
+    upload_cfg.invalidate_plan()
+    assert upload_cfg.plan is not plan
+    assert upload_cfg.plan.url.query['token'] == 'mnopqr'
+
+
+def test_upload_plan_forbid_image_data_in_headers():
+    upload_cfg = UploadCfg()
+    upload_cfg.request_url = 'http://localhost:80/'
+    upload_cfg.request_headers = {'file': '$input$'}
+
+    with pytest.raises(AssertionError):
+        upload_cfg.plan
+
+
+def test_query_response_decode_once(mocker):
+    resource = {'data': {'url': 'a.png', 'thumb': 'b.png', 'delete': 'c'}}
+    response_body = json.dumps(resource)
+
+    upload_cfg = UploadCfg()
+    upload_cfg.image_url_querystr = '$json:data.url$'
+    upload_cfg.thumbnail_url_querystr = '$json:data.thumb$'
+    upload_cfg.delete_url_querystr = 'https://example.com/$json:data.delete$'
+
+    spy = mocker.spy(json, 'loads')
+    rv = upload_cfg.query_response(response_body)
+    assert spy.call_count == 1
+    assert rv == {
+        'image_url': 'a.png',
+        'thumbnail_url': 'b.png',
+        'delete_url': 'https://example.com/c',
+    }
+
+    queries = upload_cfg.response_queries
+    upload_cfg.query_response(response_body)
+    assert upload_cfg.response_queries is queries
+
+    upload_cfg.thumbnail_url_querystr = ''
+    assert upload_cfg.response_queries is not queries
+    rv = upload_cfg.query_response(response_body)
+    assert rv['thumbnail_url'] == ''
+
+
+async def test_query_response_stream():
+    chunks_read = 0
+
+    async def chunks():
+        nonlocal chunks_read
+        for chunk in ['<a href="https://exa', 'mple.com/1.png">', ' id=12 ',
+                      'x' * 1024]:
+            chunks_read += 1
+            yield chunk
+
+    upload_cfg = UploadCfg()
+    upload_cfg.image_url_querystr = r'$regex:href="(\S+?)"$'
+    upload_cfg.delete_url_querystr = r'http://hostname.com/$regex:id=(\d+)$'
+
+    rv = await upload_cfg.query_response_stream(chunks())
+    assert rv == {
+        'image_url': 'https://example.com/1.png',
+        'thumbnail_url': '',
+        'delete_url': 'http://hostname.com/12',
+    }
+    assert chunks_read == 4
+
+
+async def test_query_response_stream_greedy_regex():
+    response_body = '{"url":"http://x/1.png","id":"12"}'
+
+    async def chunks(size):
+        for i in range(0, len(response_body), size):
+            yield response_body[i:i + size]
+
+    upload_cfg = UploadCfg()
+    upload_cfg.image_url_querystr = r'$regex:"url":"(.+)"$'
+    expected = upload_cfg.query_response(response_body)
+    assert expected['image_url'] == 'http://x/1.png","id":"12'
+    for size in (1, 5, 24, len(response_body)):
+        assert await upload_cfg.query_response_stream(chunks(size)) == \
+            expected
+
+
+async def test_query_response_stream_searches_linearly(mocker):
+    search = mocker.spy(regex_cache, 'search')
+
+    async def chunks():
+        for _ in range(4096):
+            yield 'x'
+        yield ' id=12 '
+
+    upload_cfg = UploadCfg()
+    upload_cfg.image_url_querystr = r'$regex:id=(\d+)$'
+    rv = await upload_cfg.query_response_stream(chunks(), window=64)
+    assert rv['image_url'] == '12'
+    # searched once per window dropped and when closing
+    assert search.call_count <= 4096 // 64 + 1
+
+
+async def test_query_response_stream_guarded(mocker):
+    mocker.patch.object(regex_cache, 'timeout', 1)
+
+    async def chunks():
+        yield '<a href="https://example.com/1.png"> '
+        yield 'x' * 64
+
+    upload_cfg = UploadCfg()
+    upload_cfg.image_url_querystr = r'$regex:href="(\S+?)"$'
+    try:
+        rv = await upload_cfg.query_response_stream(chunks(), window=16)
+        assert rv['image_url'] == 'https://example.com/1.png'
+
+        upload_cfg.image_url_querystr = r'$regex:id=(\d+)$'
+        with pytest.raises(ValueError):
+            await upload_cfg.query_response_stream(chunks())
+    finally:
+        regex_cache.close()
+
+
+async def test_query_xml_response_stream():
+    response_body = ('<data><urls>https://www.python.org/</urls>'
+                     '<urls>https://docs.python.org/</urls>'
+                     '<id>12</id></data>')
+
+    async def chunks(size):
+        for i in range(0, len(response_body), size):
+            yield response_body[i:i + size]
+
+    upload_cfg = UploadCfg()
+    upload_cfg.image_url_querystr = '$xml:data.urls[2]$'
+    upload_cfg.thumbnail_url_querystr = 'http://hostname.com/$xml:data.id$'
+    rv = await upload_cfg.query_response_stream(chunks(7))
+    assert rv == upload_cfg.query_response(response_body)
+
+    upload_cfg.image_url_querystr = '$xml:data.url$'
+    with pytest.raises(ValueError):
+        await upload_cfg.query_response_stream(chunks(7))
+
+
+async def test_upload_stream(mocker):
+    response_body = json.dumps({'data': {'url': 'https://example.com/1'}})
+
+    async def send_stream(**kwargs):
+        yield response_body[:10]
+        yield response_body[10:]
+
+    client = mocker.Mock(spec=Adapter)
+    client.send_stream = mocker.Mock(side_effect=send_stream)
+
+    upload_cfg = UploadCfg()
+    upload_cfg.request_url = 'http://localhost:80/'
+    upload_cfg.request_formdata = {'file': '$input$'}
+    upload_cfg.image_url_querystr = '$json:data.url$'
+
+    rv, body = await upload_cfg.upload(client, b'abcdef', stream=True)
+    assert rv['image_url'] == 'https://example.com/1'
+    assert body is None
+
+    _, kwargs = client.send_stream.call_args
+    assert kwargs['data']['file'] == b'abcdef'
+
+
+async def test_client_host_concurrency(aiohttp_server):
+    in_flight = peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return web.Response(text='hello')
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    server = await aiohttp_server(app)
+
+    client = HTTPClient(host_concurrency=2)
+    try:
+        url = server.make_url('/')
+        rv = await asyncio.gather(*[client.send('get', url)
+                                    for _ in range(6)])
+        assert rv == ['hello'] * 6
+        assert peak == 2
+
+        chunks = [chunk async for chunk in client.send_stream('get', url)]
+        assert ''.join(chunks) == 'hello'
+
+        stats = client.stats()
+        assert stats['requests'] == 7
+        assert stats['connections_created'] == 2
+        assert stats['connections_reused'] == 5
+        assert stats['hosts'][url.host] == {'concurrency': 2, 'in_flight': 0}
+    finally:
+        await client.close()
+
+
+async def test_client_breaker(aiohttp_server):
+    statuses = [500, 500, 200]
+
+    async def handler(request):
+        return web.Response(text='hello', status=statuses.pop(0))
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    server = await aiohttp_server(app)
+
+    client = HTTPClient(
+        breaker={'failure_threshold': 2, 'reset_timeout': 0.05})
+    try:
+        url = server.make_url('/')
+        for _ in range(2):
+            with pytest.raises(aiohttp.ClientResponseError):
+                await client.send('get', url)
+        # fail fast without reaching the host
+        with pytest.raises(CircuitOpen):
+            await client.send('get', url)
+        assert statuses == [200]
+        assert client.stats()['hosts'][url.host]['breaker'] == {
+            'state': 'open', 'failures': 2, 'rejected': 1}
+
+        # the trial request closes the circuit
+        await asyncio.sleep(0.05)
+        assert await client.send('get', url) == 'hello'
+        assert client.stats()['hosts'][url.host]['breaker']['state'] == \
+            'closed'
+    finally:
+        await client.close()
+
+
+async def test_client_local_error(aiohttp_server):
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        await request.read()
+        return web.Response(text='hello')
+
+    app = web.Application()
+    app.router.add_post('/', handler)
+    server = await aiohttp_server(app)
+
+    async def chunks():
+        yield b'abc'
+        raise KeyError('image')
+
+    client = HTTPClient(
+        breaker={'failure_threshold': 1, 'reset_timeout': 60})
+    try:
+        url = server.make_url('/')
+        # the errors of the body are not failures of the host
+        for _ in range(2):
+            with pytest.raises(LocalRequestError):
+                await client.send('post', url, data=chunks())
+        with pytest.raises(LocalRequestError):
+            await client.send('get', 'not a url')
+        assert client.stats()['hosts'][url.host]['breaker']['state'] == \
+            'closed'
+        assert await client.send('post', url, data=b'abc') == 'hello'
+    finally:
+        await client.close()
+
+
+async def test_multipart_form():
+    image_data = b'abcdef'
+
+    upload_cfg = UploadCfg()
+    upload_cfg.request_url = 'http://localhost:80/'
+    upload_cfg.values = {'authToken': 'abcdef'}
+    upload_cfg.request_formdata = {'token': '$authToken$', 'file': '$input$'}
+
+    form = upload_cfg.plan.formdata(image_data)
+    assert isinstance(form, MultipartForm)
+    assert dict(form) == {'token': 'abcdef', 'file': image_data}
+    assert form.content_type.endswith(upload_cfg.plan.boundary)
+
+    chunks = [chunk async for chunk in form.chunks()]
+    body = b''.join(chunks)
+    assert len(body) == form.size
+    assert any(isinstance(chunk, memoryview) for chunk in chunks)
+    assert b'name="file"; filename="file"\r\n\r\nabcdef\r\n' in body
+    assert body.endswith(f'--{upload_cfg.plan.boundary}--\r\n'.encode())
+
+    form = upload_cfg.plan.formdata(io.BytesIO(image_data))
+    assert form.size is None
+    assert b''.join([chunk async for chunk in form.chunks()]) == body
+
+
+async def test_multipart_form_reads_file_in_executor():
+    threads = set()
+
+    class File(io.BytesIO):
+        def read(self, size=-1):
+            threads.add(threading.get_ident())
+            return super().read(size)
+
+    upload_cfg = UploadCfg()
+    upload_cfg.request_url = 'http://localhost:80/'
+    upload_cfg.request_formdata = {'file': '$input$'}
+    form = upload_cfg.plan.formdata(File(b'abcdef'))
+    body = b''.join([chunk async for chunk in form.chunks()])
+    assert b'abcdef' in body
+    assert threads and threading.get_ident() not in threads
+
+
+async def test_client_send_multipart_form(aiohttp_server):
+    image_data = bytes(range(256)) * 1024
+
+    async def handler(request):
+        data = await request.post()
+        assert data['token'] == 'abcdef'
+        assert data['file'].filename == 'file'
+        assert data['file'].file.read() == image_data
+        return web.Response(text='ok')
+
+    app = web.Application(client_max_size=1024 ** 2)
+    app.router.add_post('/', handler)
+    server = await aiohttp_server(app)
+
+    upload_cfg = UploadCfg()
+    upload_cfg.request_url = str(server.make_url('/'))
+    upload_cfg.values = {'authToken': 'abcdef'}
+    upload_cfg.request_formdata = {'token': '$authToken$', 'file': '$input$'}
+
+    client = HTTPClient()
+    try:
+        async def image_chunks():
+            yield image_data[:1000]
+            yield image_data[1000:]
+
+        for data in (image_data, io.BytesIO(image_data), image_chunks()):
+            _, response_body = await upload_cfg.upload(client, data)
+            assert response_body == 'ok'
+    finally:
+        await client.close()
@@ -1,5 +1,6 @@
 from aiohttp_security.api import IDENTITY_KEY
 
+from cloud_img.hashing import password_hasher
 from cloud_img.models.user import User
 
 
@@ -73,3 +74,25 @@ async def test_login_fail_by_params_error(aiohttp_client, app, db_manager,
     assert respBody['message'] == 'paramaters error'
 
     assert app[IDENTITY_KEY]._cookie_name not in resp.cookies
+
+
+async def test_login_shed_when_hasher_busy(aiohttp_client, app, db_manager,
+                                           faker):
+    username = faker.name()
+    password = faker.password()
+    await db_manager.create(User, username=username, password=password)
+
+    client = await aiohttp_client(app)
+    max_pending = password_hasher.max_pending
+    password_hasher.max_pending = 0
+    try:
+        resp = await client.post(
+            '/login', json={
+                'username': username,
+                'password': password,
+            })
+    finally:
+        password_hasher.max_pending = max_pending
+    assert resp.status == 429
+    respBody = await resp.json()
+    assert respBody['message'] == 'too many requests'
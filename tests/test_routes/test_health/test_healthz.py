@@ -0,0 +1,26 @@
+from cloud_img.routes import health
+
+
+async def test_healthz(aiohttp_client, app, db_manager):
+    client = await aiohttp_client(app)
+    resp = await client.get('/healthz')
+    assert resp.status == 200
+    data = await resp.json()
+    assert data == {
+        'ready': True,
+        'dependencies': {'mysql': 'ready', 'redis': 'ready'},
+    }
+
+
+async def test_healthz_unavailable(aiohttp_client, app, db_manager,
+                                   monkeypatch):
+    async def ping_redis(app):
+        raise ConnectionRefusedError()
+
+    monkeypatch.setitem(health.PINGS, 'redis', ping_redis)
+    client = await aiohttp_client(app)
+    resp = await client.get('/healthz')
+    assert resp.status == 503
+    data = await resp.json()
+    assert data['ready'] is False
+    assert data['dependencies'] == {'mysql': 'ready', 'redis': 'unavailable'}
@@ -0,0 +1,16 @@
+from cloud_img.metrics import metrics
+
+
+async def test_show_metrics(logined_client):
+    metrics.incr('test.show_metrics')
+    resp = await logined_client.get('/metrics')
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['counters']['test.show_metrics'] >= 1
+    assert set(data) == {'counters', 'timings', 'collectors'}
+
+
+async def test_show_metrics_unauthorized(aiohttp_client, app):
+    client = await aiohttp_client(app)
+    resp = await client.get('/metrics')
+    assert resp.status == 401
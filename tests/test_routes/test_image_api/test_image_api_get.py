@@ -1,3 +1,4 @@
+from cloud_img.counters import image_counter
 from cloud_img.models import Image, ImageWithUploadCfg, UploadCfg
 
 
@@ -96,3 +97,50 @@ async def test_filter_by_upload_cfg_id(db_manager, faker, logined_client,
     assert data['total'] == 1
     images = data['images']
     assert images[0]['id'] == 2
+
+
+async def test_cursor_pagination(db_manager, faker, logined_client, user):
+    for i in range(20):
+        await db_manager.create(Image, user=user)
+
+    resp = await logined_client.get('/image', params={'page_size': 8})
+    assert resp.status == 200
+    data = await resp.json()
+    assert [image['id'] for image in data['images']] == list(range(20, 12, -1))
+    cursor = data['next_cursor']
+
+    ids = []
+    while cursor is not None:
+        resp = await logined_client.get(
+            '/image', params={'cursor': cursor, 'page_size': 8})
+        assert resp.status == 200
+        data = await resp.json()
+        assert data['total'] == 20
+        ids.extend(image['id'] for image in data['images'])
+        cursor = data['next_cursor']
+    assert ids == list(range(12, 0, -1))
+
+    resp = await logined_client.get('/image', params={'cursor': 'invalid'})
+    assert resp.status == 400
+
+
+async def test_total_modes(db_manager, faker, logined_client, user,
+                           redis_client):
+    # the counter may be left by the previous tests of the same user id
+    await image_counter.invalidate(redis_client, user.id)
+    for i in range(3):
+        await db_manager.create(Image, user=user)
+
+    resp = await logined_client.get('/image', params={'total': 'none'})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['total'] is None
+    assert len(data['images']) == 3
+
+    resp = await logined_client.get('/image', params={'total': 'approximate'})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['total'] == 3
+
+    resp = await logined_client.get('/image', params={'total': 'unknown'})
+    assert resp.status == 400
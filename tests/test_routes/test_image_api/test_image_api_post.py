@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import aiohttp
+
+from cloud_img.blobs import content_hash
+from cloud_img.models import Image
+
+
+async def test_post_image(db_manager, logined_client, user):
+    image_bytes = Path('tests/assets/python.png').read_bytes()
+
+    def form():
+        data = aiohttp.FormData()
+        data.add_field('file', image_bytes, filename='python.png',
+                       content_type='image/png')
+        return data
+
+    resp = await logined_client.post('/image', data=form())
+    assert resp.status == 201
+    data = await resp.json()
+    assert data['created'] is True
+    image_id = data['image']['id']
+
+    image = await db_manager.get(Image, id=image_id)
+    assert image.content_hash == content_hash(image_bytes)
+    blob_store = logined_client.server.app['blob_store']
+    assert bytes(await blob_store.get(image_id)) == image_bytes
+
+    # the same content is not stored again
+    resp = await logined_client.post('/image', data=form())
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['created'] is False
+    assert data['image']['id'] == image_id
+
+    resp = await logined_client.post('/image', data={'name': 'x'})
+    assert resp.status == 400
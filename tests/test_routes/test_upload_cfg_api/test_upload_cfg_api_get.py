@@ -1,3 +1,4 @@
+from cloud_img.counters import upload_cfg_counter
 from cloud_img.models import UploadCfg
 
 
@@ -39,3 +40,43 @@ async def test_pagination(db_manager, faker, logined_client, user):
     assert len(data['upload_cfgs']) == 10
     assert data['page_no'] == 2
     assert data['page_size'] == 10
+
+
+async def test_cursor_pagination(db_manager, faker, logined_client, user):
+    for i in range(20):
+        await db_manager.create(UploadCfg, user=user)
+
+    resp = await logined_client.get('/upload_cfg')
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data['upload_cfgs']) == 15
+
+    resp = await logined_client.get(
+        '/upload_cfg', params={'cursor': data['next_cursor']})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['upload_cfgs'][0]['id'] == 5
+    assert len(data['upload_cfgs']) == 5
+    assert data['next_cursor'] is None
+
+    resp = await logined_client.get('/upload_cfg', params={'cursor': 'e30='})
+    assert resp.status == 400
+
+
+async def test_total_modes(db_manager, faker, logined_client, user,
+                           redis_client):
+    # the counter may be left by the previous tests of the same user id
+    await upload_cfg_counter.invalidate(redis_client, user.id)
+    for i in range(3):
+        await db_manager.create(UploadCfg, user=user)
+
+    resp = await logined_client.get('/upload_cfg', params={'total': 'none'})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['total'] is None
+
+    resp = await logined_client.get(
+        '/upload_cfg', params={'total': 'approximate'})
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['total'] == 3
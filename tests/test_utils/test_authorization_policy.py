@@ -1,5 +1,10 @@
+from datetime import datetime, timedelta
+
+import jwt
+
+from cloud_img.constants import GLOBAL, JWT_KEY_CONFIG, JWT_KEY_DEFAULT
 from cloud_img.models.user import User
-from cloud_img.utils import AuthorizationPolicy
+from cloud_img.utils import AuthorizationPolicy, get_config
 
 
 async def test_authorization_success(loop, app, db_manager, faker):
@@ -29,3 +34,64 @@ async def test_authorization_fail(loop, app, db_manager, faker):
 
     assert user.id != user_id
     assert user_id is None
+
+
+def make_identity(**payload):
+    key = get_config().get(GLOBAL, {}).get(JWT_KEY_CONFIG, JWT_KEY_DEFAULT)
+    return jwt.encode(payload=payload, key=key, algorithm='HS256').decode()
+
+
+async def test_authorization_cached(loop, app, db_manager, faker, mocker):
+    username = faker.name()
+    password = faker.password()
+    user = await db_manager.create(User, username=username, password=password)
+    identity = user.identity
+
+    authorization_policy = AuthorizationPolicy(app=app)
+    spy = mocker.spy(db_manager, 'get')
+
+    assert user.id == await authorization_policy.authorized_userid(identity)
+    assert user.id == await authorization_policy.authorized_userid(identity)
+    assert spy.call_count == 1
+
+    # deleted user is authorized until the cache is invalidated
+    await db_manager.delete(user)
+    assert user.id == await authorization_policy.authorized_userid(identity)
+    authorization_policy.invalidate(user.id)
+    assert await authorization_policy.authorized_userid(identity) is None
+    # negative cache
+    assert await authorization_policy.authorized_userid(identity) is None
+    assert spy.call_count == 2
+
+
+async def test_authorization_without_cache(loop, app, db_manager, faker):
+    username = faker.name()
+    password = faker.password()
+    user = await db_manager.create(User, username=username, password=password)
+    identity = user.identity
+
+    authorization_policy = AuthorizationPolicy(
+        app=app, identity_ttl=0, negative_ttl=0)
+    assert user.id == await authorization_policy.authorized_userid(identity)
+    await db_manager.delete(user)
+    assert await authorization_policy.authorized_userid(identity) is None
+
+
+async def test_authorization_trust_claims(loop, app, db_manager, mocker):
+    authorization_policy = AuthorizationPolicy(app=app, trust_claims=True)
+    spy = mocker.spy(db_manager, 'get')
+
+    identity = make_identity(
+        user_id=42, exp=datetime.utcnow() + timedelta(seconds=60))
+    assert await authorization_policy.authorized_userid(identity) == 42
+    assert spy.call_count == 0
+
+    expired_identity = make_identity(
+        user_id=42, exp=datetime.utcnow() - timedelta(seconds=60))
+    assert await authorization_policy.authorized_userid(
+        expired_identity) is None
+
+    # identity without expiry is looked up
+    assert await authorization_policy.authorized_userid(
+        make_identity(user_id=42)) is None
+    assert spy.call_count == 1
@@ -1,4 +1,10 @@
-from cloud_img.utils import check_mysql, check_redis, get_config
+import asyncio
+import time
+
+import pytest
+
+from cloud_img.utils import (check_mysql, check_redis, get_config,
+                             wait_for_dependencies)
 
 
 def test_check_mysql(app):
@@ -29,3 +35,35 @@ def test_check_redis(app):
     conf = get_config()['db']['redis']
     is_existed = check_redis(conf)
     assert is_existed is True
+
+
+async def test_wait_for_dependencies():
+    attempts = {'fast': 0, 'slow': 0}
+
+    def probe(name, ready_after):
+        async def probe():
+            attempts[name] += 1
+            await asyncio.sleep(0.05)
+            return attempts[name] > ready_after
+        return probe
+
+    start = time.monotonic()
+    await wait_for_dependencies(
+        {'fast': probe('fast', 0), 'slow': probe('slow', 3)},
+        base_delay=0.01, max_delay=0.02)
+    # probed concurrently
+    assert time.monotonic() - start < 0.4
+    assert attempts == {'fast': 1, 'slow': 4}
+
+
+async def test_wait_for_dependencies_timeout():
+    async def ready():
+        return True
+
+    async def blocking():
+        return False
+
+    with pytest.raises(TimeoutError, match='not ready: redis.'):
+        await wait_for_dependencies(
+            {'mysql': ready, 'redis': blocking},
+            timeout=0.1, base_delay=0.01)
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import signal
+
+import pytest
+import yaml
+
+from cloud_img import utils
+from cloud_img.constants import GLOBAL, JWT_KEY_DEFAULT
+from cloud_img.utils import ConfigSnapshot, get_config, reload_config, thaw
+
+
+RAW = {
+    GLOBAL: {'JWT_KEY': 'key'},
+    'test': {
+        'db': {'mysql': {'host': 'localhost'}, 'redis': {'port': 6379}},
+        'worker': {'http': {'hosts': ['sm.ms']}},
+    },
+}
+
+
+def test_config_snapshot():
+    config = ConfigSnapshot(RAW, 'test')
+    assert config.jwt_key == 'key'
+    assert config.mysql['host'] == 'localhost'
+    assert config.redis['port'] == 6379
+    assert config.worker['http']['hosts'] == ('sm.ms', )
+    assert config.auth == {}
+    assert set(config) == {GLOBAL, 'db', 'worker'}
+
+    with pytest.raises(TypeError):
+        config['db'] = {}
+    with pytest.raises(TypeError):
+        config['db']['mysql']['host'] = '127.0.0.1'
+
+    assert thaw(config['worker']) == {'http': {'hosts': ['sm.ms']}}
+    assert ConfigSnapshot({GLOBAL: {}}).jwt_key == JWT_KEY_DEFAULT
+
+
+def test_get_config_without_copying(app):
+    assert get_config() is get_config()
+
+
+async def test_reload_config(app, aiohttp_client, tmp_path, monkeypatch):
+    # starting the app installs the SIGHUP handler
+    await aiohttp_client(app)
+    config = get_config()
+    path = tmp_path / 'conf.yaml'
+    monkeypatch.setattr(utils, '_config_path', path)
+
+    path.write_text('not: [valid')
+    with pytest.raises(Exception):
+        reload_config()
+    assert get_config() is config
+
+    path.write_text(yaml.dump({
+        GLOBAL: {'JWT_KEY': 'reloaded'},
+        app['mode']: thaw(config),
+    }))
+    os.kill(os.getpid(), signal.SIGHUP)
+    for _ in range(100):
+        if get_config() is not config:
+            break
+        await asyncio.sleep(0.01)
+    assert get_config().jwt_key == 'reloaded'
+    assert get_config().mysql == config.mysql
@@ -0,0 +1,21 @@
+import pytest
+
+from cloud_img.utils import decode_cursor, encode_cursor
+
+
+def test_cursor():
+    assert decode_cursor(encode_cursor(42)) == 42
+    assert decode_cursor('') is None
+    assert decode_cursor(None) is None
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    encode_cursor('42'),
+    encode_cursor(True),
+    'e30=',  # {}
+    'W10=',  # []
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match='invalid cursor'):
+        decode_cursor(cursor)
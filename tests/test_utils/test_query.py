@@ -1,7 +1,8 @@
 import pytest
 from lxml import etree
 
-from cloud_img.utils import query_json, query_regex, query_xml
+from cloud_img.utils import (compile_json_path, compile_xml_path, query_json,
+                             query_regex, query_xml)
 
 
 def test_query_json():
@@ -91,3 +92,29 @@ def test_query_regex():
 
     with pytest.raises(ValueError):
         query_regex(resource, r'(wrong pattern')
+
+
+def test_query_xml_nested():
+    resource = etree.fromstring('<rsp><image><url>a.png</url>'
+                                '<url>b.png</url></image></rsp>')
+
+    assert query_xml(resource, 'rsp.image.url') == 'a.png'
+    assert query_xml(resource, 'rsp.image.url[2]') == 'b.png'
+
+    with pytest.raises(ValueError):
+        query_xml(resource, 'rsp.image')
+
+    with pytest.raises(ValueError):
+        query_xml(resource, 'rsp.image.url.src')
+
+
+def test_compiled_path_cached():
+    assert compile_json_path('data.urls[1]') is \
+        compile_json_path('data.urls[1]')
+    assert compile_xml_path('data.urls[1]') is \
+        compile_xml_path('data.urls[1]')
+
+    assert compile_json_path('data.urls[1]').steps == (('data', None),
+                                                       ('urls', 1))
+    assert compile_xml_path('data.urls[1]').xpath is not None
+    assert compile_xml_path('data[1].urls').xpath is None
@@ -0,0 +1,73 @@
+import pytest
+
+from cloud_img.utils import (RegexCache, RegexTimeout, query_regex_async,
+                             regex_cache)
+
+
+def test_regex_cache_hits_and_misses():
+    cache = RegexCache(maxsize=2)
+
+    pattern = cache.compile(r'id=(\d+)')
+    assert cache.compile(r'id=(\d+)') is pattern
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+    cache.compile(r'url=(\S+)')
+    cache.compile(r'name=(\w+)')
+    stats = cache.stats()
+    assert stats['size'] == 2
+    assert r'id=(\d+)' not in stats['patterns']
+
+
+def test_regex_cache_bounded_by_weight():
+    cache = RegexCache(maxsize=10)
+    cache.compile(r'id=(\d+)')
+    cache.maxweight = cache.weight
+    cache.compile(r'url=(\S+)')
+
+    stats = cache.stats()
+    assert stats['size'] == 1
+    assert r'url=(\S+)' in stats['patterns']
+    assert stats['weight'] <= cache.maxweight
+
+
+def test_regex_cache_records_latency():
+    cache = RegexCache()
+    assert cache.search(r'id=(\d+)', 'id=12') == ('12', 5)
+    assert cache.search(r'id=(\d+)', 'no id') is None
+
+    timing = cache.stats()['patterns'][r'id=(\d+)']
+    assert timing['count'] == 2
+
+
+def test_regex_cache_search_is_not_guarded():
+    cache = RegexCache(timeout=0.5)
+    assert cache.search(r'id=(\d+)', 'id=12') == ('12', 5)
+    assert cache._guard._process is None
+
+
+async def test_regex_cache_timeout_guard():
+    cache = RegexCache(timeout=0.5)
+    try:
+        assert await cache.search_async(r'id=(\d+)', 'id=12') == ('12', 5)
+
+        with pytest.raises(RegexTimeout):
+            await cache.search_async(r'(a+)+$', 'a' * 64 + 'b')
+        assert cache.timeouts == 1
+
+        assert await cache.search_async(r'id=(\d+)', 'id=12') == ('12', 5)
+        assert cache.stats()['patterns'][r'id=(\d+)']['count'] == 2
+    finally:
+        cache.close()
+
+
+async def test_query_regex_timeout(mocker):
+    mocker.patch.object(regex_cache, 'timeout', 0.5)
+    try:
+        with pytest.raises(ValueError):
+            await query_regex_async('a' * 64 + 'b', r'(a+)+$')
+        with pytest.raises(ValueError):
+            await query_regex_async('id=12', r'(wrong pattern')
+        assert await query_regex_async('id=12', r'id=(\d+)') == '12'
+    finally:
+        regex_cache.close()
@@ -0,0 +1,31 @@
+import pytest
+
+from cloud_img.utils import retry
+
+
+async def test_retry():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError()
+        return 'ok'
+
+    assert await retry(fn, attempts=3, base_delay=0.001) == 'ok'
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(ConnectionError):
+        await retry(fn, attempts=2, base_delay=0.001)
+    assert len(calls) == 2
+
+    # not retried
+    async def fail():
+        calls.append(1)
+        raise ValueError()
+
+    calls.clear()
+    with pytest.raises(ValueError):
+        await retry(fail, exceptions=(ConnectionError, ), base_delay=0.001)
+    assert len(calls) == 1
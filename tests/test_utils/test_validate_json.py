@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from jsonschema import SchemaError
+
+from cloud_img.metrics import metrics
+from cloud_img.utils import validate_json
+
+
+SCHEMA = {
+    'type': 'object',
+    'properties': {'name': {'type': 'string'}},
+    'required': ['name'],
+}
+
+
+@validate_json(SCHEMA, max_body_size=64)
+async def echo(request):
+    return web.json_response(request['body'])
+
+
+async def test_validate_json(aiohttp_client):
+    metrics.reset()
+    app = web.Application()
+    app.router.add_post('/', echo)
+    client = await aiohttp_client(app)
+
+    resp = await client.post('/', json={'name': 'cloud_img'})
+    assert resp.status == 200
+    assert await resp.json() == {'name': 'cloud_img'}
+
+    for data in [b'{"name": 1}', b'{"name"', b'\xff']:
+        resp = await client.post('/', data=data)
+        assert resp.status == 400
+        assert (await resp.json())['message'] == 'paramaters error'
+
+    resp = await client.post('/', json={'name': 'x' * 64})
+    assert resp.status == 413
+
+    async def chunks():
+        yield b'{"name": "'
+        yield b'x' * 64
+        yield b'"}'
+
+    # without the content length
+    resp = await client.post('/', data=chunks())
+    assert resp.status == 413
+
+    async def small_chunks():
+        yield b'{"name": "'
+        await asyncio.sleep(0.01)
+        yield b'cloud_img'
+        await asyncio.sleep(0.01)
+        yield b'"}'
+
+    resp = await client.post('/', data=small_chunks())
+    assert resp.status == 200
+    assert await resp.json() == {'name': 'cloud_img'}
+
+    timing = metrics.snapshot()['timings']['routes.echo.validation']
+    assert timing['count'] == 5
+
+
+def test_validate_json_invalid_schema():
+    with pytest.raises(SchemaError):
+        validate_json({'type': 'unknown'})